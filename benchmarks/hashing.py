@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Compare sha256 throughput of the hashing strategies in hinkskalle_api.util.hashing
+against the old 64 KiB read loop.
+
+    python -m benchmarks.hashing --size 1024 --block-size 1
+
+The test file is read once before measuring, so all numbers are for data in
+the page cache (i.e. the per-call overhead, not the disk).
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+import typing
+
+import click
+
+from hinkskalle_api.util.hashing import hash_file, _hash_readinto
+
+
+def legacy(fh) -> str:
+  hl = hashlib.sha256()
+  while True:
+    chunk = fh.read(65535)
+    if len(chunk)==0:
+      break
+    hl.update(chunk)
+  return hl.hexdigest()
+
+def readinto(fh, block_size: int) -> str:
+  hl = hashlib.sha256()
+  _hash_readinto(fh, hl, None, block_size)
+  return hl.hexdigest()
+
+def file_digest(fh, block_size: int) -> str:
+  return hash_file(fh, block_size=block_size, use_mmap=False)[0]
+
+def mmapped(fh, block_size: int) -> str:
+  return hash_file(fh, block_size=block_size, use_mmap=True)[0]
+
+
+@click.command()
+@click.option('--size', help='test file size (MiB)', default=512, type=click.IntRange(min=1))
+@click.option('--block-size', help='block size (MiB)', default=1, type=click.IntRange(min=1))
+@click.option('--rounds', help='best of n', default=3, type=click.IntRange(min=1))
+@click.option('--dir', 'tmpdir', help='where to put the test file', type=click.Path(exists=True, file_okay=False))
+def main(size: int, block_size: int, rounds: int, tmpdir: typing.Optional[str]):
+  block_size = block_size*1024*1024
+  with tempfile.NamedTemporaryFile(dir=tmpdir) as tmp:
+    block = os.urandom(1024*1024)
+    for _ in range(size):
+      tmp.write(block)
+    tmp.flush()
+    with open(tmp.name, 'rb') as fh:
+      expected = legacy(fh)
+
+    strategies: typing.List[typing.Tuple[str, typing.Callable]] = [
+      ('read(65535) loop', legacy),
+      ('readinto', lambda fh: readinto(fh, block_size)),
+      ('mmap', lambda fh: mmapped(fh, block_size)),
+    ]
+    if hasattr(hashlib, 'file_digest'):
+      strategies.append(('hashlib.file_digest', lambda fh: file_digest(fh, block_size)))
+
+    baseline = None
+    for name, fn in strategies:
+      best = None
+      for _ in range(rounds):
+        with open(tmp.name, 'rb', buffering=0 if fn is not legacy else -1) as fh:
+          start = time.perf_counter()
+          digest = fn(fh)
+          elapsed = time.perf_counter() - start
+        if digest != expected:
+          raise click.ClickException(f"{name}: wrong digest {digest}")
+        best = elapsed if best is None else min(best, elapsed)
+      rate = size*1024*1024 / typing.cast(float, best) / 1e9
+      baseline = baseline or rate
+      click.echo(f"{name:<20} {rate:6.2f} GB/s  {rate/baseline:5.2f}x")
+
+if __name__ == '__main__':
+  main()
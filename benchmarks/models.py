@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Compare decoding of the compact models in hinkskalle_api.auto.models
+against the previous generated models (plain dataclasses, json.get twice
+per field, every timestamp parsed right away).
+
+    python -m benchmarks.models --count 50000
+
+Reports per-object decode time (best of --rounds) and the bytes allocated
+per decoded object (tracemalloc, input documents excluded), once before and
+once after the timestamps were read.
+"""
+
+import dataclasses
+import gc
+import time
+import tracemalloc
+import typing
+from datetime import datetime
+
+import click
+
+from hinkskalle_api.auto import models
+from hinkskalle_api.util.compact import _base_type, _model
+
+def sample(name: str, i: int) -> dict:
+  ts = f"2022-05-06T10:{i % 60:02d}:{i % 59:02d}.{i % 1000000:06d}+00:00"
+  if name == 'Manifest':
+    return {
+      'id': str(i), 'container': '1', 'containerName': 'container', 'collectionName': 'collection', 'entityName': 'test.hase',
+      'filename': f'file-{i}.bin', 'hash': f'sha256:{i:064x}', 'images': [ f'sha256:{i:064x}' ], 'tags': [ 'latest', f'v{i}' ],
+      'total_size': i * 1024, 'type': 'oras', 'downloadCount': i % 17,
+      'content': { 'schemaVersion': 2, 'layers': [ { 'digest': f'sha256:{i:064x}', 'size': i * 1024 } ] },
+      'createdAt': ts, 'updatedAt': ts, 'createdBy': 'test.hase',
+    }
+  elif name == 'Image':
+    return {
+      'id': str(i), 'container': '1', 'containerName': 'container', 'collectionName': 'collection', 'entityName': 'test.hase',
+      'hash': f'sha256:{i:064x}', 'size': i * 1024, 'tags': [ f'v{i}' ], 'arch': 'amd64', 'uploaded': True, 'signed': False,
+      'encrypted': False, 'type': 'oras', 'media_type': 'application/octet-stream', 'downloadCount': i % 17,
+      'createdAt': ts, 'updatedAt': ts, 'createdBy': 'test.hase',
+    }
+  raise Exception(f"no sample for {name}")
+
+def legacy_model(cls) -> typing.Tuple[type, typing.Callable[[dict], typing.Any]]:
+  """The same class as the models before: unslotted dataclass, and the
+  decoder the generator used to write out."""
+  fields = dataclasses.fields(cls)
+  legacy_cls = dataclasses.make_dataclass(f"Legacy{cls.__name__}", [ (f.name, typing.Any, dataclasses.field(default=f.default, default_factory=f.default_factory)) for f in fields ]) # type: ignore
+  lines = [ "def decode(json):", "  obj = cls()" ]
+  for f in fields:
+    t, n = _base_type(f), f.name
+    if t == 'datetime':
+      lines.append(f"  obj.{n} = datetime.fromisoformat(json['{n}']) if json.get('{n}') is not None else None")
+    elif _model(t):
+      lines.append(f"  obj.{n} = None")
+    elif f.default_factory is list:
+      lines.append(f"  obj.{n} = json['{n}'] if json.get('{n}') is not None and isinstance(json['{n}'], list) else []")
+    elif t == 'bool':
+      lines.append(f"  obj.{n} = bool(json['{n}']) if json.get('{n}') is not None else None")
+    else:
+      lines.append(f"  obj.{n} = json.get('{n}')")
+  lines.append("  return obj")
+  ns: typing.Dict[str, typing.Any] = { 'cls': legacy_cls, 'datetime': datetime }
+  exec("\n".join(lines), ns)
+  return legacy_cls, ns['decode']
+
+def timestamps(cls) -> typing.List[str]:
+  return [ f.name for f in dataclasses.fields(cls) if _base_type(f) == 'datetime' ]
+
+def measure_time(decode, docs: typing.List[dict], rounds: int) -> float:
+  best = None
+  for _ in range(rounds):
+    start = time.perf_counter()
+    for doc in docs:
+      decode(doc)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return typing.cast(float, best) / len(docs) * 1e6
+
+def measure_memory(decode, docs: typing.List[dict], touch: typing.List[str]) -> typing.Tuple[float, float]:
+  """bytes per object right after decoding and after reading touch"""
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  objs = [ decode(doc) for doc in docs ]
+  decoded = tracemalloc.get_traced_memory()[0]
+  for o in objs:
+    for name in touch:
+      getattr(o, name)
+  touched = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  # the list holding the objects is not part of the objects
+  overhead = 8 * len(objs)
+  return (decoded - before - overhead) / len(objs), (touched - before - overhead) / len(objs)
+
+
+@click.command()
+@click.option('--count', help='objects per model', default=20000, type=click.IntRange(min=1))
+@click.option('--rounds', help='best of n', default=5, type=click.IntRange(min=1))
+def main(count: int, rounds: int):
+  click.echo(f"{'':<22} {'us/object':>10} {'bytes':>8} {'bytes (dates read)':>19}")
+  for name in [ 'Manifest', 'Image' ]:
+    cls = getattr(models, name)
+    docs = [ sample(name, i) for i in range(count) ]
+    _, legacy_decode = legacy_model(cls)
+    compact_decode = getattr(models, f"plainTo{name}")
+    if compact_decode(docs[0]) != cls(**dataclasses.asdict(legacy_decode(docs[0]))):
+      raise click.ClickException(f"{name}: decoders disagree")
+    baseline = None
+    for label, decode in [ ('legacy', legacy_decode), ('compact', compact_decode) ]:
+      us = measure_time(decode, docs, rounds)
+      size, touched = measure_memory(decode, docs, timestamps(cls))
+      baseline = baseline or us
+      click.echo(f"{name + ' ' + label:<22} {us:10.2f} {size:8.0f} {touched:19.0f}  {baseline/us:5.2f}x")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Measure how long `hinkli --help` takes to start and fail if it gets slower
+than the budget.
+
+    python -m benchmarks.startup --budget 100 --cold-budget 2500
+
+Budgets are for the time on top of a bare `python -c pass`, which depends a
+lot on the machine and the installed site packages. The warm budget is the
+100 ms the startup work asked for (a clean checkout takes 40-80 ms here),
+pass a tighter one to catch smaller regressions.
+
+cold: nothing has bytecode yet (empty PYTHONPYCACHEPREFIX), so this mostly
+measures compiling everything that gets imported. warm: median of several
+runs with the bytecode cache in place. Afterwards the biggest imports
+according to `python -X importtime` are listed. It also fails if one of the
+heavy modules needed only for real work is imported.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+import click
+
+COMMAND = "from hinkskalle_api.cli import cli; cli(['--help'], prog_name='hinkli')"
+# must stay out of hinkli --help
+HEAVY = [ 'requests', 'yaml', 'hinkskalle_api.api', 'hinkskalle_api.auto.models' ]
+
+
+def run(env: typing.Optional[dict] = None, importtime=False) -> typing.Tuple[float, str]:
+  args = [ sys.executable ] + ([ '-X', 'importtime' ] if importtime else []) + [ '-c', COMMAND ]
+  start = time.perf_counter()
+  ret = subprocess.run(args, env={ **os.environ, **(env or {}) }, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+  return (time.perf_counter() - start)*1000, ret.stderr.decode('utf8')
+
+def run_bare() -> float:
+  start = time.perf_counter()
+  subprocess.run([ sys.executable, '-c', 'pass' ], check=True)
+  return (time.perf_counter() - start)*1000
+
+def import_times(stderr: str) -> typing.List[typing.Tuple[int, int, str]]:
+  """(self us, cumulative us, module) from -X importtime output"""
+  times = []
+  for line in stderr.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    self_us, cumulative, name = line[len('import time:'):].split('|')
+    times.append((int(self_us), int(cumulative), name.rstrip()))
+  return times
+
+
+@click.command()
+@click.option('--budget', help='maximum warm startup over bare python (ms)', default=100.0)
+@click.option('--cold-budget', help='maximum cold startup over bare python (ms)', default=2500.0)
+@click.option('--rounds', help='warm runs', default=10, type=click.IntRange(min=1))
+@click.option('--top', help='show this many imports', default=15)
+def main(budget: float, cold_budget: float, rounds: int, top: int):
+  with tempfile.TemporaryDirectory() as pycache:
+    cold, _ = run({ 'PYTHONPYCACHEPREFIX': pycache })
+  run()
+  warm = statistics.median(run()[0] for _ in range(rounds))
+  baseline = statistics.median(run_bare() for _ in range(rounds))
+
+  _, stderr = run(importtime=True)
+  times = import_times(stderr)
+  loaded = { name.strip() for _, _, name in times }
+
+  warm -= baseline
+  cold -= baseline
+  click.echo(f"python itself:  {baseline:6.1f} ms")
+  click.echo(f"hinkli --help:  +{warm:5.1f} ms warm (budget {budget:.0f}), +{cold:5.1f} ms cold (budget {cold_budget:.0f})")
+  click.echo(f"imports:        {sum(t[0] for t in times)/1000:6.1f} ms in {len(times)} modules, top {top}:")
+  for self_us, cumulative, name in sorted(times, key=lambda t: t[0], reverse=True)[:top]:
+    click.echo(f"  {self_us/1000:6.1f} ms {cumulative/1000:6.1f} ms cumulative {name}")
+
+  failed = []
+  heavy = [ m for m in HEAVY if m in loaded ]
+  if heavy:
+    failed.append(f"hinkli --help imports {', '.join(heavy)}")
+  if warm > budget:
+    failed.append(f"warm startup {warm:.1f} ms > {budget:.0f} ms")
+  if cold > cold_budget:
+    failed.append(f"cold startup {cold:.1f} ms > {cold_budget:.0f} ms")
+  if failed:
+    raise click.ClickException('; '.join(failed))
+
+if __name__ == '__main__':
+  main()
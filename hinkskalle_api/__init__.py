@@ -4,4 +4,19 @@ __author__ = """Heinz Axelsson-Ekker"""
 __email__ = 'heinz.ekker@vbcf.ac.at'
 __version__ = '0.3.6'
 
-from .api import HinkApi
+import typing
+
+if typing.TYPE_CHECKING:
+  from .api import HinkApi
+  from .async_api import AsyncHinkApi
+
+def __getattr__(name: str):
+  # importing the api pulls in requests, yaml and the models; hinkli --help
+  # and shell completion should not pay for that
+  if name == 'HinkApi':
+    from .api import HinkApi
+    return HinkApi
+  if name == 'AsyncHinkApi':
+    from .async_api import AsyncHinkApi
+    return AsyncHinkApi
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,5 +1,4 @@
 import requests
-import yaml
 import os
 import os.path
 import typing
@@ -8,121 +7,178 @@ import logging
 import hashlib
 import json
 import io
-import tarfile
 import tempfile
 import shutil
-import re
 from humanize import naturalsize
-from calendar import timegm
-from datetime import datetime, timedelta
 
-from .util.parse_timedelta import parse_time
+from .base import HinkApiBase
+from .util.transport import HinkSession
+from .util.hashing import hash_file
+from .util.config import load_config
+from .util.manifest_index import ManifestIndex
+from .util.blob_cache import BlobCache, parse_digest, DEFAULT_MAX_SIZE as DEFAULT_BLOB_CACHE_SIZE
+from .util.fastcopy import stage_file, DEFAULT_STAGING_THRESHOLD
+from .util.upload import ChunkedUpload, StreamingUpload, DEFAULT_CHUNK_SIZE
+from .util.download import RangedDownload, PartialState, parse_content_range, DEFAULT_SEGMENT_SIZE
+from .util.layers import DEFAULT_LAYER_SIZE
+from .util.json_stream import iter_data
+from .util.inventory import DiskUsage, Usage, DEFAULT_WORKERS as DEFAULT_DU_WORKERS
+from .util.sync import ContainerSync, SyncReport
+from .util.batch import BatchPull, PullItem, PullReport, PullResult, BatchPush, PushItem, PushReport, PushResult, DEFAULT_WORKERS
 
 logger = logging.getLogger()
 
 from .auto.models import *
 
-class HinkApi:
-  config_file = '~/.hink_api.yml'
-  def __init__(self, base=None, key=None):
-    if not base:
-      base = os.environ.get('HINK_API_BASE')
-    if not key:
-      key = os.environ.get('HINK_API_KEY')
-    self.config_file = os.environ.get('HINK_API_CFG', self.config_file)
-    try:
-      with open(os.path.expanduser(self.config_file), 'r') as yml:
-        cfg = yaml.load(yml, Loader=yaml.SafeLoader)
-    except FileNotFoundError:
-      cfg={}
-
-    if not base:
-      base=cfg.get('hink_api_base')
-    if not key:
-      key=cfg.get('hink_api_key')
-    if not base:
-      raise Exception("Please configure HINK_API_BASE!")
-
-    self.base: str = base
-    self.key: typing.Optional[str] = key
+class HinkApi(HinkApiBase):
+  def __init__(self, base=None, key=None, use_cache=True):
+    cfg = self._setup(base, key, use_cache)
     self.staging_path: typing.Optional[str] = cfg.get('hink_api_staging_path')
-    if self.base.endswith('/'):
-      self.base = self.base[:-1]
-    
-    self.user: typing.Optional[User] = None
+    self.staging_threshold = int(cfg.get('hink_api_staging_threshold', DEFAULT_STAGING_THRESHOLD))
+    self.staging_link: str = cfg.get('hink_api_staging_link', 'hardlink')
+    # 0: no paging, listings come in one response
+    self.page_size = int(cfg.get('hink_api_page_size', 0))
+    self.session = HinkSession.from_config(cfg)
+    # opt-in, usually a directory shared by everybody on a node
+    self.blob_cache: typing.Optional[BlobCache] = None
+    if cfg.get('hink_api_blob_cache'):
+      self.blob_cache = BlobCache(os.path.expanduser(cfg['hink_api_blob_cache']), max_size=int(cfg.get('hink_api_blob_cache_size', DEFAULT_BLOB_CACHE_SIZE)), link=cfg.get('hink_api_blob_cache_link', 'hardlink'))
+
+  def close(self):
+    logger.debug(f"connection pool: {self.session.stats}")
+    if self.http_cache:
+      logger.debug(f"http cache: {self.http_cache}")
+    self.session.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
 
-  def handle_error(self, r):
-    try:
-      json: dict = r.json()
-    except:
-      return r.raise_for_status()
-    if 'errors' in json and type(json['errors']) is list:
-      raise Exception(f"HINK-ERROR: {json['errors'][0]['detail']}")
-    elif 'errors' in json and type(json['errors']) is dict:
-      raise Exception(f"HINK-ERROR: {json['errors']}")
-    elif 'message' in json:
-      raise Exception(f"HINK-ERROR: {json['message']}")
-    else:
-      r.raise_for_status()
-  
-  def _make_headers(self, hdr: dict = {}) -> dict:
-    if not self.key:
-      raise Exception("Not authenticated, please login or provide a token")
-    hdr['Authorization'] = f"Bearer {self.key}"
-    return hdr
-  
   def get(self, route, **kwargs):
-    r = requests.get(self.base+route, headers=self._make_headers(), **kwargs)
+    url = self.base+route
+    cache_key, cached = self._cache_lookup(url, kwargs.get('params'))
+    if cached and self._cache_fresh(cached):
+      return self._from_cache(cache_key, cached)
+    r = self.session.get(url, headers=self._make_headers(cached.validators if cached else {}), **kwargs)
+    if r.status_code == requests.codes.not_modified and cached:
+      return self._from_cache(cache_key, cached, r.headers)
     if r.status_code != requests.codes.ok:
       self.handle_error(r)
-    return r.json().get('data', r.json())
+    body = r.json()
+    self._to_cache(cache_key, url, r.text, r.headers)
+    return self._unwrap(body)
   
   def post(self, route, data, **kwargs):
-    r = requests.post(self.base+route, headers=self._make_headers(), json=data, **kwargs)
+    r = self.session.post(self.base+route, headers=self._make_headers(), json=data, **kwargs)
+    self._changed()
     if r.status_code != requests.codes.ok:
       self.handle_error(r)
-    return r.json().get('data', r.json())
+    body = r.json()
+    return body.get('data', body)
   
   def put(self, route, data, **kwargs):
-    r = requests.put(self.base+route, headers=self._make_headers(), json=data, **kwargs)
+    r = self.session.put(self.base+route, headers=self._make_headers(), json=data, **kwargs)
+    self._changed()
     if r.status_code != requests.codes.ok:
       self.handle_error(r)
-    return r.json().get('data', r.json())
+    body = r.json()
+    return body.get('data', body)
+
+  def iter_get(self, route, **kwargs) -> typing.Iterator[typing.Any]:
+    """Like get() for listings: yields the elements of `data` while the
+    response is still arriving instead of parsing it as a whole."""
+    url = self.base+route
+    cache_key, cached = self._cache_lookup(url, kwargs.get('params'))
+    if cached and self._cache_fresh(cached):
+      yield from iter_data([ cached.body.encode('utf8') ])
+      return
+    with self.session.get(url, headers=self._make_headers(cached.validators if cached else {}), stream=True, **kwargs) as r:
+      if r.status_code == requests.codes.not_modified and cached:
+        self._revalidated(cache_key, cached, r.headers)
+        yield from iter_data([ cached.body.encode('utf8') ])
+        return
+      if r.status_code != requests.codes.ok:
+        self.handle_error(r)
+      if not self.http_cache:
+        yield from iter_data(r.iter_content(64*1024))
+        return
+      body: typing.List[bytes] = []
+      def tee():
+        for chunk in r.iter_content(64*1024):
+          body.append(chunk)
+          yield chunk
+      yield from iter_data(tee())
+      self._to_cache(cache_key, url, b''.join(body).decode('utf8'), r.headers)
+
+  def iter_pages(self, route, **kwargs) -> typing.Iterator[typing.Any]:
+    """iter_get() over all pages of a listing (`limit`/`offset`) when
+    hink_api_page_size is set. A server that ignores the parameters sends
+    everything at once, which is noticed and not asked for again."""
+    if not self.page_size:
+      yield from self.iter_get(route, **kwargs)
+      return
+    params = kwargs.pop('params', None) or {}
+    offset = 0
+    first = None
+    while True:
+      count = 0
+      for item in self.iter_get(route, params={ **params, 'limit': self.page_size, 'offset': offset }, **kwargs):
+        if count == 0 and offset > 0 and item == first:
+          # offset ignored, this is the first page again
+          return
+        if count == 0 and offset == 0:
+          first = item
+        count += 1
+        yield item
+      if count != self.page_size:
+        return
+      offset += count
 
   def get_current_user(self) -> User:
-    ret = self.get('/v1/token-status')
-    self.user = User(username=ret.get('username'), isAdmin=ret.get('isAdmin'))
-    return self.user
+    return self._remember_user(self.get('/v1/token-status'))
   
   def _get_entity(self, entity: typing.Optional[str] = None) -> str:
+    if not self.user:
+      self.user = self._cached_user()
     if not self.user:
       self.get_current_user()
-    if not entity and self.user:
-      entity = typing.cast(str, self.user.username)
-    return typing.cast(str, entity)
+    return self._default_entity(entity)
 
   def get_token(self, username: str, password: str):
-    ret = requests.post(f'{self.base}/v1/get-token', json={'username': username, 'password': password })
+    ret = self.session.post(f'{self.base}/v1/get-token', json={'username': username, 'password': password })
     if ret.status_code != requests.codes.ok:
       self.handle_error(ret)
     token = ret.json().get('data')
+    import yaml
     try:
-      with open(os.path.expanduser(self.config_file), 'r') as yml:
-        cfg = yaml.load(yml, Loader=yaml.SafeLoader)
+      cfg = load_config(os.path.expanduser(self.config_file))
     except FileNotFoundError:
       cfg={}
     cfg['hink_api_key']=token.get('token')
     cfg['hink_api_base']=self.base
     with open(os.path.expanduser(self.config_file), 'w') as cfgfh:
       yaml.dump(cfg, cfgfh)
-    self.token=plainToToken(token.get('token'))
+    if self.user_cache:
+      for key in (self.key, token.get('token')):
+        if key:
+          self.user_cache.remove(self.base, key)
+    self.user = None
+    self.token=plainToToken(token)
 
 
-  def list_collections(self, entity: typing.Optional[str]=None) -> typing.List[Collection]:
+  def get_entity(self, entity: typing.Optional[str]=None) -> Entity:
     entity = self._get_entity(entity)
+    return plainToEntity(self.get(f'/v1/entities/{entity}'))
 
-    colls = self.get(f'/v1/collections/{entity}')
-    return [ plainToCollection(c) for c in colls ]
+  def list_collections(self, entity: typing.Optional[str]=None) -> typing.List[Collection]:
+    return list(self.iter_collections(entity))
+
+  def iter_collections(self, entity: typing.Optional[str]=None) -> typing.Iterator[Collection]:
+    entity = self._get_entity(entity)
+    for c in self.iter_pages(f'/v1/collections/{entity}'):
+      yield plainToCollection(c)
   
   def get_collection(self, collection: str, entity: typing.Optional[str]=None) -> Collection:
     entity = self._get_entity(entity)
@@ -138,10 +194,12 @@ class HinkApi:
     return plainToCollection(coll)
 
   def list_containers(self, collection: str='default', entity: typing.Optional[str]=None) -> typing.List[Container]:
-    entity = self._get_entity(entity)
+    return list(self.iter_containers(collection, entity))
 
-    containers = self.get(f'/v1/containers/{entity}/{collection}')
-    return [ plainToContainer(c) for c in containers ]
+  def iter_containers(self, collection: str='default', entity: typing.Optional[str]=None) -> typing.Iterator[Container]:
+    entity = self._get_entity(entity)
+    for c in self.iter_pages(f'/v1/containers/{entity}/{collection}'):
+      yield plainToContainer(c)
   
   def get_container(self, container: str, collection: str='default', entity: typing.Optional[str]=None) -> Container:
     entity = self._get_entity(entity)
@@ -158,6 +216,21 @@ class HinkApi:
     return plainToContainer(cont)
 
 
+  def list_images(self, container: str, collection: str='default', entity: typing.Optional[str]=None) -> typing.List[Image]:
+    return list(self.iter_images(container, collection, entity))
+
+  def iter_images(self, container: str, collection: str='default', entity: typing.Optional[str]=None) -> typing.Iterator[Image]:
+    entity = self._get_entity(entity)
+    for i in self.iter_pages(f'/v1/containers/{entity}/{collection}/{container}/images'):
+      yield plainToImage(i)
+
+  def disk_usage(self, entity: typing.Optional[str]=None, workers: int = DEFAULT_DU_WORKERS, manifests=False) -> typing.Iterator[Usage]:
+    """Usage of all collections and containers of entity (and each
+    manifest, if asked), listed with `workers` requests in flight. Yields
+    containers as they are done, each collection after its containers and
+    the entity total last."""
+    return iter(DiskUsage(self, entity, workers=workers, manifests=manifests))
+
   def list_tags(self, container: str, collection: str='default', entity: typing.Optional[str]=None) -> typing.List[Tag]:
     entity = self._get_entity(entity)
 
@@ -170,217 +243,471 @@ class HinkApi:
     return ret
 
   def list_manifests(self, container: str, collection: str='default', entity: typing.Optional[str]=None) -> typing.List[Manifest]:
-    entity = self._get_entity(entity)
+    return list(self.iter_manifests(container, collection, entity))
 
-    manifests = self.get(f'/v1/containers/{entity}/{collection}/{container}/manifests')
-    ret: typing.List[Manifest] = []
-    for m in manifests:
-      mani = plainToManifest(m)
-      mani.image_hash = m.get('images', [None])
-      ret.append(mani)
-    return ret
+  def iter_manifests(self, container: str, collection: str='default', entity: typing.Optional[str]=None) -> typing.Iterator[Manifest]:
+    entity = self._get_entity(entity)
+    for m in self.iter_pages(f'/v1/containers/{entity}/{collection}/{container}/manifests'):
+      yield self._manifest(m)
     
+  def manifest_index(self, container: str, collection: str='default', entity: typing.Optional[str]=None, refresh=False) -> ManifestIndex:
+    """Tag/hash index of the manifests in container, built once per session."""
+    entity = self._get_entity(entity)
+    key = (entity, collection, container)
+    if refresh or key not in self._manifest_indexes:
+      self._manifest_indexes[key] = ManifestIndex(self.list_manifests(container, collection, entity))
+    return self._manifest_indexes[key]
+
+  def _get_tagged_manifest(self, container: str, collection: str, entity: str, tag: str) -> typing.Tuple[typing.Optional[Manifest], bool]:
+    try:
+      r = self.session.get(f'{self.base}/v1/manifests/{entity}/{collection}/{container}:{tag}', headers=self._make_headers())
+    except requests.exceptions.RequestException as err:
+      logger.debug(f"direct tag lookup failed: {err}")
+      return None, False
+    return self._tagged_response(r, tag)
+
   def get_manifest(self, container: str, collection: str='default', entity: typing.Optional[str]=None, tag: typing.Optional[str]=None, hash: typing.Optional[str]=None) -> Manifest:
     entity = self._get_entity(entity)
-    manifests = self.list_manifests(container, collection, entity)
-    to_fetch: typing.Optional[Manifest] = None
-    if not tag and not hash:
-      raise Exception(f"Need either hash or tag")
-    for m in manifests:
-      if tag and tag in m.tags:
-        to_fetch = m
-        break
-      elif hash and m.hash == hash:
-        to_fetch = m
-        break
-    if not to_fetch:
-      raise Exception(f"Manifest {entity}/{collection}/{container}:{tag}/{hash} not found")
-    return to_fetch
-
-  def fetch_blob(self, container: str, collection: str='default', entity: typing.Optional[str]=None, tag: typing.Optional[str]=None, hash: typing.Optional[str]=None, out: typing.Optional[str] = None, progress=False) -> str:
+    key = (entity, collection, container)
+    to_fetch, probe = self._indexed_manifest(key, tag=tag, hash=hash)
+    if to_fetch:
+      return to_fetch
+    route_missing = False
+    if probe:
+      to_fetch, route_missing = self._get_tagged_manifest(container, collection, entity, typing.cast(str, tag))
+      if to_fetch:
+        self._set_direct_tag_lookup(True)
+        return to_fetch
+    return self._listed_manifest(self.manifest_index(container, collection, entity, refresh=True), key, tag=tag, hash=hash, route_missing=route_missing)
+
+  def fetch_blob(self, container: str, collection: str='default', entity: typing.Optional[str]=None, tag: typing.Optional[str]=None, hash: typing.Optional[str]=None, out: typing.Optional[str] = None, progress=False, connections: int = 1, segment_size: int = DEFAULT_SEGMENT_SIZE, resume=False, unpack=False) -> str:
+    """Download a blob, returns the file name.
+
+    With unpack, a directory archive is extracted while it downloads and the
+    directory it went to is returned (see fetch_layers). Downloads with
+    several layers are always unpacked.
+    """
     to_fetch = self.get_manifest(container=container, collection=collection, entity=entity, tag=tag, hash=hash)
+    layers = (to_fetch.content or {}).get('layers') or []
+    if len(layers) > 1:
+      return self.fetch_layers(to_fetch, container=container, collection=collection, entity=entity, out=out, progress=progress)
+    if unpack:
+      from .util.layers import is_archive
+      if layers and is_archive(layers[0]):
+        return self.fetch_layers(to_fetch, container=container, collection=collection, entity=entity, out=out, progress=progress)
+      logger.warning(f"{to_fetch.filename} is not a directory archive, not unpacking")
+    outfn = self._out_filename(to_fetch, out)
+
+    url = self._download_url(to_fetch)
+    digest = parse_digest(to_fetch.images[0]) if to_fetch.images else None
+    if not self.blob_cache or not digest:
+      self._download(url, outfn, progress=progress, connections=connections, segment_size=segment_size, resume=resume)
+      return outfn
+
+    # one download per digest, whoever comes later waits and links
+    with self.blob_cache.lock(digest):
+      if self.blob_cache.lookup(digest):
+        logger.info(f"{digest} found in blob cache")
+      else:
+        tmp = self.blob_cache.tmp_path(digest)
+        got = self._download(url, tmp, progress=progress, connections=connections, segment_size=segment_size, resume=resume)
+        if f"sha256:{got}" != digest:
+          os.unlink(tmp)
+          raise Exception(f"Checksum mismatch: {got} != {digest}")
+        self.blob_cache.store(tmp, digest)
+      self.blob_cache.materialize(digest, outfn)
+    return outfn
 
-    ret = requests.get(f'{self.base}/v1/manifests/{to_fetch.id}/download', headers=self._make_headers(), stream=True)
-    if ret.status_code != requests.codes.ok:
+  def _download(self, url: str, outfn: str, progress=False, connections: int = 1, segment_size: int = DEFAULT_SEGMENT_SIZE, resume=False) -> str:
+    """Fetch url to outfn, checking it against the digest the server sends.
+    Returns the hex digest."""
+    target = f"{outfn}.partial" if resume else outfn
+    if connections > 1 or resume:
+      # probe for range support, if the server ignores the range we get the
+      # whole blob and fall back to a single stream.
+      self.session.ensure_pool_size(connections)
+      ret = self.session.get(url, headers=self._make_headers({ 'Range': 'bytes=0-0' }), stream=True)
+    else:
+      ret = self.session.get(url, headers=self._make_headers(), stream=True)
+    if ret.status_code not in (requests.codes.ok, requests.codes.partial_content):
       self.handle_error(ret)
-    
-    if not to_fetch.filename:
-      raise Exception('blob filename unset')
-    outfn = to_fetch.filename
-    if out and os.path.isdir(out):
-      outfn = os.path.join(out, outfn)
-    elif out:
-      outfn = out
-    logger.debug(f"will fetch {naturalsize(int(ret.headers.get('Content-Length', -1)))} to {outfn}")
+    expected_digest = ret.headers.get('Docker-Content-Digest')
+
+    if ret.status_code == requests.codes.partial_content:
+      _, _, size = parse_content_range(ret.headers.get('Content-Range'))
+      ret.close()
+    else:
+      size = int(ret.headers.get('Content-Length', -1))
+    logger.debug(f"will fetch {naturalsize(size)} to {outfn}")
+
+    state: typing.Optional[PartialState] = None
+    if resume and ret.status_code == requests.codes.partial_content:
+      state = PartialState.load(f"{target}.json")
+      if state and (state.digest != expected_digest or state.size != size or not os.path.exists(target)):
+        logger.warning(f"discarding stale partial download {target}")
+        state = None
+      if not state and os.path.exists(target):
+        os.unlink(target)
+      if not state:
+        state = PartialState(f"{target}.json", digest=typing.cast(str, expected_digest), size=size, segment_size=segment_size)
+    elif resume:
+      logger.warning(f"server does not support range requests, cannot resume")
     
     if progress:
-      prog = click.progressbar(length=int(ret.headers.get('Content-Length', -1)), label='🥤 Slurping:')
+      prog = click.progressbar(length=size, label='🥤 Slurping:')
     else:
       prog = None
-    
-    hl = hashlib.sha256()
-    with open(os.path.basename(outfn), 'wb') as outfh:
-      for chunk in ret.iter_content(chunk_size=65535): 
-        outfh.write(chunk)
-        if prog:
-          prog.update(len(chunk))
-        hl.update(chunk)
+
+    if ret.status_code == requests.codes.partial_content:
+      logger.debug(f"using {connections} connections, {naturalsize(segment_size)} segments")
+      download = RangedDownload(self.session, url, headers=self._make_headers(), outfn=target, size=size, connections=connections, segment_size=segment_size, progress=prog.update if prog else None, state=state, block_size=self.hash_block_size)
+      digest = download.run()
+    else:
+      hl = hashlib.sha256()
+      with open(target, 'wb') as outfh:
+        for chunk in ret.iter_content(chunk_size=self.hash_block_size):
+          outfh.write(chunk)
+          if prog:
+            prog.update(len(chunk))
+          hl.update(chunk)
+      digest = hl.hexdigest()
     if progress:
       print()
 
-    if f"sha256:{hl.hexdigest()}" != ret.headers.get('Docker-Content-Digest'):
-      raise Exception(f"Checksum mismatch: {hl.hexdigest()} != {ret.headers.get('Docker-Content-Digest')}")
+    if f"sha256:{digest}" != expected_digest:
+      if resume:
+        os.unlink(target)
+        if state:
+          state.remove()
+      raise Exception(f"Checksum mismatch: {digest} != {expected_digest}")
     else:
       logger.info("Checksum ok.")
+    if resume:
+      os.replace(target, outfn)
+      if state:
+        state.remove()
+
+    return digest
+
+  def fetch_layers(self, manifest: Manifest, container: str, collection: str='default', entity: typing.Optional[str]=None, out: typing.Optional[str] = None, progress=False) -> str:
+    """Download all layers of a manifest into directory out (default: the
+    current directory).
+
+    Directory archives are unpacked while they stream in, so a layered push
+    comes back as one tree and no archive lands on disk. Other layers are
+    saved under their title. Everything goes into a staging directory first
+    and is moved into out only when all checksums match.
+    """
+    from .util.codecs import codec_for_media_type
+    from .util.layers import extract_tar, is_archive, HashingReader, StagingDir
+    entity = self._get_entity(entity)
+    layers: typing.List[dict] = (manifest.content or {}).get('layers') or []
+    outdir = out or '.'
+    prog = click.progressbar(length=sum(l.get('size', 0) for l in layers), label='🥤 Slurping:') if progress else None
+    with StagingDir(outdir) as staging:
+      for layer in layers:
+        digest = layer['digest']
+        title = (layer.get('annotations') or {}).get('org.opencontainers.image.title') or digest.replace(':', '_')
+        # closed on errors too, a half read body would hold on to its connection
+        with self.session.get(f"{self.base}/v2/{entity}/{collection}/{container}/blobs/{digest}", headers=self._make_headers(), stream=True) as ret:
+          if ret.status_code != requests.codes.ok:
+            self.handle_error(ret)
+          reader = HashingReader(ret.iter_content(chunk_size=self.hash_block_size), progress=prog.update if prog else None)
+          if is_archive(layer):
+            logger.debug(f"unpacking {title}")
+            extract_tar(codec_for_media_type(layer.get('mediaType')).reader(reader), staging.path)
+            reader.drain()
+          else:
+            with open(os.path.join(staging.path, os.path.basename(title)), 'wb') as fh:
+              shutil.copyfileobj(reader, fh, self.hash_block_size)
+        if reader.digest != digest:
+          raise Exception(f"Checksum mismatch in {title}: {reader.digest} != {digest}")
+      if progress:
+        click.echo("")
+      logger.info(f"Checksums of {len(layers)} layer(s) ok.")
+      staging.commit()
+    return outdir
+
+  def pull_many(self, items: typing.Iterable[typing.Union[str, PullItem]], out: typing.Optional[str] = None, workers: int = DEFAULT_WORKERS, connections: int = 1, segment_size: int = DEFAULT_SEGMENT_SIZE, on_result: typing.Optional[typing.Callable[[PullResult], typing.Any]] = None) -> PullReport:
+    """Download many blobs at once.
+
+    Items are library paths (`entity/collection/container:tag`, tag defaults
+    to latest) or PullItems. Manifests are listed once per container, then
+    `workers` downloads run in parallel. Failures are reported per item in
+    the returned PullReport, they do not raise.
+
+    :param out: directory to save to
+    :param on_result: called with each PullResult when it is done
+    """
+    pull_items = [ PullItem.parse(i) if isinstance(i, str) else i for i in items ]
+    return BatchPull(self, pull_items, out=out, workers=workers, connections=connections, segment_size=segment_size, on_result=on_result).run()
+
+  def sync(self, container: str, out: str, collection: str='default', entity: typing.Optional[str]=None, workers: int = DEFAULT_WORKERS, prune=False, on_file: typing.Optional[typing.Callable[[str, str], typing.Any]] = None) -> SyncReport:
+    """Mirror all tags of container into directory out, one subdirectory
+    per tag. Only blobs that are not in the mirror yet are downloaded, tags
+    sharing a blob get hardlinks (see ContainerSync).
+
+    :param prune: remove tags that are gone from the server
+    :param on_file: called with (action, path) for every file touched
+    """
+    entity = self._get_entity(entity)
+    return ContainerSync(self, container, collection, entity, out, workers=workers, prune=prune, on_file=on_file).run()
 
-    return outfn
-    
-  def push_file(self, tag: str, container: str, filename: str, collection: str = 'default', entity: typing.Optional[str] = None, progress=False, excludes: typing.List[typing.Union[typing.Pattern, str]]=[], private=False, valid_for=None) -> str:
+  def push_many(self, items: typing.Iterable[typing.Union[typing.Tuple[str, str], PushItem]], workers: int = DEFAULT_WORKERS, hash_workers: typing.Optional[int] = None, on_result: typing.Optional[typing.Callable[[PushResult], typing.Any]] = None, private=False, valid_for=None, chunk_size: typing.Optional[int] = None, excludes: typing.List[typing.Union[typing.Pattern, str]]=[], gitignore=False, codec: str = 'gzip', compress_level: typing.Optional[int] = None, threads: typing.Optional[int] = None, reproducible=True) -> PushReport:
+    """Push many files or directories at once.
+
+    Items are (path, `container:tag`) pairs or PushItems. Everything is
+    checksummed in parallel first, then only blobs missing on the server
+    are uploaded (`workers` at a time) and the manifests pushed at the end.
+    Failures are reported per item in the returned PushReport.
+
+    :param on_result: called with each PushResult when it is done
+    """
+    push_items = [ i if isinstance(i, PushItem) else PushItem.parse(*i) for i in items ]
+    return BatchPush(self, push_items, workers=workers, hash_workers=hash_workers, on_result=on_result, private=private, valid_for=valid_for, chunk_size=chunk_size, excludes=excludes, gitignore=gitignore, codec=codec, compress_level=compress_level, threads=threads, reproducible=reproducible).run()
+
+  def push_file(self, tag: str, container: str, filename: str, collection: str = 'default', entity: typing.Optional[str] = None, progress=False, excludes: typing.List[typing.Union[typing.Pattern, str]]=[], private=False, valid_for=None, chunk_size: typing.Optional[int] = None, connections: int = 1, stream=False, codec: str = 'gzip', compress_level: typing.Optional[int] = None, threads: typing.Optional[int] = None, reproducible=True, gitignore=False, layers: typing.Optional[str] = None, layer_size: int = DEFAULT_LAYER_SIZE) -> str:
+    from .util.codecs import get_codec
     entity = self._get_entity(entity)
+    layer_codec = get_codec(codec)
     is_tar = False
     orig_filename = filename
+    tmp_tar = None
     if os.path.isdir(filename):
       if orig_filename.endswith('/'):
         orig_filename = orig_filename[:-1]
       is_tar = True
-      filename = self._create_tar(filename, progress=progress, excludes=excludes)
 
     logging.info(f"⏳ Uploading file to {entity}/{collection}/{container}:{tag}...")
-    with open(filename, 'rb') as infh:
-      image_hash, image_size = self.push_blob(data=infh, entity=entity, collection=collection, container=container, progress=progress, private=private, valid_for=valid_for)
+    if is_tar and layers:
+      if stream:
+        raise Exception("layered pushes cannot be streamed")
+      return self.push_layers(directory=filename, tag=tag, entity=entity, collection=collection, container=container, progress=progress, excludes=excludes, private=private, valid_for=valid_for, chunk_size=chunk_size, connections=connections, codec=codec, compress_level=compress_level, threads=threads, reproducible=reproducible, gitignore=gitignore, mode=layers, layer_size=layer_size)
+    if is_tar and stream:
+      image_hash, image_size = self.push_tar_stream(directory=filename, entity=entity, collection=collection, container=container, progress=progress, excludes=excludes, private=private, valid_for=valid_for, chunk_size=chunk_size, codec=codec, compress_level=compress_level, threads=threads, reproducible=reproducible, gitignore=gitignore)
+    else:
+      if is_tar:
+        filename = tmp_tar = self._create_tar(filename, progress=progress, excludes=excludes, codec=codec, compress_level=compress_level, threads=threads, reproducible=reproducible, gitignore=gitignore)
+      with open(filename, 'rb') as infh:
+        image_hash, image_size = self.push_blob(data=infh, entity=entity, collection=collection, container=container, progress=progress, private=private, valid_for=valid_for, chunk_size=chunk_size, connections=connections)
 
     logging.info("⏳ Uploading image config...")
     cfg=b'{}'
     with io.BytesIO(cfg) as cfgfh:
       cfg_hash, cfg_size = self.push_blob(data=cfgfh, entity=entity, collection=collection, container=container, progress=progress, private=private)
     
-    manifest = {
+    manifest = self._file_manifest(cfg_hash, cfg_size, image_hash, image_size, orig_filename, layer_codec if is_tar else None)
+    logging.info("⏳ Pushing manifest...")
+    self.push_manifest(manifest=manifest, tag=tag, entity=entity, container=container, collection=collection)
+    if tmp_tar:
+      os.unlink(tmp_tar)
+    return image_hash
+
+  @staticmethod
+  def _oras_manifest(cfg_hash: str, cfg_size: int, layers: typing.List[dict]) -> dict:
+    return {
       'schemaVersion': 2,
       "config": {
         'mediaType': 'application/vnd.unknown.config.v1+json',
         'digest': f'sha256:{cfg_hash}',
         'size': cfg_size,
       },
-      "layers": [{
-        "mediaType": "application/vnd.oci.image.layer.v1.tar+gzip" if is_tar else "application/vnd.oci.image.layer.v1.tar",
-        "digest": f"sha256:{image_hash}",
-        "size": image_size,
-        "annotations":{
-          "io.deis.oras.content.unpack": "true" if is_tar else "false",
-          "org.opencontainers.image.title": orig_filename,
-        }
-      }]
+      "layers": layers,
     }
-    logging.info("⏳ Pushing manifest...")
-    self.push_manifest(manifest=manifest, tag=tag, entity=entity, container=container, collection=collection)
-    if is_tar:
-      os.unlink(filename)
-    return image_hash
+
+  @staticmethod
+  def _layer(image_hash: str, image_size: int, filename: str, codec=None) -> dict:
+    """layer descriptor, codec is set for packed directories."""
+    return {
+      "mediaType": codec.media_type if codec else "application/vnd.oci.image.layer.v1.tar",
+      "digest": f"sha256:{image_hash}",
+      "size": image_size,
+      "annotations":{
+        "io.deis.oras.content.unpack": "true" if codec and codec.unpack else "false",
+        "org.opencontainers.image.title": filename,
+      }
+    }
+
+  @classmethod
+  def _file_manifest(cls, cfg_hash: str, cfg_size: int, image_hash: str, image_size: int, filename: str, codec=None) -> dict:
+    """oras manifest for a single file, codec is set for packed directories."""
+    return cls._oras_manifest(cfg_hash, cfg_size, [ cls._layer(image_hash, image_size, filename, codec) ])
+
+  def push_layers(self, directory: str, tag: str, container: str, collection: str = 'default', entity: typing.Optional[str] = None, progress=False, excludes: typing.List[typing.Union[typing.Pattern, str]]=[], private=False, valid_for=None, chunk_size: typing.Optional[int] = None, connections: int = 1, codec: str = 'gzip', compress_level: typing.Optional[int] = None, threads: typing.Optional[int] = None, reproducible=True, gitignore=False, mode: str = 'subdirs', layer_size: int = DEFAULT_LAYER_SIZE) -> str:
+    """Push a directory as several tar layers (see util.layers.split_layers).
+
+    Each layer goes through push_blob, so layers the server already has
+    are not uploaded again. Returns the manifest hash.
+    """
+    from .util.codecs import get_codec
+    from .util.scan import ExcludeMatcher, scan_tree
+    from .util.layers import split_layers
+    entity = self._get_entity(entity)
+    layer_codec = get_codec(codec)
+    if layer_codec.name == 'none':
+      raise Exception("layered pushes need compression (gzip or zstd)")
+    directory = directory.rstrip('/') or directory
+    scan = scan_tree(directory, ExcludeMatcher(excludes, gitignore=gitignore))
+    logger.info(f"📂 Scanned {scan}")
+    parts = split_layers(directory, scan.entries, mode=mode, layer_size=layer_size)
+    if not parts:
+      raise Exception(f"{directory}: nothing to push")
+
+    descriptors = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+      for num, part in enumerate(parts, 1):
+        logger.info(f"📦 Layer {num}/{len(parts)}: {part.name} ({naturalsize(part.size)})")
+        tmptar = os.path.join(tmpdir, f"layer{num}.tar")
+        with open(tmptar, 'wb') as tmp:
+          self._write_tar(tmp, directory, codec=codec, compress_level=compress_level, threads=threads, reproducible=reproducible, entries=part.entries)
+        with open(tmptar, 'rb') as infh:
+          layer_hash, layer_bytes = self.push_blob(data=infh, entity=entity, collection=collection, container=container, progress=progress, private=private, valid_for=valid_for, chunk_size=chunk_size, connections=connections)
+        os.unlink(tmptar)
+        descriptors.append(self._layer(layer_hash, layer_bytes, part.name, layer_codec))
+    finally:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+    with io.BytesIO(b'{}') as cfgfh:
+      cfg_hash, cfg_size = self.push_blob(data=cfgfh, entity=entity, collection=collection, container=container, private=private)
+    logging.info(f"⏳ Pushing manifest with {len(descriptors)} layers...")
+    return self.push_manifest(manifest=self._oras_manifest(cfg_hash, cfg_size, descriptors), tag=tag, entity=entity, container=container, collection=collection)
+
+  def push_tar_stream(self, directory: str, container: str, collection: str = 'default', entity: typing.Optional[str] = None, progress=False, excludes: typing.List[typing.Union[typing.Pattern, str]]=[], private=False, valid_for=None, chunk_size: typing.Optional[int] = None, codec: str = 'gzip', compress_level: typing.Optional[int] = None, threads: typing.Optional[int] = None, reproducible=True, gitignore=False) -> typing.Tuple[str, int]:
+    """Pack directory and upload it in one pass, without a temporary tar file.
+
+    The digest is only known at the end, so there is no check whether the
+    blob is already on the server.
+    """
+    params = self._upload_params(None, private=private, valid_for=valid_for)
+    upload = StreamingUpload(self.session, self._upload_url(typing.cast(str, entity), collection, container), headers=self._make_headers(), params=params, chunk_size=chunk_size or DEFAULT_CHUNK_SIZE)
+    try:
+      self._write_tar(typing.cast(typing.BinaryIO, upload), directory, progress=progress, excludes=excludes, codec=codec, compress_level=compress_level, threads=threads, reproducible=reproducible, gitignore=gitignore)
+      upload.close()
+    except:
+      upload.abort()
+      raise
+    return upload.digest, upload.size
 
 
   def push_manifest(self, manifest: dict, tag: str, container: str, collection: str = 'default', entity: typing.Optional[str] = None) -> str:
-    json_manifest = json.dumps(manifest).encode('utf8')
-    hl = hashlib.sha256()
-    hl.update(json_manifest)
-    manifest_hash = hl.hexdigest()
+    json_manifest, manifest_hash = self._manifest_body(manifest)
 
-    ret = requests.put(f"{self.base}/v2/{entity}/{collection}/{container}/manifests/{tag}", data=json_manifest, headers=self._make_headers())
+    ret = self.session.put(f"{self.base}/v2/{entity}/{collection}/{container}/manifests/{tag}", data=json_manifest, headers=self._make_headers())
+    self._manifest_written((typing.cast(str, entity), collection, container))
     if ret.status_code != requests.codes.ok:
       self.handle_error(ret)
-    upload_hash = ret.headers.get('Docker-Content-Digest')
-    if f"sha256:{manifest_hash}" != upload_hash:
-      raise Exception(f"Manifest checksum mismatch: {manifest_hash} != {upload_hash}")
+    self._check_manifest_digest(manifest_hash, ret.headers.get('Docker-Content-Digest'))
     return manifest_hash
 
-  def _create_tar(self, directory: str, progress=False, excludes: typing.List[typing.Union[typing.Pattern, str]]=[]) -> str:
+  def _create_tar(self, directory: str, progress=False, excludes: typing.List[typing.Union[typing.Pattern, str]]=[], codec: str = 'gzip', compress_level: typing.Optional[int] = None, threads: typing.Optional[int] = None, reproducible=True, gitignore=False) -> str:
     tmpdir = tempfile.mkdtemp()
     tmptar = os.path.join(tmpdir, f"{directory.replace('/', '_')}.tar")
-    tmp = open(tmptar, 'wb')
-    tar = tarfile.open(fileobj=tmp, mode='w:gz')
-    totar = []
-    total_size = 0
-    def is_match(fullpath: str) -> bool:
-      skip = False
-      for pat in excludes:
-        if re.search(pat, fullpath):
-          logger.debug(f"excluding {fullpath}, match with {pat}")
-          print(f"excluding {fullpath}, match with {pat}")
-          skip=True
-          break
-      return skip
-
-    for root, dirs, files in os.walk(directory, topdown=True):
-      dirs[:] = [ d for d in dirs if not is_match(os.path.join(root, d)) ]
-      for f in files:
-        fullpath = os.path.join(root, f)
-        if is_match(fullpath):
-          continue
-
-        total_size+=os.path.getsize(fullpath)
-        totar.append(fullpath)
+    with open(tmptar, 'wb') as tmp:
+      self._write_tar(tmp, directory, progress=progress, excludes=excludes, codec=codec, compress_level=compress_level, threads=threads, reproducible=reproducible, gitignore=gitignore)
+    return tmptar
+
+  def _write_tar(self, fileobj: typing.BinaryIO, directory: str, progress=False, excludes: typing.List[typing.Union[typing.Pattern, str]]=[], codec: str = 'gzip', compress_level: typing.Optional[int] = None, threads: typing.Optional[int] = None, reproducible=True, gitignore=False, entries: typing.Optional[typing.List[typing.Tuple[str, os.stat_result]]] = None):
+    # only needed for directory pushes
+    import tarfile
+    from .util.codecs import get_codec
+    from .util.tar import TarInfoFactory, reproducible_tarinfo
+    from .util.scan import ExcludeMatcher, scan_tree
+    compressor = get_codec(codec).writer(fileobj, level=compress_level, threads=threads, mtime=0 if reproducible else None)
+    tar = tarfile.open(fileobj=compressor, mode='w|', format=tarfile.PAX_FORMAT)
+    normalize = reproducible_tarinfo() if reproducible else None
+    factory = TarInfoFactory(tar, names=not reproducible)
+
+    if entries is None:
+      scan = scan_tree(directory, ExcludeMatcher(excludes, gitignore=gitignore))
+      logger.info(f"📂 Scanned {scan}")
+      entries, total_size = scan.entries, scan.total_size
+    else:
+      total_size = sum(st.st_size for _, st in entries)
     if progress:
       prog = click.progressbar(length=total_size, label='📦 Tarring:')
       prog.update(1)
     else:
       prog = None
-    for f in sorted(totar):
-      tar.add(f, recursive=False)
+    for path, st in sorted(entries, key=lambda e: e[0]):
+      info = factory.create(path, st)
+      if not info:
+        continue
+      if normalize:
+        info = normalize(info)
+      if info.isreg():
+        with open(path, 'rb') as fh:
+          tar.addfile(info, fh)
+      else:
+        tar.addfile(info)
       if prog:
-        prog.update(os.path.getsize(f))
+        prog.update(info.size)
     if progress:
       click.echo("")
     tar.close()
-    tmp.close()
-    return tmptar
+    compressor.close()
 
-  def push_blob(self, container: str, data: typing.BinaryIO, collection: str = 'default', entity: typing.Optional[str] = None, progress=False, private=False, valid_for=None) -> typing.Tuple[str, int]:
-    hl = hashlib.sha256()
+  def checksum(self, data: typing.BinaryIO, progress=False) -> typing.Tuple[str, int]:
+    """sha256 and size of data, from the digest cache if possible. Rewinds data."""
+    cache_key, cached = self._cached_checksum(data)
+    if cached:
+      return cached
     if progress:
       prog = click.progressbar(length=os.path.getsize(data.name) if hasattr(data, 'name') else 0,label='👀 Checksumming:')
     else:
       prog = None
-    size = 0
-    while True:
-      chunk = data.read(65535)
-      if len(chunk)==0:
-        break
-      size += len(chunk)
-      hl.update(chunk)
-      if prog:
-        prog.update(len(chunk))
+    image_hash, size = hash_file(data, block_size=self.hash_block_size, progress=prog.update if prog else None, use_mmap=self.hash_mmap)
     data.seek(0)
     if progress:
       click.echo("")
-    
-    image_hash = hl.hexdigest()
 
-    params = {
-      'digest': f'sha256:{image_hash}', 
-      'private': private, 
-    }
-    if valid_for:
-      expiration = datetime.today() + parse_time(valid_for)
-      params['expiresAt'] = expiration.isoformat()
-
-    check = requests.head(f"{self.base}/v2/{entity}/{collection}/{container}/blobs/sha256:{image_hash}", headers=self._make_headers())
-    if check.status_code == requests.codes.ok:
-      if not check.headers.get('Docker-Content-Digest'):
-        raise Exception("something went wrong - no content digest header!")
+    self._store_checksum(cache_key, image_hash, data)
+    return image_hash, size
+
+  def blob_exists(self, image_hash: str, container: str, collection: str = 'default', entity: typing.Optional[str] = None) -> bool:
+    check = self.session.head(self._blob_url(typing.cast(str, entity), collection, container, image_hash), headers=self._make_headers())
+    return self._blob_found(check)
+
+  def push_blob(self, container: str, data: typing.BinaryIO, collection: str = 'default', entity: typing.Optional[str] = None, progress=False, private=False, valid_for=None, chunk_size: typing.Optional[int] = None, connections: int = 1) -> typing.Tuple[str, int]:
+    image_hash, size = self.checksum(data, progress=progress)
+    if self.blob_exists(image_hash, container=container, collection=collection, entity=entity):
       logger.info(f"😎 File already on server, skipping upload.")
       return image_hash, size
-    
-    if size > 100*1024*1024 and self.staging_path:
+    self.upload_blob(data, image_hash, size, container=container, collection=collection, entity=entity, progress=progress, private=private, valid_for=valid_for, chunk_size=chunk_size, connections=connections)
+    return image_hash, size
+
+  def upload_blob(self, data: typing.BinaryIO, image_hash: str, size: int, container: str, collection: str = 'default', entity: typing.Optional[str] = None, progress=False, private=False, valid_for=None, chunk_size: typing.Optional[int] = None, connections: int = 1):
+    """Upload data with a known checksum, without asking whether the server has it."""
+    params = self._upload_params(image_hash, private=private, valid_for=valid_for)
+
+    if size > self.staging_threshold and self.staging_path:
       logger.info(f"📥 switching to staged upload")
       staged_fn = os.path.join(self.staging_path, f"sha256.{image_hash}")
       os.makedirs(self.staging_path, exist_ok=True)
-      with open(staged_fn, 'wb') as staged_fh:
-        shutil.copyfileobj(data, staged_fh)
+      prog = click.progressbar(length=size, label='📥 Staging:') if progress else None
+      mode, staged_hash = stage_file(data, staged_fn, size, link=self.staging_link, block_size=self.hash_block_size, progress=prog.update if prog else None)
+      if prog:
+        click.echo("")
+      if staged_hash and staged_hash != image_hash:
+        os.unlink(staged_fn)
+        raise Exception(f"Checksum mismatch while staging: sha256:{staged_hash} != sha256:{image_hash}. Did the file change?")
+      logger.debug(f"staged {naturalsize(size)} by {mode}")
       params['staged']=1
-      ret = requests.post(f"{self.base}/v2/{entity}/{collection}/{container}/blobs/uploads/", params=params, headers=self._make_headers({ 'Content-Type': 'application/octet-stream' }))
+      ret = self.session.post(self._upload_url(typing.cast(str, entity), collection, container), params=params, headers=self._make_headers({ 'Content-Type': 'application/octet-stream' }))
       if ret.status_code != requests.codes.ok:
         self.handle_error(ret)
-      return image_hash, size
-
+      return
+
+    if chunk_size:
+      logger.debug(f"chunked upload, {naturalsize(chunk_size)} chunks, {connections} connections")
+      self.session.ensure_pool_size(connections)
+      prog = click.progressbar(length=size, label='🚀 Pushing:') if progress else None
+      upload_params = { k: v for k, v in params.items() if k != 'digest' }
+      upload = ChunkedUpload(self.session, self._upload_url(typing.cast(str, entity), collection, container), headers=self._make_headers(), data=data, size=size, digest=image_hash, params=upload_params, chunk_size=chunk_size, connections=connections, progress=prog.update if prog else None)
+      upload.run()
+      if progress:
+        click.echo("")
+      return
 
     class MonitoredFile(io.BytesIO):
       def __init__(self, hdl: typing.BinaryIO, length: int):
@@ -399,12 +726,11 @@ class HinkApi:
       def __len__(self):
         return self.length
 
-    ret = requests.post(f"{self.base}/v2/{entity}/{collection}/{container}/blobs/uploads/", params=params, data=MonitoredFile(data, size), headers=self._make_headers({ 'Content-Type': 'application/octet-stream' }))
+    ret = self.session.post(self._upload_url(typing.cast(str, entity), collection, container), params=params, data=MonitoredFile(data, size), headers=self._make_headers({ 'Content-Type': 'application/octet-stream' }))
     if ret.status_code != requests.codes.ok:
       self.handle_error(ret)
     if progress:
       click.echo("")
-    return image_hash, size
 
   def get_download_token(self, manifest: typing.Optional[Manifest]=None, tag: typing.Optional[str] = None, container: typing.Optional[str] = None, collection: str = 'default', entity: typing.Optional[str] = None, expiration=None, username=None) -> str:
     if not manifest:
@@ -416,28 +742,6 @@ class HinkApi:
     else:
       to_fetch = manifest
 
-    post_data = {
-      'type': 'manifest',
-      'id': to_fetch.id,
-    }
-    if not self.user:
-      raise Exception("user not defined")
-    if self.user.isAdmin:
-      if not username:
-        if entity == 'default':
-          username = self.user.username
-        else:
-          username = entity
-
-      if not expiration:
-        expiration = 14
-      try:
-        expiration = timegm((datetime.utcnow() + timedelta(days=int(expiration))).utctimetuple())
-      except ValueError:
-        raise Exception("expiration must be a int (days)")
-
-      post_data['username'] = username
-      post_data['exp'] = expiration
-
+    post_data = self._download_token_request(to_fetch, entity, expiration=expiration, username=username)
     ret = self.post('/v1/get-download-token', data=post_data)
     return ret['location']
\ No newline at end of file
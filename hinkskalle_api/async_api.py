@@ -0,0 +1,372 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import os.path
+import typing
+
+from .base import HinkApiBase
+from .util.hashing import hash_file
+from .util.manifest_index import ManifestIndex
+from .util.download import parse_content_range, preallocate, DEFAULT_SEGMENT_SIZE
+from .util.upload import upload_offset
+
+from .auto.models import *
+
+logger = logging.getLogger()
+
+DEFAULT_CONCURRENCY = 8
+
+
+class AsyncHinkApi(HinkApiBase):
+  """asyncio version of HinkApi, based on httpx.
+
+  Reads the same config and caches as HinkApi and shares everything but the
+  I/O with it (see HinkApiBase). All requests share one connection pool,
+  and at most `concurrency` of them are in flight at the same time, no
+  matter how many tasks use the client.
+
+  ```python
+  async with AsyncHinkApi() as api:
+    manifests = await asyncio.gather(*[ api.list_manifests(c) for c in containers ])
+  ```
+
+  Needs httpx (`pip3 install 'hinkskalle_api[async]'`).
+
+  :param base: server url
+  :param key: access token
+  :param use_cache: use the on-disk listing and user caches
+  :param concurrency: maximum number of requests in flight
+  """
+  def __init__(self, base=None, key=None, use_cache=True, concurrency: int = DEFAULT_CONCURRENCY):
+    try:
+      import httpx
+    except ImportError:
+      raise Exception("AsyncHinkApi needs httpx: pip3 install 'hinkskalle_api[async]'")
+    cfg = self._setup(base, key, use_cache)
+
+    self.concurrency = concurrency
+    self._slots: typing.Optional[asyncio.Semaphore] = None
+    limits = httpx.Limits(max_connections=int(cfg.get('hink_api_pool_maxsize', concurrency)), max_keepalive_connections=int(cfg.get('hink_api_pool_maxsize', concurrency)) if cfg.get('hink_api_keep_alive', True) else 0)
+    self.client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(60.0, connect=30.0))
+
+  @property
+  def _semaphore(self) -> asyncio.Semaphore:
+    # created on first use: before Python 3.10 a semaphore is bound to the
+    # event loop that is current when it is created, which is not
+    # necessarily the one running the requests
+    if self._slots is None:
+      self._slots = asyncio.Semaphore(self.concurrency)
+    return self._slots
+
+  async def aclose(self):
+    if self.http_cache:
+      logger.debug(f"http cache: {self.http_cache}")
+    await self.client.aclose()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    await self.aclose()
+
+  async def _off_loop(self, fn, *args, **kwargs):
+    """Run fn in the default executor: file I/O (the caches, downloads)
+    must not block the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+  async def request(self, method: str, url: str, **kwargs):
+    """Send one request, waiting for a free slot first."""
+    async with self._semaphore:
+      return await self.client.request(method, url, **kwargs)
+
+  async def get(self, route, **kwargs):
+    url = self.base+route
+    cache_key, cached = await self._off_loop(self._cache_lookup, url, kwargs.get('params'))
+    if cached and self._cache_fresh(cached):
+      return await self._off_loop(self._from_cache, cache_key, cached)
+    r = await self.request('GET', url, headers=self._make_headers(cached.validators if cached else {}), **kwargs)
+    if r.status_code == 304 and cached:
+      return await self._off_loop(self._from_cache, cache_key, cached, r.headers)
+    if r.status_code != 200:
+      self.handle_error(r)
+    body = r.json()
+    await self._off_loop(self._to_cache, cache_key, url, r.text, r.headers)
+    return self._unwrap(body)
+
+  async def post(self, route, data, **kwargs):
+    r = await self.request('POST', self.base+route, headers=self._make_headers(), json=data, **kwargs)
+    await self._off_loop(self._changed)
+    if r.status_code != 200:
+      self.handle_error(r)
+    body = r.json()
+    return body.get('data', body)
+
+  async def put(self, route, data, **kwargs):
+    r = await self.request('PUT', self.base+route, headers=self._make_headers(), json=data, **kwargs)
+    await self._off_loop(self._changed)
+    if r.status_code != 200:
+      self.handle_error(r)
+    body = r.json()
+    return body.get('data', body)
+
+  async def get_current_user(self) -> User:
+    return await self._off_loop(self._remember_user, await self.get('/v1/token-status'))
+
+  async def _get_entity(self, entity: typing.Optional[str] = None) -> str:
+    if not self.user:
+      self.user = await self._off_loop(self._cached_user)
+    if not self.user:
+      await self.get_current_user()
+    return self._default_entity(entity)
+
+  async def list_collections(self, entity: typing.Optional[str]=None) -> typing.List[Collection]:
+    entity = await self._get_entity(entity)
+    colls = await self.get(f'/v1/collections/{entity}')
+    return [ plainToCollection(c) for c in colls ]
+
+  async def get_collection(self, collection: str, entity: typing.Optional[str]=None) -> Collection:
+    entity = await self._get_entity(entity)
+    coll = await self.get(f'/v1/collections/{entity}/{collection}')
+    return plainToCollection(coll)
+
+  async def list_containers(self, collection: str='default', entity: typing.Optional[str]=None) -> typing.List[Container]:
+    entity = await self._get_entity(entity)
+    containers = await self.get(f'/v1/containers/{entity}/{collection}')
+    return [ plainToContainer(c) for c in containers ]
+
+  async def get_container(self, container: str, collection: str='default', entity: typing.Optional[str]=None) -> Container:
+    entity = await self._get_entity(entity)
+    cont = await self.get(f'/v1/containers/{entity}/{collection}/{container}')
+    return plainToContainer(cont)
+
+  async def list_tags(self, container: str, collection: str='default', entity: typing.Optional[str]=None) -> typing.List[Tag]:
+    entity = await self._get_entity(entity)
+    ret = await self.get(f'/v1/containers/{entity}/{collection}/{container}')
+    tags = await self.get(f'/v2/tags/{ret.get("id")}')
+    return [ Tag(name=tag, arch=arch) for arch in tags for tag in tags[arch] ]
+
+  async def list_manifests(self, container: str, collection: str='default', entity: typing.Optional[str]=None) -> typing.List[Manifest]:
+    entity = await self._get_entity(entity)
+    manifests = await self.get(f'/v1/containers/{entity}/{collection}/{container}/manifests')
+    return [ self._manifest(m) for m in manifests ]
+
+  async def manifest_index(self, container: str, collection: str='default', entity: typing.Optional[str]=None, refresh=False) -> ManifestIndex:
+    entity = await self._get_entity(entity)
+    key = (entity, collection, container)
+    if refresh or key not in self._manifest_indexes:
+      self._manifest_indexes[key] = ManifestIndex(await self.list_manifests(container, collection, entity))
+    return self._manifest_indexes[key]
+
+  async def _get_tagged_manifest(self, container: str, collection: str, entity: str, tag: str) -> typing.Tuple[typing.Optional[Manifest], bool]:
+    import httpx
+    try:
+      r = await self.request('GET', f'{self.base}/v1/manifests/{entity}/{collection}/{container}:{tag}', headers=self._make_headers())
+    except httpx.HTTPError as err:
+      logger.debug(f"direct tag lookup failed: {err}")
+      return None, False
+    return self._tagged_response(r, tag)
+
+  async def get_manifest(self, container: str, collection: str='default', entity: typing.Optional[str]=None, tag: typing.Optional[str]=None, hash: typing.Optional[str]=None) -> Manifest:
+    entity = await self._get_entity(entity)
+    key = (entity, collection, container)
+    to_fetch, probe = await self._off_loop(self._indexed_manifest, key, tag=tag, hash=hash)
+    if to_fetch:
+      return to_fetch
+    route_missing = False
+    if probe:
+      to_fetch, route_missing = await self._get_tagged_manifest(container, collection, entity, typing.cast(str, tag))
+      if to_fetch:
+        await self._off_loop(self._set_direct_tag_lookup, True)
+        return to_fetch
+    index = await self.manifest_index(container, collection, entity, refresh=True)
+    return await self._off_loop(self._listed_manifest, index, key, tag=tag, hash=hash, route_missing=route_missing)
+
+  async def fetch_blob(self, container: str, collection: str='default', entity: typing.Optional[str]=None, tag: typing.Optional[str]=None, hash: typing.Optional[str]=None, out: typing.Optional[str] = None, progress: typing.Optional[typing.Callable[[int], typing.Any]] = None, connections: int = 1, segment_size: int = DEFAULT_SEGMENT_SIZE) -> str:
+    """Download a blob, in byte ranges over several connections if
+    `connections` > 1 and the server supports it.
+
+    :param progress: called with the number of bytes written
+    """
+    to_fetch = await self.get_manifest(container=container, collection=collection, entity=entity, tag=tag, hash=hash)
+    outfn = await self._off_loop(self._out_filename, to_fetch, out)
+    url = self._download_url(to_fetch)
+
+    if connections > 1:
+      async with self._semaphore:
+        async with self.client.stream('GET', url, headers=self._make_headers({ 'Range': 'bytes=0-0' })) as ret:
+          if ret.status_code not in (200, 206):
+            await ret.aread()
+            self.handle_error(ret)
+          expected_digest = ret.headers.get('Docker-Content-Digest')
+          ranged = ret.status_code == 206
+          if ranged:
+            _, _, size = parse_content_range(ret.headers.get('Content-Range'))
+      if ranged:
+        digest = await self._fetch_ranges(url, outfn, size, connections, segment_size, progress)
+        return self._check_digest(outfn, digest, expected_digest)
+      logger.debug(f"server does not support range requests, using one connection")
+
+    hl = hashlib.sha256()
+    async with self._semaphore:
+      async with self.client.stream('GET', url, headers=self._make_headers()) as ret:
+        if ret.status_code != 200:
+          await ret.aread()
+          self.handle_error(ret)
+        expected_digest = ret.headers.get('Docker-Content-Digest')
+        outfh = await self._off_loop(open, outfn, 'wb')
+        try:
+          async for chunk in ret.aiter_bytes(self.hash_block_size):
+            await self._off_loop(_write_hashed, outfh, hl, chunk)
+            if progress:
+              progress(len(chunk))
+        finally:
+          await self._off_loop(outfh.close)
+    return self._check_digest(outfn, hl.hexdigest(), expected_digest)
+
+  async def _fetch_ranges(self, url: str, outfn: str, size: int, connections: int, segment_size: int, progress) -> str:
+    await self._off_loop(preallocate, outfn, size)
+    limit = asyncio.Semaphore(connections)
+
+    async def fetch(start: int, end: int):
+      async with limit, self._semaphore:
+        async with self.client.stream('GET', url, headers=self._make_headers({ 'Range': f'bytes={start}-{end}' })) as ret:
+          if ret.status_code != 206:
+            await ret.aread()
+            raise Exception(f"segment {start}-{end}: expected 206, got {ret.status_code}")
+          fd = await self._off_loop(os.open, outfn, os.O_WRONLY)
+          try:
+            offset = start
+            async for chunk in ret.aiter_bytes(self.hash_block_size):
+              await self._off_loop(os.pwrite, fd, chunk, offset)
+              offset += len(chunk)
+              if progress:
+                progress(len(chunk))
+          finally:
+            await self._off_loop(os.close, fd)
+          if offset != end+1:
+            raise Exception(f"segment {start}-{end}: short read at {offset}")
+
+    await asyncio.gather(*[ fetch(start, min(start+segment_size, size)-1) for start in range(0, size, segment_size) ])
+
+    def digest() -> str:
+      with open(outfn, 'rb') as fh:
+        return hash_file(fh, block_size=self.hash_block_size, use_mmap=self.hash_mmap)[0]
+    return await asyncio.get_running_loop().run_in_executor(None, digest)
+
+  async def push_blob(self, container: str, data: typing.BinaryIO, collection: str = 'default', entity: typing.Optional[str] = None, progress: typing.Optional[typing.Callable[[int], typing.Any]] = None, private=False, valid_for=None, chunk_size: typing.Optional[int] = None) -> typing.Tuple[str, int]:
+    """Upload a blob unless the server has it already.
+
+    With `chunk_size` the data goes through an upload session in chunks of
+    that size, otherwise in one request. Hashing runs in a worker thread.
+    """
+    entity = await self._get_entity(entity)
+    loop = asyncio.get_running_loop()
+    cache_key, cached = await loop.run_in_executor(None, self._cached_checksum, data)
+    if cached:
+      image_hash, size = cached
+    else:
+      data.seek(0)
+      image_hash, size = await loop.run_in_executor(None, lambda: hash_file(data, block_size=self.hash_block_size, use_mmap=self.hash_mmap))
+      await loop.run_in_executor(None, self._store_checksum, cache_key, image_hash, data)
+    data.seek(0)
+
+    # httpx would send booleans as true/false
+    params = { k: str(v) for k, v in self._upload_params(image_hash, private=private, valid_for=valid_for).items() }
+
+    check = await self.request('HEAD', self._blob_url(entity, collection, container, image_hash), headers=self._make_headers())
+    if self._blob_found(check):
+      logger.info(f"😎 File already on server, skipping upload.")
+      return image_hash, size
+
+    upload_url = self._upload_url(entity, collection, container)
+    if chunk_size:
+      await self._push_chunked(upload_url, data, size, image_hash, { k: v for k, v in params.items() if k != 'digest' }, chunk_size, progress)
+      return image_hash, size
+
+    async def body():
+      while True:
+        # reading blocks, keep it off the event loop
+        chunk = await loop.run_in_executor(None, data.read, self.hash_block_size)
+        if not chunk:
+          break
+        if progress:
+          progress(len(chunk))
+        yield chunk
+    ret = await self.request('POST', upload_url, params=params, content=body(), headers=self._make_headers({ 'Content-Type': 'application/octet-stream', 'Content-Length': str(size) }))
+    if ret.status_code != 200:
+      self.handle_error(ret)
+    self._check_upload_digest(image_hash, ret.headers.get('Docker-Content-Digest'))
+    return image_hash, size
+
+  async def _push_chunked(self, url: str, data: typing.BinaryIO, size: int, digest: str, params: dict, chunk_size: int, progress, retries: int = 3):
+    ret = await self.request('POST', url, params=params, headers=self._make_headers())
+    if ret.status_code != 202 or not ret.headers.get('Location'):
+      self.handle_error(ret)
+    location = str(ret.url.join(ret.headers['Location']))
+    loop = asyncio.get_running_loop()
+    offset = 0
+    attempt = 0
+    acknowledged = False
+    while offset < size:
+      chunk = await loop.run_in_executor(None, _read_at, data, offset, min(chunk_size, size-offset))
+      try:
+        ret = await self.request('PATCH', location, content=chunk, headers=self._make_headers({
+          'Content-Type': 'application/octet-stream',
+          'Content-Range': f'{offset}-{offset+len(chunk)-1}',
+        }))
+        if ret.status_code not in (202, 204):
+          raise Exception(f"chunk {offset}: status {ret.status_code}")
+      except Exception as err:
+        attempt += 1
+        if attempt > retries:
+          raise
+        status = await self.request('GET', location, headers=self._make_headers())
+        if status.status_code in (202, 204):
+          offset = upload_offset(status.headers.get('Range'), acknowledged)
+        logger.warning(f"upload broke ({err}), resuming at {offset} ({attempt}/{retries})")
+        continue
+      acknowledged = True
+      if ret.headers.get('Location'):
+        location = str(ret.url.join(ret.headers['Location']))
+      offset += len(chunk)
+      if progress:
+        progress(len(chunk))
+    ret = await self.request('PUT', location, params={ **params, 'digest': f"sha256:{digest}" }, headers=self._make_headers())
+    if ret.status_code not in (200, 201, 202, 204):
+      self.handle_error(ret)
+    self._check_upload_digest(digest, ret.headers.get('Docker-Content-Digest'))
+
+  async def push_manifest(self, manifest: dict, tag: str, container: str, collection: str = 'default', entity: typing.Optional[str] = None) -> str:
+    entity = await self._get_entity(entity)
+    json_manifest, manifest_hash = self._manifest_body(manifest)
+
+    ret = await self.request('PUT', f"{self.base}/v2/{entity}/{collection}/{container}/manifests/{tag}", content=json_manifest, headers=self._make_headers())
+    await self._off_loop(self._manifest_written, (entity, collection, container))
+    if ret.status_code != 200:
+      self.handle_error(ret)
+    self._check_manifest_digest(manifest_hash, ret.headers.get('Docker-Content-Digest'))
+    return manifest_hash
+
+  async def get_download_token(self, manifest: typing.Optional[Manifest]=None, tag: typing.Optional[str] = None, container: typing.Optional[str] = None, collection: str = 'default', entity: typing.Optional[str] = None, expiration=None, username=None) -> str:
+    entity = await self._get_entity(entity)
+    if not manifest:
+      if not container or not tag:
+        raise Exception(f"container and tag are required")
+      to_fetch = await self.get_manifest(tag=tag, container=container, collection=collection, entity=entity)
+    else:
+      to_fetch = manifest
+
+    post_data = self._download_token_request(to_fetch, entity, expiration=expiration, username=username)
+    ret = await self.post('/v1/get-download-token', data=post_data)
+    return ret['location']
+
+
+def _read_at(data: typing.BinaryIO, offset: int, size: int) -> bytes:
+  data.seek(offset)
+  return data.read(size)
+
+def _write_hashed(fh: typing.BinaryIO, hl, chunk: bytes):
+  fh.write(chunk)
+  hl.update(chunk)
@@ -4,30 +4,10 @@ import typing
 from datetime import datetime
 from humanize import naturalsize
 
+from ..util.compact import compact, decoder
 
 
 
-def plainToCollection(json: dict) -> Collection:
-  obj = Collection()
-  obj.canEdit = bool(json['canEdit']) if json.get('canEdit') is not None else None
-  
-  obj.containers = json['containers'] if json.get('containers') is not None and isinstance(json['containers'], list) else []
-  obj.createdAt = datetime.fromisoformat(json['createdAt']) if json.get('createdAt') is not None else None
-  obj.createdBy = json.get('createdBy')
-  obj.customData = json.get('customData')
-  obj.deleted = bool(json['deleted']) if json.get('deleted') is not None else None
-  obj.deletedAt = datetime.fromisoformat(json['deletedAt']) if json.get('deletedAt') is not None else None
-  obj.description = json.get('description')
-  obj.entity = json.get('entity')
-  obj.entityName = json.get('entityName')
-  obj.id = json.get('id')
-  obj.name = json.get('name')
-  obj.private = bool(json['private']) if json.get('private') is not None else None
-  obj.size = json.get('size')
-  obj.updatedAt = datetime.fromisoformat(json['updatedAt']) if json.get('updatedAt') is not None else None
-  obj.usedQuota = json.get('usedQuota')
-  
-  return obj
 
 def serializeCollection(obj: Collection) -> dict:
   json = {}
@@ -40,6 +20,7 @@ def serializeCollection(obj: Collection) -> dict:
   
   return json
 
+@compact
 @dataclass
 class Collection:
   canEdit: typing.Optional[bool] = None
@@ -67,39 +48,10 @@ class Collection:
   usedQuota: {naturalsize(self.usedQuota)}
 """
 
+plainToCollection = decoder(Collection)
+
 
 
-def plainToContainer(json: dict) -> Container:
-  obj = Container()
-  obj.archTags = json.get('archTags')
-  obj.canEdit = bool(json['canEdit']) if json.get('canEdit') is not None else None
-  obj.collection = json.get('collection')
-  obj.collectionName = json.get('collectionName')
-  obj.createdAt = datetime.fromisoformat(json['createdAt']) if json.get('createdAt') is not None else None
-  obj.createdBy = json.get('createdBy')
-  obj.customData = json.get('customData')
-  obj.deleted = bool(json['deleted']) if json.get('deleted') is not None else None
-  obj.deletedAt = datetime.fromisoformat(json['deletedAt']) if json.get('deletedAt') is not None else None
-  obj.description = json.get('description')
-  obj.downloadCount = json.get('downloadCount')
-  obj.entity = json.get('entity')
-  obj.entityName = json.get('entityName')
-  obj.fullDescription = json.get('fullDescription')
-  obj.id = json.get('id')
-  obj.imageTags = json.get('imageTags')
-  
-  obj.images = json['images'] if json.get('images') is not None and isinstance(json['images'], list) else []
-  obj.name = json.get('name')
-  obj.private = bool(json['private']) if json.get('private') is not None else None
-  obj.readOnly = bool(json['readOnly']) if json.get('readOnly') is not None else None
-  obj.size = json.get('size')
-  obj.stars = json.get('stars')
-  obj.type = json.get('type')
-  obj.updatedAt = datetime.fromisoformat(json['updatedAt']) if json.get('updatedAt') is not None else None
-  obj.usedQuota = json.get('usedQuota')
-  obj.vcsUrl = json.get('vcsUrl')
-  
-  return obj
 
 def serializeContainer(obj: Container) -> dict:
   json = {}
@@ -115,6 +67,7 @@ def serializeContainer(obj: Container) -> dict:
   
   return json
 
+@compact
 @dataclass
 class Container:
   archTags: typing.Optional[dict] = None
@@ -152,30 +105,10 @@ class Container:
   usedQuota: {naturalsize(self.usedQuota)}
 """
 
+plainToContainer = decoder(Container)
+
 
 
-def plainToEntity(json: dict) -> Entity:
-  obj = Entity()
-  obj.canEdit = bool(json['canEdit']) if json.get('canEdit') is not None else None
-  
-  obj.collections = json['collections'] if json.get('collections') is not None and isinstance(json['collections'], list) else []
-  obj.createdAt = datetime.fromisoformat(json['createdAt']) if json.get('createdAt') is not None else None
-  obj.createdBy = json.get('createdBy')
-  obj.customData = json.get('customData')
-  obj.defaultPrivate = bool(json['defaultPrivate']) if json.get('defaultPrivate') is not None else None
-  obj.deleted = bool(json['deleted']) if json.get('deleted') is not None else None
-  obj.deletedAt = datetime.fromisoformat(json['deletedAt']) if json.get('deletedAt') is not None else None
-  obj.description = json.get('description')
-  obj.groupRef = json.get('groupRef')
-  obj.id = json.get('id')
-  obj.isGroup = bool(json['isGroup']) if json.get('isGroup') is not None else None
-  obj.name = json.get('name')
-  obj.quota = json.get('quota')
-  obj.size = json.get('size')
-  obj.updatedAt = datetime.fromisoformat(json['updatedAt']) if json.get('updatedAt') is not None else None
-  obj.usedQuota = json.get('usedQuota')
-  
-  return obj
 
 def serializeEntity(obj: Entity) -> dict:
   json = {}
@@ -188,6 +121,7 @@ def serializeEntity(obj: Entity) -> dict:
   
   return json
 
+@compact
 @dataclass
 class Entity:
   canEdit: typing.Optional[bool] = None
@@ -216,44 +150,10 @@ class Entity:
   usedQuota: {naturalsize(self.usedQuota)}
 """
 
+plainToEntity = decoder(Entity)
+
 
 
-def plainToImage(json: dict) -> Image:
-  obj = Image()
-  obj.arch = json.get('arch')
-  obj.blob = json.get('blob')
-  obj.canEdit = bool(json['canEdit']) if json.get('canEdit') is not None else None
-  obj.collection = json.get('collection')
-  obj.collectionName = json.get('collectionName')
-  obj.container = json.get('container')
-  obj.containerDownloads = json.get('containerDownloads')
-  obj.containerName = json.get('containerName')
-  obj.containerStars = json.get('containerStars')
-  obj.createdAt = datetime.fromisoformat(json['createdAt']) if json.get('createdAt') is not None else None
-  obj.createdBy = json.get('createdBy')
-  obj.customData = json.get('customData')
-  obj.deleted = bool(json['deleted']) if json.get('deleted') is not None else None
-  obj.deletedAt = datetime.fromisoformat(json['deletedAt']) if json.get('deletedAt') is not None else None
-  obj.description = json.get('description')
-  obj.downloadCount = json.get('downloadCount')
-  obj.encrypted = bool(json['encrypted']) if json.get('encrypted') is not None else None
-  obj.entity = json.get('entity')
-  obj.entityName = json.get('entityName')
-  obj.expiresAt = datetime.fromisoformat(json['expiresAt']) if json.get('expiresAt') is not None else None
-  
-  obj.fingerprints = json['fingerprints'] if json.get('fingerprints') is not None and isinstance(json['fingerprints'], list) else []
-  obj.hash = json.get('hash')
-  obj.id = json.get('id')
-  obj.signatureVerified = bool(json['signatureVerified']) if json.get('signatureVerified') is not None else None
-  obj.signed = bool(json['signed']) if json.get('signed') is not None else None
-  obj.size = json.get('size')
-  
-  obj.tags = json['tags'] if json.get('tags') is not None and isinstance(json['tags'], list) else []
-  obj.type = json.get('type')
-  obj.updatedAt = datetime.fromisoformat(json['updatedAt']) if json.get('updatedAt') is not None else None
-  obj.uploadState = json.get('uploadState')
-  
-  return obj
 
 def serializeImage(obj: Image) -> dict:
   json = {}
@@ -269,6 +169,7 @@ def serializeImage(obj: Image) -> dict:
   
   return json
 
+@compact
 @dataclass
 class Image:
   arch: typing.Optional[str] = None
@@ -303,26 +204,10 @@ class Image:
   uploadState: typing.Optional[str] = None
   
 
+plainToImage = decoder(Image)
+
 
 
-def plainToUser(json: dict) -> User:
-  obj = User()
-  obj.canEdit = bool(json['canEdit']) if json.get('canEdit') is not None else None
-  obj.createdAt = datetime.fromisoformat(json['createdAt']) if json.get('createdAt') is not None else None
-  obj.createdBy = json.get('createdBy')
-  obj.deleted = bool(json['deleted']) if json.get('deleted') is not None else None
-  obj.deletedAt = datetime.fromisoformat(json['deletedAt']) if json.get('deletedAt') is not None else None
-  obj.email = json.get('email')
-  obj.firstname = json.get('firstname')
-  obj.id = json.get('id')
-  obj.isActive = bool(json['isActive']) if json.get('isActive') is not None else None
-  obj.isAdmin = bool(json['isAdmin']) if json.get('isAdmin') is not None else None
-  obj.lastname = json.get('lastname')
-  obj.source = json.get('source')
-  obj.updatedAt = datetime.fromisoformat(json['updatedAt']) if json.get('updatedAt') is not None else None
-  obj.username = json.get('username')
-  
-  return obj
 
 def serializeUser(obj: User) -> dict:
   json = {}
@@ -336,6 +221,7 @@ def serializeUser(obj: User) -> dict:
   
   return json
 
+@compact
 @dataclass
 class User:
   canEdit: typing.Optional[bool] = None
@@ -358,27 +244,10 @@ class User:
   def is_admin(self) -> bool:
     return self.isAdmin if self.isAdmin is not None else False
 
+plainToUser = decoder(User)
+
 
 
-def plainToGroup(json: dict) -> Group:
-  obj = Group()
-  obj.canEdit = bool(json['canEdit']) if json.get('canEdit') is not None else None
-  obj.collections = json.get('collections')
-  obj.createdAt = datetime.fromisoformat(json['createdAt']) if json.get('createdAt') is not None else None
-  obj.createdBy = json.get('createdBy')
-  obj.deleted = bool(json['deleted']) if json.get('deleted') is not None else None
-  obj.deletedAt = datetime.fromisoformat(json['deletedAt']) if json.get('deletedAt') is not None else None
-  obj.description = json.get('description')
-  obj.email = json.get('email')
-  obj.entityRef = json.get('entityRef')
-  obj.id = json.get('id')
-  obj.name = json.get('name')
-  obj.updatedAt = datetime.fromisoformat(json['updatedAt']) if json.get('updatedAt') is not None else None
-  obj.users = [ 
-    plainToGroupMember(o) for o in (json['users'] if json.get('users') is not None and isinstance(json['users'], list) else [])
-  ]
-  
-  return obj
 
 def serializeGroup(obj: Group) -> dict:
   json = {}
@@ -389,6 +258,7 @@ def serializeGroup(obj: Group) -> dict:
   
   return json
 
+@compact
 @dataclass
 class Group:
   canEdit: typing.Optional[bool] = None
@@ -406,15 +276,10 @@ class Group:
   users: list[GroupMember] = field(default_factory=list)
   
 
+plainToGroup = decoder(Group)
+
 
 
-def plainToGroupMember(json: dict) -> GroupMember:
-  obj = GroupMember()
-  obj.role = json.get('role')
-  
-  obj.user = plainToUser(json['user']) if json.get('user') is not None else None
-  
-  return obj
 
 def serializeGroupMember(obj: GroupMember) -> dict:
   json = {}
@@ -424,38 +289,17 @@ def serializeGroupMember(obj: GroupMember) -> dict:
   
   return json
 
+@compact
 @dataclass
 class GroupMember:
   role: typing.Optional[str] = None
   user: typing.Optional[User] = None
   
 
+plainToGroupMember = decoder(GroupMember)
+
 
 
-def plainToManifest(json: dict) -> Manifest:
-  obj = Manifest()
-  obj.collection = json.get('collection')
-  obj.collectionName = json.get('collectionName')
-  obj.container = json.get('container')
-  obj.containerName = json.get('containerName')
-  obj.content = json.get('content')
-  obj.createdAt = datetime.fromisoformat(json['createdAt']) if json.get('createdAt') is not None else None
-  obj.createdBy = json.get('createdBy')
-  obj.downloadCount = json.get('downloadCount')
-  obj.entity = json.get('entity')
-  obj.entityName = json.get('entityName')
-  obj.filename = json.get('filename')
-  obj.hash = json.get('hash')
-  obj.id = json.get('id')
-  
-  obj.images = json['images'] if json.get('images') is not None and isinstance(json['images'], list) else []
-  
-  obj.tags = json['tags'] if json.get('tags') is not None and isinstance(json['tags'], list) else []
-  obj.total_size = json.get('total_size')
-  obj.type = json.get('type')
-  obj.updatedAt = datetime.fromisoformat(json['updatedAt']) if json.get('updatedAt') is not None else None
-  
-  return obj
 
 def serializeManifest(obj: Manifest) -> dict:
   json = {}
@@ -467,6 +311,7 @@ def serializeManifest(obj: Manifest) -> dict:
   
   return json
 
+@compact
 @dataclass
 class Manifest:
   collection: typing.Optional[str] = None
@@ -496,14 +341,10 @@ class Manifest:
   tags: {','.join(self.tags)}
 """
 
+plainToManifest = decoder(Manifest)
+
 
 
-def plainToTagData(json: dict) -> TagData:
-  obj = TagData()
-  
-  obj.tags = json['tags'] if json.get('tags') is not None and isinstance(json['tags'], list) else []
-  
-  return obj
 
 def serializeTagData(obj: TagData) -> dict:
   json = {}
@@ -511,30 +352,16 @@ def serializeTagData(obj: TagData) -> dict:
   
   return json
 
+@compact
 @dataclass
 class TagData:
   tags: list[str] = field(default_factory=list)
   
 
+plainToTagData = decoder(TagData)
+
 
 
-def plainToToken(json: dict) -> Token:
-  obj = Token()
-  obj.comment = json.get('comment')
-  obj.createdAt = datetime.fromisoformat(json['createdAt']) if json.get('createdAt') is not None else None
-  obj.createdBy = json.get('createdBy')
-  obj.deleted = bool(json['deleted']) if json.get('deleted') is not None else None
-  obj.deletedAt = datetime.fromisoformat(json['deletedAt']) if json.get('deletedAt') is not None else None
-  obj.expiresAt = datetime.fromisoformat(json['expiresAt']) if json.get('expiresAt') is not None else None
-  obj.generatedToken = json.get('generatedToken')
-  obj.id = json.get('id')
-  obj.key_uid = json.get('key_uid')
-  obj.source = json.get('source')
-  obj.updatedAt = datetime.fromisoformat(json['updatedAt']) if json.get('updatedAt') is not None else None
-  
-  obj.user = plainToUser(json['user']) if json.get('user') is not None else None
-  
-  return obj
 
 def serializeToken(obj: Token) -> dict:
   json = {}
@@ -545,6 +372,7 @@ def serializeToken(obj: Token) -> dict:
   
   return json
 
+@compact
 @dataclass
 class Token:
   comment: typing.Optional[str] = None
@@ -561,7 +389,10 @@ class Token:
   user: typing.Optional[User] = None
   
 
+plainToToken = decoder(Token)
+
 
+@compact
 @dataclass
 class Tag:
   name: str
@@ -0,0 +1,333 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import typing
+from calendar import timegm
+from datetime import datetime, timedelta
+
+from .util.parse_timedelta import parse_time
+from .util.config import read_settings
+from .util.paths import user_cache_dir
+from .util.digest_cache import DigestCache, CacheKey
+from .util.hashing import DEFAULT_BLOCK_SIZE
+from .util.manifest_index import ManifestIndex
+from .util.user_cache import UserCache, DEFAULT_TTL as DEFAULT_USER_CACHE_TTL
+from .util.http_cache import HttpCache, CacheEntry, DEFAULT_MAX_SIZE as DEFAULT_HTTP_CACHE_SIZE
+from .util.server_info import ServerInfo, DEFAULT_TTL as DEFAULT_SERVER_INFO_TTL
+
+from .auto.models import Manifest, User, plainToManifest
+
+logger = logging.getLogger()
+
+ManifestKey = typing.Tuple[str, str, str]
+
+
+class HinkApiBase:
+  """What HinkApi and AsyncHinkApi have in common: settings, caches and
+  everything about a request that does not depend on how it is sent
+  (urls, parameters, error mapping, manifest resolution). The clients only
+  do the I/O.
+  """
+  config_file = '~/.hink_api.yml'
+
+  def _setup(self, base: typing.Optional[str], key: typing.Optional[str], use_cache: bool) -> dict:
+    """Read settings and set up the caches, returns the config for the
+    client specific parts."""
+    self.config_file = os.environ.get('HINK_API_CFG', self.config_file)
+    base, key, cfg = read_settings(self.config_file, base, key)
+
+    self.base: str = base
+    self.key: typing.Optional[str] = key
+    self.hash_block_size = int(cfg.get('hink_api_hash_block_size', DEFAULT_BLOCK_SIZE))
+    self.hash_mmap = bool(cfg.get('hink_api_hash_mmap', True))
+
+    self.user: typing.Optional[User] = None
+    self._manifest_indexes: typing.Dict[ManifestKey, ManifestIndex] = {}
+    # None: not known yet
+    self.direct_tag_lookup: typing.Optional[bool] = None
+
+    self.cache_dir = user_cache_dir(cfg.get('hink_api_cache_dir'))
+    self.digest_cache: typing.Optional[DigestCache] = None
+    if cfg.get('hink_api_digest_cache', True):
+      self.digest_cache = DigestCache(os.path.join(self.cache_dir, 'digests.json'), max_entries=int(cfg.get('hink_api_digest_cache_entries', 10000)), use_xattr=bool(cfg.get('hink_api_digest_cache_xattr', False)))
+    self.user_cache: typing.Optional[UserCache] = None
+    if use_cache and float(cfg.get('hink_api_user_cache_ttl', DEFAULT_USER_CACHE_TTL)) > 0:
+      self.user_cache = UserCache(os.path.join(self.cache_dir, 'users.json'), ttl=float(cfg.get('hink_api_user_cache_ttl', DEFAULT_USER_CACHE_TTL)))
+    self.http_cache: typing.Optional[HttpCache] = None
+    if use_cache and cfg.get('hink_api_http_cache', True):
+      self.http_cache = HttpCache(os.path.join(self.cache_dir, 'http'), max_size=int(cfg.get('hink_api_http_cache_size', DEFAULT_HTTP_CACHE_SIZE)), ttl=float(cfg.get('hink_api_http_cache_ttl', 0)))
+    # what the server supports, remembered between invocations
+    self.server_info: typing.Optional[ServerInfo] = None
+    if use_cache:
+      self.server_info = ServerInfo(os.path.join(self.cache_dir, 'server.json'), ttl=float(cfg.get('hink_api_server_info_ttl', DEFAULT_SERVER_INFO_TTL)))
+    return cfg
+
+  def handle_error(self, r):
+    """Raise the server's error message for a failed response (requests or
+    httpx)."""
+    if r.status_code in (401, 403) and self.user_cache and self.key:
+      # token revoked or changed, ask again next time
+      self.user_cache.remove(self.base, self.key)
+    try:
+      json: dict = r.json()
+    except:
+      return r.raise_for_status()
+    if 'errors' in json and type(json['errors']) is list:
+      raise Exception(f"HINK-ERROR: {json['errors'][0]['detail']}")
+    elif 'errors' in json and type(json['errors']) is dict:
+      raise Exception(f"HINK-ERROR: {json['errors']}")
+    elif 'message' in json:
+      raise Exception(f"HINK-ERROR: {json['message']}")
+    else:
+      r.raise_for_status()
+
+  def _make_headers(self, hdr: typing.Optional[dict] = None) -> dict:
+    if not self.key:
+      raise Exception("Not authenticated, please login or provide a token")
+    hdr = dict(hdr or {})
+    hdr['Authorization'] = f"Bearer {self.key}"
+    return hdr
+
+  @staticmethod
+  def _unwrap(body: typing.Any) -> typing.Any:
+    return body.get('data', body)
+
+  # listing cache
+
+  def _cache_lookup(self, url: str, params: typing.Optional[dict] = None) -> typing.Tuple[typing.Optional[str], typing.Optional[CacheEntry]]:
+    """cache key and cached response for a GET, if there is a cache"""
+    if not self.http_cache:
+      return None, None
+    cache_key = HttpCache.key_for(url, self.key, params)
+    return cache_key, self.http_cache.lookup(cache_key)
+
+  def _cache_fresh(self, cached: typing.Optional[CacheEntry]) -> bool:
+    """whether cached can be used without asking the server"""
+    if not cached or not self.http_cache or not self.http_cache.fresh(cached):
+      return False
+    self.http_cache.hits += 1
+    return True
+
+  def _from_cache(self, cache_key: typing.Optional[str], cached: CacheEntry, headers: typing.Optional[typing.Mapping[str, str]] = None) -> typing.Any:
+    """data of a cached response, headers of a 304 refresh it"""
+    if headers is not None:
+      self._revalidated(cache_key, cached, headers)
+    return self._unwrap(json.loads(cached.body))
+
+  def _revalidated(self, cache_key: typing.Optional[str], cached: CacheEntry, headers: typing.Mapping[str, str]):
+    """the server answered 304 for cached"""
+    if self.http_cache and cache_key:
+      self.http_cache.revalidated += 1
+      self.http_cache.refresh(cache_key, cached, headers)
+
+  def _to_cache(self, cache_key: typing.Optional[str], url: str, text: str, headers: typing.Mapping[str, str]):
+    if self.http_cache and cache_key:
+      self.http_cache.misses += 1
+      self.http_cache.store(cache_key, url, text, headers)
+
+  def _changed(self):
+    """after a write: cached listings might be outdated"""
+    if self.http_cache:
+      self.http_cache.invalidate()
+
+  # identity
+
+  def _remember_user(self, status: dict) -> User:
+    """User from a token-status response"""
+    self.user = User(username=status.get('username'), isAdmin=status.get('isAdmin'))
+    if self.user_cache and self.key:
+      self.user_cache.store(self.base, self.key, { 'username': self.user.username, 'isAdmin': self.user.isAdmin })
+    return self.user
+
+  def _cached_user(self) -> typing.Optional[User]:
+    if not self.user_cache or not self.key:
+      return None
+    cached = self.user_cache.lookup(self.base, self.key)
+    if not cached:
+      return None
+    logger.debug(f"using cached identity {cached.get('username')}")
+    return User(username=cached.get('username'), isAdmin=cached.get('isAdmin'))
+
+  def _default_entity(self, entity: typing.Optional[str]) -> str:
+    if not entity and self.user:
+      entity = typing.cast(str, self.user.username)
+    return typing.cast(str, entity)
+
+  # manifests
+
+  @staticmethod
+  def _manifest(m: dict) -> Manifest:
+    mani = plainToManifest(m)
+    mani.image_hash = m.get('images', [None])
+    return mani
+
+  @classmethod
+  def _tagged_manifest(cls, m: typing.Any, tag: str) -> typing.Optional[Manifest]:
+    """Manifest from the direct tag route, if it is the one we asked for"""
+    if not isinstance(m, dict) or tag not in (m.get('tags') or []):
+      return None
+    return cls._manifest(m)
+
+  def _tagged_response(self, r, tag: str) -> typing.Tuple[typing.Optional[Manifest], bool]:
+    """Manifest from a direct tag route response (requests or httpx), and
+    whether the server looks like it does not have the route at all.
+
+    Only 404/405 or a body that is not the manifest count as a missing
+    route, other failures (5xx, ...) are just a failed probe."""
+    if r.status_code in (404, 405):
+      return None, True
+    if r.status_code != 200:
+      logger.debug(f"direct tag lookup failed with status {r.status_code}")
+      return None, False
+    try:
+      to_fetch = self._tagged_manifest(self._unwrap(r.json()), tag)
+    except ValueError:
+      to_fetch = None
+    return to_fetch, to_fetch is None
+
+  def _indexed_manifest(self, key: ManifestKey, tag: typing.Optional[str], hash: typing.Optional[str]) -> typing.Tuple[typing.Optional[Manifest], bool]:
+    """Manifest from an index built before. If there is none, whether to
+    ask the direct tag route before listing the container."""
+    if not tag and not hash:
+      raise Exception(f"Need either hash or tag")
+    if self.direct_tag_lookup is None and self.server_info:
+      self.direct_tag_lookup = self.server_info.lookup(self.base, 'direct_tag_lookup')
+    if key in self._manifest_indexes:
+      return self._manifest_indexes[key].resolve(tag=tag, hash=hash), False
+    return None, bool(tag) and self.direct_tag_lookup is not False
+
+  def _listed_manifest(self, index: ManifestIndex, key: ManifestKey, tag: typing.Optional[str], hash: typing.Optional[str], route_missing: bool = False) -> Manifest:
+    """Manifest from a fresh index of the container. route_missing: the
+    direct tag route was not found."""
+    to_fetch = index.resolve(tag=tag, hash=hash)
+    if not to_fetch:
+      entity, collection, container = key
+      raise Exception(f"Manifest {entity}/{collection}/{container}:{tag}/{hash} not found")
+    if route_missing and tag and tag in to_fetch.tags and self.direct_tag_lookup is None:
+      # the tag exists, so the server does not know the route
+      logger.debug(f"server has no direct tag lookup, using manifest listings")
+      self._set_direct_tag_lookup(False)
+    return to_fetch
+
+  def _set_direct_tag_lookup(self, supported: bool):
+    if self.direct_tag_lookup is supported:
+      return
+    self.direct_tag_lookup = supported
+    if self.server_info:
+      self.server_info.store(self.base, 'direct_tag_lookup', supported)
+
+  @staticmethod
+  def _manifest_body(manifest: dict) -> typing.Tuple[bytes, str]:
+    """serialized manifest and its sha256"""
+    json_manifest = json.dumps(manifest).encode('utf8')
+    return json_manifest, hashlib.sha256(json_manifest).hexdigest()
+
+  def _manifest_written(self, key: ManifestKey):
+    """after a manifest push: listings and the index of its container are outdated"""
+    self._changed()
+    self._manifest_indexes.pop(key, None)
+
+  @staticmethod
+  def _check_manifest_digest(manifest_hash: str, upload_hash: typing.Optional[str]):
+    if f"sha256:{manifest_hash}" != upload_hash:
+      raise Exception(f"Manifest checksum mismatch: {manifest_hash} != {upload_hash}")
+
+  # downloads
+
+  @staticmethod
+  def _out_filename(to_fetch: Manifest, out: typing.Optional[str]) -> str:
+    if not to_fetch.filename:
+      raise Exception('blob filename unset')
+    outfn = os.path.basename(to_fetch.filename)
+    if out and os.path.isdir(out):
+      outfn = os.path.join(out, outfn)
+    elif out:
+      outfn = out
+    return outfn
+
+  def _download_url(self, to_fetch: Manifest) -> str:
+    return f'{self.base}/v1/manifests/{to_fetch.id}/download'
+
+  @staticmethod
+  def _check_digest(outfn: str, digest: str, expected_digest: typing.Optional[str]) -> str:
+    if f"sha256:{digest}" != expected_digest:
+      raise Exception(f"Checksum mismatch: {digest} != {expected_digest}")
+    logger.info("Checksum ok.")
+    return outfn
+
+  def _download_token_request(self, to_fetch: Manifest, entity: typing.Optional[str], expiration=None, username=None) -> dict:
+    """post data for /v1/get-download-token. Admins can ask for tokens on
+    behalf of others, valid for expiration days."""
+    post_data = {
+      'type': 'manifest',
+      'id': to_fetch.id,
+    }
+    if not self.user:
+      raise Exception("user not defined")
+    if self.user.isAdmin:
+      if not username:
+        if entity == 'default':
+          username = self.user.username
+        else:
+          username = entity
+
+      if not expiration:
+        expiration = 14
+      try:
+        expiration = timegm((datetime.utcnow() + timedelta(days=int(expiration))).utctimetuple())
+      except ValueError:
+        raise Exception("expiration must be a int (days)")
+
+      post_data['username'] = username
+      post_data['exp'] = expiration
+    return post_data
+
+  # uploads
+
+  def _cached_checksum(self, data: typing.Any) -> typing.Tuple[typing.Optional[CacheKey], typing.Optional[typing.Tuple[str, int]]]:
+    """digest cache key of data and, if known, its sha256 and size"""
+    cache_key = DigestCache.key_for(data) if self.digest_cache else None
+    cached_hash = self.digest_cache.lookup(cache_key, data) if self.digest_cache and cache_key else None
+    if cached_hash and cache_key:
+      logger.info(f"👴 Using cached checksum.")
+      return cache_key, (cached_hash, cache_key[2])
+    return cache_key, None
+
+  def _store_checksum(self, cache_key: typing.Optional[CacheKey], image_hash: str, data: typing.Any):
+    if self.digest_cache and cache_key:
+      self.digest_cache.store(cache_key, image_hash, data)
+
+  def _blob_url(self, entity: str, collection: str, container: str, image_hash: str) -> str:
+    return f"{self.base}/v2/{entity}/{collection}/{container}/blobs/sha256:{image_hash}"
+
+  def _upload_url(self, entity: str, collection: str, container: str) -> str:
+    return f"{self.base}/v2/{entity}/{collection}/{container}/blobs/uploads/"
+
+  @staticmethod
+  def _blob_found(check) -> bool:
+    """whether a HEAD on the blob url says the server has it"""
+    if check.status_code == 200:
+      if not check.headers.get('Docker-Content-Digest'):
+        raise Exception("something went wrong - no content digest header!")
+      return True
+    return False
+
+  @staticmethod
+  def _check_upload_digest(image_hash: str, upload_digest: typing.Optional[str]):
+    """The server does not always send the digest of a finished upload,
+    but if it does it has to match."""
+    if upload_digest and upload_digest != f"sha256:{image_hash}":
+      raise Exception(f"Upload checksum mismatch: {image_hash} != {upload_digest}")
+
+  @staticmethod
+  def _upload_params(image_hash: typing.Optional[str], private=False, valid_for=None) -> dict:
+    """query of an upload, without digest if it is not known yet"""
+    params: typing.Dict[str, typing.Any] = { 'private': private }
+    if image_hash:
+      params['digest'] = f'sha256:{image_hash}'
+    if valid_for:
+      expiration = datetime.today() + parse_time(valid_for)
+      params['expiresAt'] = expiration.isoformat()
+    return params
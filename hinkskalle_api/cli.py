@@ -1,4 +1,5 @@
 """Console script for hinkskalle_api."""
+import itertools
 import re
 import sys
 import click
@@ -6,56 +7,68 @@ import click_log
 import logging
 import typing
 
+from hinkskalle_api.util.library import split_container, split_tagged_container
+
 logger = logging.getLogger()
-click_log.basic_config(logger)
-from hinkskalle_api import HinkApi
+
+if typing.TYPE_CHECKING:
+  from hinkskalle_api.api import HinkApi
+
+
+def echo_items(items: typing.Iterator, empty: typing.Optional[str] = None):
+  """Page through items as they come in from the server."""
+  first = next(items, None)
+  if first is None:
+    if empty:
+      click.echo(empty)
+    return
+  click.echo_via_pager(f"{i}\n" for i in itertools.chain([ first ], items))
 
 
 @click.group()
 @click_log.simple_verbosity_option(logger)
 @click.option('--base', help='API Base URL')
 @click.option('--key', help='Your access token')
+@click.option('--cache/--no-cache', help='Use cached listings if the server says they are unchanged', default=True)
 @click.pass_context
-def cli(ctx, base, key):
+def cli(ctx, base, key, cache):
     """Hinkli - talking to Hinkskalle"""
-    ctx.obj = HinkApi(base, key)
+    # only once a command runs, --help does not log
+    click_log.basic_config(logger)
+    from hinkskalle_api.api import HinkApi
+    ctx.obj = HinkApi(base, key, use_cache=cache)
+    ctx.call_on_close(ctx.obj.close)
     return 0
 
 @cli.command(short_help='get token')
 @click.option('--user', help='Username', prompt=True)
 @click.option('--password', help='Password', prompt=True, hide_input=True)
 @click.pass_obj
-def login(obj: HinkApi, user: str, password: str):
+def login(obj: 'HinkApi', user: str, password: str):
   obj.get_token(username=user, password=password)
   click.echo(f"Token stored in {obj.config_file}")
 
 @cli.command(short_help='list collections')
 @click.argument('entity', required=False)
 @click.pass_obj
-def list_collections(obj: HinkApi, entity: str):
-  colls = obj.list_collections(entity)
-  if len(colls) == 0:
-    click.echo("No collections, you should definitely make some.")
-  click.echo_via_pager(f"{c}\n" for c in colls)
+def list_collections(obj: 'HinkApi', entity: str):
+  echo_items(obj.iter_collections(entity), "No collections, you should definitely make some.")
 
 @cli.command(short_help='list containers')
 @click.argument('collection')
 @click.pass_obj
-def list_containers(obj: HinkApi, collection: str):
+def list_containers(obj: 'HinkApi', collection: str):
   if '/' in collection:
     entity, collection = collection.split('/')
   else:
     entity=None
 
-  containers = obj.list_containers(collection, entity)
-  if len(containers) == 0:
-    click.echo("No containers, did you forget to push some?")
-  click.echo_via_pager(f"{c}\n" for c in containers)
+  echo_items(obj.iter_containers(collection, entity), "No containers, did you forget to push some?")
 
 @cli.command(short_help='list tags')
 @click.argument('container')
 @click.pass_obj
-def list_tags(obj: HinkApi, container: str):
+def list_tags(obj: 'HinkApi', container: str):
   entity, collection, container = split_container(container)
   tags = obj.list_tags(entity=entity, collection=collection, container=container)
   
@@ -64,19 +77,38 @@ def list_tags(obj: HinkApi, container: str):
 @cli.command(short_help='list downloads')
 @click.argument('container')
 @click.pass_obj
-def list_downloads(obj: HinkApi, container: str):
+def list_downloads(obj: 'HinkApi', container: str):
   entity, collection, container = split_container(container)
-  manifests = obj.list_manifests(entity=entity, collection=collection, container=container)
-  
-  manifests = [ m for m in manifests if m.type=='oras' and m.filename!='(none)' and m.filename != '(multiple)']
-  
-  click.echo_via_pager(f"{m}\n" for m in manifests)
+  manifests = obj.iter_manifests(entity=entity, collection=collection, container=container)
+  echo_items(m for m in manifests if m.type=='oras' and m.filename!='(none)')
+
+@cli.command(short_help='disk usage')
+@click.argument('entity', required=False)
+@click.option('--json', 'as_json', help='One JSON object per line instead of a table', is_flag=True)
+@click.option('--all', '-a', 'show_all', help='Also list every download', is_flag=True)
+@click.option('--workers', '-w', help='Requests in flight', default=16, type=click.IntRange(min=1))
+@click.pass_obj
+def du(obj: 'HinkApi', entity: typing.Optional[str], as_json: bool, show_all: bool, workers: int):
+  """Quota used by ENTITY (default: yours), per collection and container.
+
+  Containers are printed as soon as they are done, collections after their
+  containers and the entity total last.
+  """
+  from hinkskalle_api.util.inventory import Usage
+  if not as_json:
+    click.echo(Usage.header())
+  for usage in obj.disk_usage(entity, workers=workers, manifests=show_all):
+    if as_json:
+      import json
+      click.echo(json.dumps(usage.to_dict()))
+    else:
+      click.echo(str(usage))
 
 @cli.command(short_help='get download token')
 @click.argument('container')
 @click.option('--expiration', help='Expiration time in days', default=14)
 @click.pass_obj
-def download_token(obj: HinkApi, container: str, expiration: int):
+def download_token(obj: 'HinkApi', container: str, expiration: int):
   entity, collection, container, tag = split_tagged_container(container)
   if not tag:
     raise click.ClickException("Please provide container:tag")
@@ -86,66 +118,176 @@ def download_token(obj: HinkApi, container: str, expiration: int):
   
 
 @cli.command(short_help='download data')
-@click.argument('container')
+@click.argument('container', required=False)
+@click.option('--from-file', '-f', help='Download all library paths in this file (one per line, optionally followed by a target)', type=click.File())
+@click.option('--workers', '-w', help='With --from-file: parallel downloads', default=4, type=click.IntRange(min=1))
 @click.option('--out', help='Filename/directory to save to')
 @click.option('--progress/--no-progress', help='Show progress bar', default=True)
+@click.option('--connections', '-c', help='Download in parallel over this many connections', default=1, type=click.IntRange(min=1))
+@click.option('--segment-size', help='Size of each parallel download segment (MiB)', default=64, type=click.IntRange(min=1))
+@click.option('--resume/--no-resume', help='Keep partial downloads and continue where an earlier pull stopped', default=False)
+@click.option('--unpack/--no-unpack', help='Extract directory archives while downloading (into --out)', default=False)
 @click.pass_obj
-def pull(obj: HinkApi, container: str, out: str, progress: bool):
+def pull(obj: 'HinkApi', container: typing.Optional[str], from_file: typing.Optional[typing.TextIO], workers: int, out: str, progress: bool, connections: int, segment_size: int, resume: bool, unpack: bool):
   """CONTAINER is a library path like user.name/collection/container:tag
 
   user.name can be omitted, tag defaults to 'latest'
+
+  With --from-file, OUT is the directory for all downloads. Downloads
+  with several layers are unpacked into OUT (default: the current
+  directory).
   """
+  if from_file:
+    if container:
+      raise click.ClickException("Use either CONTAINER or --from-file")
+    from hinkskalle_api.util.batch import parse_pull_spec
+    try:
+      items = parse_pull_spec(from_file)
+    except Exception as err:
+      raise click.ClickException(f"{from_file.name}: {err}")
+    report = obj.pull_many(items, out=out, workers=workers, connections=connections, segment_size=segment_size*1024*1024, on_result=click.echo)
+    click.echo(str(report))
+    if report.failed:
+      raise click.ClickException(f"{len(report.failed)} of {len(report.results)} downloads failed")
+    return
+  if not container:
+    raise click.ClickException("Please provide CONTAINER or --from-file")
   entity, collection, container, tag = split_tagged_container(container)
   if not tag:
     tag = 'latest'
   
-  out = obj.fetch_blob(entity=entity, collection=collection, container=container, tag=tag, progress=progress)
+  out = obj.fetch_blob(entity=entity, collection=collection, container=container, tag=tag, out=out, progress=progress, connections=connections, segment_size=segment_size*1024*1024, resume=resume, unpack=unpack)
   click.echo(f"{out}: Download complete")
 
-@cli.command(short_help='upload data')
-@click.argument('filename')
+@cli.command(short_help='mirror a container')
 @click.argument('container')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--prune/--no-prune', help='Remove tags that are gone from the server', default=False)
+@click.option('--workers', '-w', help='Parallel downloads', default=4, type=click.IntRange(min=1))
+@click.pass_obj
+def sync(obj: 'HinkApi', container: str, directory: str, prune: bool, workers: int):
+  """Keep DIRECTORY in step with all tags of CONTAINER
+  (user.name/collection/container), one subdirectory per tag.
+
+  Only new or changed files are downloaded, tags with the same data share
+  hardlinks. A state file in DIRECTORY remembers what is there, an
+  unchanged container costs one listing.
+  """
+  entity, collection, container = split_container(container)
+  try:
+    report = obj.sync(container, directory, collection=collection, entity=entity, workers=workers, prune=prune, on_file=lambda action, path: logger.info(f"{action}: {path}"))
+  except Exception as err:
+    raise click.ClickException(str(err))
+  click.echo(str(report))
+
+@cli.group(short_help='shared blob cache')
+@click.pass_obj
+def cache(obj: 'HinkApi'):
+  """Inspect and prune the blob cache (hink_api_blob_cache)."""
+  if not obj.blob_cache:
+    raise click.ClickException("No blob cache configured, set hink_api_blob_cache in your config")
+
+@cache.command(name='ls', short_help='list cached blobs')
+@click.pass_obj
+def cache_ls(obj: 'HinkApi'):
+  """Cached blobs, least recently used first."""
+  from humanize import naturalsize
+  blob_cache = obj.blob_cache
+  assert blob_cache
+  blobs = blob_cache.entries()
+  for blob in blobs:
+    click.echo(str(blob))
+  click.echo(f"{blob_cache.path}: {len(blobs)} blob(s), {naturalsize(sum(b.size for b in blobs))} of {naturalsize(blob_cache.max_size)}")
+
+@cache.command(name='prune', short_help='remove cached blobs')
+@click.option('--max-size', help='Shrink the cache to this size (MiB), default: hink_api_blob_cache_size', type=click.IntRange(min=0))
+@click.option('--older-than', help='Also remove blobs not used for this long (e.g. 7d, 12h)')
+@click.option('--all', 'remove_all', help='Remove everything', is_flag=True)
+@click.pass_obj
+def cache_prune(obj: 'HinkApi', max_size: typing.Optional[int], older_than: typing.Optional[str], remove_all: bool):
+  """Remove least recently used blobs. Blobs that are being downloaded
+  right now are left alone."""
+  import time
+  from humanize import naturalsize
+  from hinkskalle_api.util.parse_timedelta import parse_time
+  blob_cache = obj.blob_cache
+  assert blob_cache
+  removed = blob_cache.evict(
+    max_size=0 if remove_all else (max_size*1024*1024 if max_size is not None else None),
+    older_than=time.time()-parse_time(older_than).total_seconds() if older_than else None,
+  )
+  click.echo(f"Removed {len(removed)} blob(s), {naturalsize(sum(b.size for b in removed))}")
+
+@cli.command(short_help='upload data')
+@click.argument('filename', required=False)
+@click.argument('container', required=False)
+@click.option('--from-file', '-f', help='Push all `path container:tag` pairs in this file (one per line)', type=click.File())
+@click.option('--workers', '-w', help='With --from-file: parallel uploads', default=4, type=click.IntRange(min=1))
+@click.option('--hash-workers', help='With --from-file: files checksummed at once (default: all available cores)', type=click.IntRange(min=1))
 @click.option('--exclude', '-e', help='When creating tar, exclude files matching these regexes', multiple=True)
 @click.option('--exclude-file', help='Read exclude patterns from this file (one per line)', type=click.File())
+@click.option('--gitignore/--no-gitignore', help='Exclude patterns are gitignore-style globs instead of regexes', default=False)
 @click.option('--private/--no-private', help='Set private flag on container', default=False)
 @click.option('--valid-for', '-v', help='time until image is auto-deleted, format: <n>w<n>d<n>h<n>m, unused parts can be left out. e.g. 2w for 2 weeks')
 @click.option('--progress/--no-progress', help='Show progress bar', default=True)
+@click.option('--chunk-size', help='Upload in chunks of this size (MiB), resuming after errors', type=click.IntRange(min=1))
+@click.option('--connections', '-c', help='Upload this many chunks at once (if the server allows)', default=1, type=click.IntRange(min=1))
+@click.option('--stream/--no-stream', help='Upload directories while packing them, without a temporary tar file', default=False)
+@click.option('--compression', help='Compression for directories', type=click.Choice(['gzip', 'zstd', 'none']), default='gzip')
+@click.option('--level', help='Compression level (gzip 0-9, default 6; zstd 1-22, default 3)', type=click.IntRange(min=0, max=22))
+@click.option('--threads', help='Compression threads (default: all available cores, with --from-file split between the hash workers)', type=click.IntRange(min=1))
+@click.option('--reproducible/--no-reproducible', help='Pack directories without ownership and sub-second timestamps, so unchanged directories are not uploaded again', default=True)
+@click.option('--layers', help='Split directories into several layers: one per top level subdirectory or by size', type=click.Choice(['subdirs', 'size']))
+@click.option('--layer-size', help='With --layers size: target layer size (MiB)', default=1024, type=click.IntRange(min=1))
 @click.pass_obj
-def push(obj: HinkApi, filename: str, container: str, progress: bool, exclude: typing.Tuple, exclude_file: typing.TextIO, private: bool, valid_for: str):
-  entity, collection, container, tag = split_tagged_container(container)
+def push(obj: 'HinkApi', filename: typing.Optional[str], container: typing.Optional[str], from_file: typing.Optional[typing.TextIO], workers: int, hash_workers: typing.Optional[int], progress: bool, exclude: typing.Tuple, exclude_file: typing.TextIO, gitignore: bool, private: bool, valid_for: str, chunk_size: typing.Optional[int], connections: int, stream: bool, compression: str, level: typing.Optional[int], threads: typing.Optional[int], reproducible: bool, layers: typing.Optional[str], layer_size: int):
+  """Upload FILENAME (a file or directory) to CONTAINER (container:tag)
+
+  With --from-file many files are checksummed in parallel, only data the
+  server does not have yet is uploaded, and the tags are set at the end.
+  """
+  if level is not None:
+    from hinkskalle_api.util.codecs import get_codec
+    try:
+      get_codec(compression).level(level)
+    except Exception as err:
+      raise click.BadParameter(str(err), param_hint="'--level'")
+
   if exclude_file:
-    exclude = exclude + tuple([ l.rstrip() for l in exclude_file.readlines() if not l.startswith('#') ])
+    exclude = exclude + tuple([ l.rstrip() for l in exclude_file.readlines() if l.strip() and not l.startswith('#') ])
   
   exclude_regexes: typing.List[typing.Union[typing.Pattern, str]] = []
   for l in exclude:
+    if gitignore:
+      exclude_regexes.append(l)
+      continue
     try:
       exclude_regexes.append(re.compile(l))
     except re.error as rerr:
       raise click.ClickException(f"pattern `{l}` invalid: {rerr}")
 
+  if from_file:
+    if filename or container:
+      raise click.ClickException("Use either FILENAME CONTAINER or --from-file")
+    from hinkskalle_api.util.batch import parse_push_spec
+    try:
+      items = parse_push_spec(from_file)
+    except Exception as err:
+      raise click.ClickException(f"{from_file.name}: {err}")
+    report = obj.push_many(items, workers=workers, hash_workers=hash_workers, on_result=click.echo, private=private, valid_for=valid_for, chunk_size=chunk_size*1024*1024 if chunk_size else None, excludes=exclude_regexes, gitignore=gitignore, codec=compression, compress_level=level, threads=threads, reproducible=reproducible)
+    click.echo(str(report))
+    if report.failed:
+      raise click.ClickException(f"{len(report.failed)} of {len(report.results)} pushes failed")
+    return
+  if not filename or not container:
+    raise click.ClickException("Please provide FILENAME and CONTAINER or --from-file")
+
+  entity, collection, container, tag = split_tagged_container(container)
   if not tag:
     raise click.ClickException("Please provide container:tag")
-  obj.push_file(entity=entity, collection=collection, container=container, tag=tag, progress=progress, filename=filename, excludes=exclude_regexes, private=private, valid_for=valid_for)
+  obj.push_file(entity=entity, collection=collection, container=container, tag=tag, progress=progress, filename=filename, excludes=exclude_regexes, private=private, valid_for=valid_for, chunk_size=chunk_size*1024*1024 if chunk_size else None, connections=connections, stream=stream, codec=compression, compress_level=level, threads=threads, reproducible=reproducible, gitignore=gitignore, layers=layers, layer_size=layer_size*1024*1024)
   click.echo(f"Upload complete! (Take that, server!)")
 
 
-def split_tagged_container(container: str) -> typing.Tuple[typing.Optional[str], str, str, typing.Optional[str]]:
-  if ':' in container:
-    container, tag = container.split(':')
-  else:
-    tag = None
-  entity, collection, container = split_container(container)
-  return entity, collection, container, tag
-
-def split_container(container: str) -> typing.Tuple[typing.Optional[str], str, str]:
-  el = container.split('/')
-  if len(el) == 3:
-    return el[0], el[1], el[2]
-  elif len(el) == 2:
-    return None, el[0], el[1]
-  else:
-    return None, 'default', container
-
-
 if __name__ == "__main__":
     sys.exit(cli())  # pragma: no cover
@@ -0,0 +1,448 @@
+import hashlib
+import io
+import logging
+import os
+import os.path
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from humanize import naturalsize
+
+from .library import split_tagged_container
+from .download import DEFAULT_SEGMENT_SIZE
+from .codecs import available_threads
+
+if typing.TYPE_CHECKING:
+  from ..api import HinkApi
+  from ..auto.models import Manifest
+
+logger = logging.getLogger()
+
+DEFAULT_WORKERS = 4
+# image config of oras pushes
+CONFIG_BLOB = b'{}'
+
+
+class PullItem:
+  """One download: library path and optional target file/directory."""
+  def __init__(self, entity: typing.Optional[str], collection: str, container: str, tag: str, out: typing.Optional[str] = None):
+    self.entity = entity
+    self.collection = collection
+    self.container = container
+    self.tag = tag
+    self.out = out
+
+  @classmethod
+  def parse(cls, path: str, out: typing.Optional[str] = None) -> 'PullItem':
+    entity, collection, container, tag = split_tagged_container(path)
+    return cls(entity, collection, container, tag or 'latest', out)
+
+  @property
+  def path(self) -> str:
+    return f"{self.entity+'/' if self.entity else ''}{self.collection}/{self.container}:{self.tag}"
+
+  def __str__(self):
+    return self.path
+
+
+def parse_pull_spec(lines: typing.Iterable[str]) -> typing.List[PullItem]:
+  """Read a pull spec: one library path per line, optionally followed by a
+  file or directory to save to. Blank lines and `#` comments are skipped.
+  """
+  items = []
+  for num, line in enumerate(lines, 1):
+    line = line.split('#', 1)[0].strip()
+    if not line:
+      continue
+    fields = line.split()
+    if len(fields) > 2:
+      raise Exception(f"line {num}: expected `container:tag [out]`, got `{line}`")
+    items.append(PullItem.parse(fields[0], fields[1] if len(fields) > 1 else None))
+  return items
+
+
+class PullResult:
+  def __init__(self, item: PullItem, outfn: typing.Optional[str] = None, size: int = 0, seconds: float = 0.0, error: typing.Optional[str] = None):
+    self.item = item
+    self.outfn = outfn
+    self.size = size
+    self.seconds = seconds
+    self.error = error
+
+  @property
+  def ok(self) -> bool:
+    return self.error is None
+
+  def __str__(self):
+    if not self.ok:
+      return f"FAILED {self.item}: {self.error}"
+    return f"ok     {self.item} -> {self.outfn} ({naturalsize(self.size)}, {self.seconds:.1f}s)"
+
+
+class PullReport:
+  def __init__(self, results: typing.List[PullResult], seconds: float):
+    self.results = results
+    self.seconds = seconds
+
+  @property
+  def failed(self) -> typing.List[PullResult]:
+    return [ r for r in self.results if not r.ok ]
+
+  @property
+  def size(self) -> int:
+    return sum(r.size for r in self.results if r.ok)
+
+  @property
+  def throughput(self) -> float:
+    """bytes/s over the whole batch"""
+    return self.size / self.seconds if self.seconds > 0 else 0.0
+
+  def __str__(self):
+    return f"{len(self.results)-len(self.failed)}/{len(self.results)} downloaded, {naturalsize(self.size)} in {self.seconds:.1f}s ({naturalsize(self.throughput)}/s)"
+
+
+class BatchPull:
+  """Downloads many blobs with one client.
+
+  The user is looked up once, each container's manifests are listed once
+  (in parallel), then `workers` downloads run at the same time over the
+  client's connection pool. A failed item does not stop the others.
+
+  :param api: client to use
+  :param items: what to download
+  :param out: directory for items without their own target
+  :param workers: parallel downloads
+  :param connections: connections per download (see HinkApi.fetch_blob)
+  :param on_result: called with each PullResult as soon as it is done
+  """
+  def __init__(self, api: 'HinkApi', items: typing.List[PullItem], out: typing.Optional[str] = None, workers: int = DEFAULT_WORKERS, connections: int = 1, segment_size: int = DEFAULT_SEGMENT_SIZE, on_result: typing.Optional[typing.Callable[[PullResult], typing.Any]] = None):
+    self.api = api
+    self.items = items
+    self.out = out
+    self.workers = workers
+    self.connections = connections
+    self.segment_size = segment_size
+    self.on_result = on_result
+
+  def _done(self, result: PullResult) -> PullResult:
+    if self.on_result:
+      self.on_result(result)
+    return result
+
+  def _outfn(self, item: PullItem, manifest: 'Manifest') -> str:
+    if not manifest.filename:
+      raise Exception('blob filename unset')
+    out = item.out or self.out
+    outfn = os.path.basename(manifest.filename)
+    if out and (os.path.isdir(out) or not item.out):
+      return os.path.join(out, outfn)
+    return out or outfn
+
+  def _fetch(self, item: PullItem, outfn: str) -> PullResult:
+    start = time.perf_counter()
+    try:
+      self.api.fetch_blob(entity=item.entity, collection=item.collection, container=item.container, tag=item.tag, out=outfn, connections=self.connections, segment_size=self.segment_size)
+    except Exception as err:
+      return self._done(PullResult(item, outfn, seconds=time.perf_counter()-start, error=str(err)))
+    return self._done(PullResult(item, outfn, size=os.path.getsize(outfn), seconds=time.perf_counter()-start))
+
+  def run(self) -> PullReport:
+    start = time.perf_counter()
+    username = self.api._get_entity(None)
+    for item in self.items:
+      item.entity = item.entity or username
+    if self.out:
+      os.makedirs(self.out, exist_ok=True)
+    # all requests, including the ranged segments of each download, should
+    # find a kept-alive connection
+    self.api.session.ensure_pool_size(self.workers*self.connections)
+
+    results: typing.Dict[int, PullResult] = {}
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      keys = { (i.entity, i.collection, i.container) for i in self.items }
+      listings = { executor.submit(self.api.manifest_index, container=k[2], collection=k[1], entity=k[0]): k for k in keys }
+      failed_listings: typing.Dict[tuple, str] = {}
+      for future in as_completed(listings):
+        if future.exception():
+          failed_listings[listings[future]] = str(future.exception())
+
+      targets: typing.Dict[str, PullItem] = {}
+      downloads = {}
+      for idx, item in enumerate(self.items):
+        key = (item.entity, item.collection, item.container)
+        if key in failed_listings:
+          results[idx] = self._done(PullResult(item, error=failed_listings[key]))
+          continue
+        manifest = self.api.manifest_index(container=item.container, collection=item.collection, entity=item.entity).resolve(tag=item.tag)
+        if not manifest:
+          results[idx] = self._done(PullResult(item, error=f"tag {item.tag} not found"))
+          continue
+        try:
+          outfn = self._outfn(item, manifest)
+        except Exception as err:
+          results[idx] = self._done(PullResult(item, error=str(err)))
+          continue
+        if outfn in targets:
+          results[idx] = self._done(PullResult(item, outfn, error=f"{outfn} is also the target of {targets[outfn]}"))
+          continue
+        targets[outfn] = item
+        downloads[executor.submit(self._fetch, item, outfn)] = idx
+
+      for future in as_completed(downloads):
+        results[downloads[future]] = future.result()
+
+    report = PullReport([ results[idx] for idx in range(len(self.items)) ], time.perf_counter()-start)
+    logger.debug(f"batch pull: {report}")
+    return report
+
+
+class PushItem:
+  """One upload: local file or directory and where it goes."""
+  def __init__(self, filename: str, entity: typing.Optional[str], collection: str, container: str, tag: str):
+    self.filename = filename
+    self.entity = entity
+    self.collection = collection
+    self.container = container
+    self.tag = tag
+
+  @classmethod
+  def parse(cls, filename: str, target: str) -> 'PushItem':
+    entity, collection, container, tag = split_tagged_container(target)
+    if not tag:
+      raise Exception(f"{filename}: please provide container:tag, got `{target}`")
+    return cls(filename, entity, collection, container, tag)
+
+  @property
+  def repo(self) -> typing.Tuple[typing.Optional[str], str, str]:
+    return (self.entity, self.collection, self.container)
+
+  @property
+  def target(self) -> str:
+    return f"{self.entity+'/' if self.entity else ''}{self.collection}/{self.container}:{self.tag}"
+
+  def __str__(self):
+    return f"{self.filename} -> {self.target}"
+
+
+def parse_push_spec(lines: typing.Iterable[str]) -> typing.List[PushItem]:
+  """Read a push spec: `path container:tag` per line. Blank lines and `#`
+  comments are skipped.
+  """
+  items = []
+  for num, line in enumerate(lines, 1):
+    line = line.split('#', 1)[0].strip()
+    if not line:
+      continue
+    fields = line.split()
+    if len(fields) != 2:
+      raise Exception(f"line {num}: expected `path container:tag`, got `{line}`")
+    try:
+      items.append(PushItem.parse(fields[0], fields[1]))
+    except Exception as err:
+      raise Exception(f"line {num}: {err}")
+  return items
+
+
+class PushResult:
+  def __init__(self, item: PushItem, digest: typing.Optional[str] = None, size: int = 0, uploaded: bool = False, error: typing.Optional[str] = None):
+    self.item = item
+    self.digest = digest
+    self.size = size
+    self.uploaded = uploaded
+    self.error = error
+
+  @property
+  def ok(self) -> bool:
+    return self.error is None
+
+  def __str__(self):
+    if not self.ok:
+      return f"FAILED {self.item}: {self.error}"
+    return f"ok     {self.item} ({naturalsize(self.size)}, {'uploaded' if self.uploaded else 'already on server'})"
+
+
+class PushReport:
+  def __init__(self, results: typing.List[PushResult], seconds: float):
+    self.results = results
+    self.seconds = seconds
+
+  @property
+  def failed(self) -> typing.List[PushResult]:
+    return [ r for r in self.results if not r.ok ]
+
+  @property
+  def uploaded(self) -> int:
+    """bytes sent to the server"""
+    return sum(r.size for r in self.results if r.ok and r.uploaded)
+
+  @property
+  def skipped(self) -> int:
+    """bytes not sent because the server (or an earlier item) had them"""
+    return sum(r.size for r in self.results if r.ok and not r.uploaded)
+
+  @property
+  def throughput(self) -> float:
+    return self.uploaded / self.seconds if self.seconds > 0 else 0.0
+
+  def __str__(self):
+    return f"{len(self.results)-len(self.failed)}/{len(self.results)} pushed, {naturalsize(self.uploaded)} uploaded, {naturalsize(self.skipped)} skipped, in {self.seconds:.1f}s ({naturalsize(self.throughput)}/s)"
+
+
+class _Blob:
+  def __init__(self, filename: str, digest: str, size: int, tmp_tar: typing.Optional[str] = None, codec=None):
+    self.filename = filename
+    self.digest = digest
+    self.size = size
+    self.tmp_tar = tmp_tar
+    self.codec = codec
+
+
+class BatchPush:
+  """Uploads many files/directories, each as its own tag.
+
+  1. directories are packed and everything is checksummed, `hash_workers`
+     at a time (hashlib releases the GIL, so threads use all cores)
+  2. each distinct (container, checksum) is checked on the server once
+  3. missing blobs are uploaded, `workers` at a time
+  4. the manifests are pushed
+
+  A failed item does not stop the others.
+
+  :param api: client to use
+  :param items: what to push
+  :param workers: parallel requests
+  :param hash_workers: parallel checksums, default: all cores
+  :param threads: compression threads per directory, default: the cores
+    split between the hash workers, so that packing in parallel does not
+    start hash_workers times all cores threads
+  :param on_result: called with each PushResult when it is done
+  """
+  def __init__(self, api: 'HinkApi', items: typing.List[PushItem], workers: int = DEFAULT_WORKERS, hash_workers: typing.Optional[int] = None, on_result: typing.Optional[typing.Callable[[PushResult], typing.Any]] = None, private=False, valid_for=None, chunk_size: typing.Optional[int] = None, excludes: typing.List[typing.Union[typing.Pattern, str]] = [], gitignore=False, codec: str = 'gzip', compress_level: typing.Optional[int] = None, threads: typing.Optional[int] = None, reproducible=True):
+    self.api = api
+    self.items = items
+    self.workers = workers
+    self.hash_workers = hash_workers or available_threads()
+    self.on_result = on_result
+    self.private = private
+    self.valid_for = valid_for
+    self.chunk_size = chunk_size
+    self.tar_options = { 'excludes': excludes, 'gitignore': gitignore, 'codec': codec, 'compress_level': compress_level, 'threads': threads or max(1, available_threads() // self.hash_workers), 'reproducible': reproducible }
+
+  def _done(self, result: PushResult) -> PushResult:
+    if self.on_result:
+      self.on_result(result)
+    return result
+
+  def _prepare(self, item: PushItem) -> _Blob:
+    filename = item.filename.rstrip('/') or item.filename
+    if os.path.isdir(filename):
+      from .codecs import get_codec
+      tmp_tar = self.api._create_tar(filename, **self.tar_options)
+      try:
+        with open(tmp_tar, 'rb') as fh:
+          digest, size = self.api.checksum(fh)
+      except:
+        _remove_tar(tmp_tar)
+        raise
+      return _Blob(filename, digest, size, tmp_tar=tmp_tar, codec=get_codec(self.tar_options['codec']))
+    with open(filename, 'rb') as fh:
+      digest, size = self.api.checksum(fh)
+    return _Blob(filename, digest, size)
+
+  def _upload(self, blob: typing.Union[_Blob, bytes], digest: str, size: int, repo: tuple):
+    entity, collection, container = repo
+    if isinstance(blob, bytes):
+      with io.BytesIO(blob) as fh:
+        self.api.upload_blob(fh, digest, size, container=container, collection=collection, entity=entity, private=self.private)
+      return
+    with open(blob.tmp_tar or blob.filename, 'rb') as fh:
+      self.api.upload_blob(fh, digest, size, container=container, collection=collection, entity=entity, private=self.private, valid_for=self.valid_for, chunk_size=self.chunk_size)
+
+  def _push_manifest(self, item: PushItem, blob: _Blob, cfg_digest: str, uploaded: bool) -> PushResult:
+    manifest = self.api._file_manifest(cfg_digest, len(CONFIG_BLOB), blob.digest, blob.size, blob.filename, blob.codec)
+    try:
+      self.api.push_manifest(manifest=manifest, tag=item.tag, entity=item.entity, collection=item.collection, container=item.container)
+    except Exception as err:
+      return self._done(PushResult(item, blob.digest, blob.size, error=str(err)))
+    return self._done(PushResult(item, blob.digest, blob.size, uploaded=uploaded))
+
+  def run(self) -> PushReport:
+    start = time.perf_counter()
+    username = self.api._get_entity(None)
+    for item in self.items:
+      item.entity = item.entity or username
+    self.api.session.ensure_pool_size(self.workers)
+    cfg_digest = hashlib.sha256(CONFIG_BLOB).hexdigest()
+
+    results: typing.Dict[int, PushResult] = {}
+    blobs: typing.Dict[int, _Blob] = {}
+    try:
+      with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+        prepared = { executor.submit(self._prepare, item): idx for idx, item in enumerate(self.items) }
+        for future in as_completed(prepared):
+          idx = prepared[future]
+          if future.exception():
+            results[idx] = self._done(PushResult(self.items[idx], error=str(future.exception())))
+          else:
+            blobs[idx] = future.result()
+
+      # (repo, digest) -> item that uploads it, or None for the config blob
+      owners: typing.Dict[tuple, typing.Optional[int]] = {}
+      # the first item with a blob uploads it
+      for idx, blob in sorted(blobs.items()):
+        owners.setdefault((self.items[idx].repo, blob.digest), idx)
+        owners.setdefault((self.items[idx].repo, cfg_digest), None)
+
+      with ThreadPoolExecutor(max_workers=self.workers) as executor:
+        checks = { executor.submit(self.api.blob_exists, key[1], container=key[0][2], collection=key[0][1], entity=key[0][0]): key for key in owners }
+        errors: typing.Dict[tuple, str] = {}
+        missing = []
+        for future in as_completed(checks):
+          if future.exception():
+            errors[checks[future]] = str(future.exception())
+          elif not future.result():
+            missing.append(checks[future])
+        logger.debug(f"{len(missing)} of {len(owners)} blobs missing on the server")
+
+        uploads = {}
+        for key in missing:
+          owner = owners[key]
+          if owner is None:
+            uploads[executor.submit(self._upload, CONFIG_BLOB, key[1], len(CONFIG_BLOB), key[0])] = key
+          else:
+            uploads[executor.submit(self._upload, blobs[owner], key[1], blobs[owner].size, key[0])] = key
+        uploaded = set()
+        for future in as_completed(uploads):
+          if future.exception():
+            errors[uploads[future]] = str(future.exception())
+          else:
+            uploaded.add(uploads[future])
+
+        manifests = {}
+        for idx, blob in blobs.items():
+          item = self.items[idx]
+          error = errors.get((item.repo, blob.digest)) or errors.get((item.repo, cfg_digest))
+          if error:
+            results[idx] = self._done(PushResult(item, blob.digest, blob.size, error=error))
+            continue
+          is_owner = owners[(item.repo, blob.digest)] == idx and (item.repo, blob.digest) in uploaded
+          manifests[executor.submit(self._push_manifest, item, blob, cfg_digest, is_owner)] = idx
+        for future in as_completed(manifests):
+          results[manifests[future]] = future.result()
+    finally:
+      for blob in blobs.values():
+        if blob.tmp_tar:
+          _remove_tar(blob.tmp_tar)
+
+    report = PushReport([ results[idx] for idx in range(len(self.items)) ], time.perf_counter()-start)
+    logger.debug(f"batch push: {report}")
+    return report
+
+
+def _remove_tar(tmp_tar: str):
+  os.unlink(tmp_tar)
+  try:
+    os.rmdir(os.path.dirname(tmp_tar))
+  except OSError:
+    pass
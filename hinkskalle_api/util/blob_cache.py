@@ -0,0 +1,256 @@
+import contextlib
+import logging
+import os
+import os.path
+import re
+import shutil
+import time
+import typing
+
+try:
+  import fcntl
+except ImportError: # pragma: no cover
+  fcntl = None # type: ignore
+
+from .fastcopy import reflink
+
+logger = logging.getLogger()
+
+DEFAULT_MAX_SIZE = 50*1024*1024*1024
+LINK_MODES = ('hardlink', 'reflink', 'copy')
+
+# hinkskalle writes image hashes as sha256.<hex>
+_digest = re.compile(r'^sha256[:.]([0-9a-f]{64})$')
+
+
+def parse_digest(digest: typing.Optional[str]) -> typing.Optional[str]:
+  """`sha256:<hex>` for digest, None if it is not a usable sha256 digest."""
+  match = _digest.match(digest or '')
+  return f"sha256:{match.group(1)}" if match else None
+
+
+class CachedBlob:
+  def __init__(self, digest: str, path: str, size: int, used: float):
+    self.digest = digest
+    self.path = path
+    self.size = size
+    self.used = used
+
+  def __str__(self):
+    return f"{self.digest} {self.size} {time.strftime('%Y-%m-%d %H:%M', time.localtime(self.used))}"
+
+
+class BlobCache:
+  """Content-addressed store of downloaded blobs, keyed by
+  `sha256:<digest>`, that several processes (and users) can share.
+
+  Blobs live in `<path>/sha256/<hex>`, read-only so that a hardlinked copy
+  cannot be changed behind the cache's back. They are handed out as a
+  hardlink, a reflink or a copy, whichever works first starting at `link`.
+
+  A process fetching a blob holds an exclusive lock on
+  `<path>/locks/<hex>` (flock) for the whole download. Everybody else asking
+  for the same digest waits there and finds it in the cache afterwards, so
+  one blob is downloaded once per cache no matter how many jobs start at
+  the same time.
+
+  Every hit sets the mtime of the blob. Once the cache holds more than
+  `max_size` bytes the least recently used blobs are removed, skipping
+  any that are locked right now.
+
+  :param path: cache directory
+  :param max_size: evict beyond this many bytes
+  :param link: how blobs get to their target first, see LINK_MODES
+  """
+  def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE, link: str = 'hardlink'):
+    if link not in LINK_MODES:
+      raise Exception(f"unknown link mode {link}, use one of {', '.join(LINK_MODES)}")
+    self.path = path
+    self.max_size = max_size
+    self.link = link
+
+  @staticmethod
+  def _hex(digest: str) -> str:
+    match = _digest.match(digest)
+    if not match:
+      raise Exception(f"invalid digest {digest}")
+    return match.group(1)
+
+  def _dir(self, name: str) -> str:
+    path = os.path.join(self.path, name)
+    # group members share the cache, umask decides how far
+    os.makedirs(path, mode=0o777, exist_ok=True)
+    return path
+
+  def blob_path(self, digest: str) -> str:
+    return os.path.join(self.path, 'sha256', self._hex(digest))
+
+  def tmp_path(self, digest: str) -> str:
+    """Where the (locked) download of digest goes before store()."""
+    return os.path.join(self._dir('tmp'), self._hex(digest))
+
+  def lock_path(self, digest: str) -> str:
+    return os.path.join(self.path, 'locks', self._hex(digest))
+
+  @contextlib.contextmanager
+  def lock(self, digest: str, blocking: bool = True) -> typing.Iterator[bool]:
+    """Exclusive lock on digest across processes, yields False if not
+    blocking and somebody else has it."""
+    if fcntl is None:
+      yield True
+      return
+    self._dir('locks')
+    path = self.lock_path(digest)
+    while True:
+      fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o666)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+      except BlockingIOError:
+        os.close(fd)
+        yield False
+        return
+      # remove() deletes lock files, make sure ours is still the one
+      # everybody else opens
+      try:
+        if os.path.samestat(os.fstat(fd), os.stat(path)):
+          break
+      except FileNotFoundError:
+        pass
+      os.close(fd)
+    try:
+      yield True
+    finally:
+      os.close(fd)
+
+  def lookup(self, digest: str) -> typing.Optional[str]:
+    path = self.blob_path(digest)
+    try:
+      os.utime(path)
+    except PermissionError:
+      # somebody else's blob, still good
+      pass
+    except FileNotFoundError:
+      return None
+    return path
+
+  def store(self, src: str, digest: str) -> str:
+    """Move the verified download src into the cache."""
+    self._dir('sha256')
+    path = self.blob_path(digest)
+    os.chmod(src, 0o444)
+    os.replace(src, path)
+    self.evict()
+    return path
+
+  def materialize(self, digest: str, dest: str) -> str:
+    """Put the cached blob at dest, returns how (see LINK_MODES)."""
+    src = self.blob_path(digest)
+    tmp = f"{dest}.hinkli-cache"
+    if os.path.lexists(tmp):
+      os.unlink(tmp)
+    for mode in LINK_MODES[LINK_MODES.index(self.link):]:
+      try:
+        if mode == 'hardlink':
+          os.link(src, tmp)
+        elif mode == 'reflink':
+          _reflink(src, tmp)
+        else:
+          shutil.copyfile(src, tmp)
+      except OSError as err:
+        logger.debug(f"{mode} {src} -> {dest}: {err}")
+        if os.path.lexists(tmp):
+          os.unlink(tmp)
+        continue
+      os.replace(tmp, dest)
+      logger.debug(f"{dest}: {mode} from blob cache")
+      return mode
+    raise Exception(f"could not get {digest} out of the blob cache")
+
+  def entries(self) -> typing.List[CachedBlob]:
+    """All blobs, least recently used first."""
+    blobs = []
+    try:
+      it = os.scandir(os.path.join(self.path, 'sha256'))
+    except FileNotFoundError:
+      return []
+    with it:
+      for entry in it:
+        try:
+          st = entry.stat()
+        except FileNotFoundError:
+          continue
+        blobs.append(CachedBlob(f"sha256:{entry.name}", entry.path, st.st_size, st.st_mtime))
+    return sorted(blobs, key=lambda b: b.used)
+
+  @property
+  def size(self) -> int:
+    return sum(b.size for b in self.entries())
+
+  def remove(self, blob: CachedBlob) -> bool:
+    """Remove blob and its lock file unless somebody is fetching it
+    right now."""
+    with self.lock(blob.digest, blocking=False) as locked:
+      if not locked:
+        return False
+      try:
+        os.unlink(blob.path)
+      except FileNotFoundError:
+        pass
+      except PermissionError as err:
+        logger.warning(f"cannot remove {blob.path}: {err}")
+        return False
+      self._unlink_lock(blob.digest)
+    return True
+
+  def _unlink_lock(self, digest: str):
+    try:
+      os.unlink(self.lock_path(digest))
+    except FileNotFoundError:
+      pass
+    except PermissionError as err:
+      logger.debug(f"cannot remove lock of {digest}: {err}")
+
+  def prune_locks(self) -> int:
+    """Remove lock files left behind by downloads that never made it into
+    the cache, returns how many."""
+    try:
+      names = os.listdir(os.path.join(self.path, 'locks'))
+    except FileNotFoundError:
+      return 0
+    pruned = 0
+    for name in names:
+      digest = parse_digest(f"sha256:{name}")
+      if not digest or os.path.exists(self.blob_path(digest)):
+        continue
+      with self.lock(digest, blocking=False) as locked:
+        if locked and not os.path.exists(self.blob_path(digest)):
+          self._unlink_lock(digest)
+          pruned += 1
+    return pruned
+
+  def evict(self, max_size: typing.Optional[int] = None, older_than: typing.Optional[float] = None) -> typing.List[CachedBlob]:
+    """Remove least recently used blobs until the cache fits max_size
+    (default: the configured size) and everything not used since
+    older_than (a timestamp). Returns what was removed."""
+    max_size = self.max_size if max_size is None else max_size
+    blobs = self.entries()
+    total = sum(b.size for b in blobs)
+    removed = []
+    for blob in blobs:
+      if total <= max_size and (older_than is None or blob.used >= older_than):
+        break
+      if self.remove(blob):
+        total -= blob.size
+        removed.append(blob)
+    if removed:
+      logger.debug(f"blob cache: evicted {len(removed)} blob(s)")
+    self.prune_locks()
+    return removed
+
+  def __str__(self):
+    return f"{self.path}: {len(self.entries())} blob(s), {self.size} of {self.max_size} bytes"
+
+
+def _reflink(src: str, dest: str):
+  with open(src, 'rb') as sfh, open(dest, 'wb') as dfh:
+    reflink(sfh.fileno(), dfh.fileno())
@@ -0,0 +1,175 @@
+import collections
+import gzip
+import os
+import struct
+import time
+import typing
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 1024*1024
+# deflate window, the tail of the previous block primes the next one
+DICT_SIZE = 32*1024
+
+def available_threads() -> int:
+  try:
+    return len(os.sched_getaffinity(0)) # type: ignore
+  except AttributeError:
+    return os.cpu_count() or 1
+
+
+class PassThroughWriter:
+  """Writes to fileobj unchanged, close() leaves fileobj open."""
+  def __init__(self, fileobj: typing.BinaryIO):
+    self.fileobj = fileobj
+
+  def write(self, data) -> int:
+    self.fileobj.write(data)
+    return len(data)
+
+  def close(self):
+    pass
+
+
+class ParallelGzipWriter:
+  """Block-parallel gzip compression, like pigz.
+
+  Input is cut into blocks that are deflated independently in a thread
+  pool (zlib releases the GIL). Every block but the last ends with a sync
+  flush, so the concatenated output is a single ordinary gzip member that
+  `gunzip` and `tarfile` read as usual. Each block is primed with the last
+  32 KiB of the previous one to keep the ratio close to serial gzip.
+
+  close() finishes the gzip stream but leaves fileobj open.
+
+  :param fileobj: where the compressed data goes
+  :param level: compression level 0-9
+  :param threads: compression threads
+  :param mtime: timestamp for the gzip header (0 means none)
+  """
+  def __init__(self, fileobj: typing.BinaryIO, level: int = 6, threads: typing.Optional[int] = None, block_size: int = BLOCK_SIZE, mtime: typing.Optional[int] = None):
+    self.fileobj = fileobj
+    self.level = level
+    self.threads = threads or available_threads()
+    self.block_size = block_size
+    self._executor = ThreadPoolExecutor(max_workers=self.threads)
+    self._pending: typing.Deque = collections.deque()
+    self._buf = bytearray()
+    self._dict = b''
+    self._crc = 0
+    self._size = 0
+    self.closed = False
+    mtime = int(time.time()) if mtime is None else mtime
+    # magic, deflate, no flags, mtime, no extra flags, unix
+    self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', mtime) + b'\x00\x03')
+
+  def _compress(self, block: bytes, zdict: bytes, last: bool) -> bytes:
+    if zdict:
+      comp = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+      comp = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return comp.compress(block) + comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+  def _submit(self, block: bytes, last: bool):
+    self._crc = zlib.crc32(block, self._crc)
+    self._size += len(block)
+    self._pending.append(self._executor.submit(self._compress, block, self._dict, last))
+    self._dict = block[-DICT_SIZE:] if len(block) >= DICT_SIZE else (self._dict + block)[-DICT_SIZE:]
+    # keep a bounded number of blocks in memory
+    while len(self._pending) > self.threads*2:
+      self.fileobj.write(self._pending.popleft().result())
+
+  def write(self, data) -> int:
+    self._buf += data
+    while len(self._buf) >= self.block_size:
+      block = bytes(self._buf[:self.block_size])
+      del self._buf[:self.block_size]
+      self._submit(block, last=False)
+    return len(data)
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    try:
+      self._submit(bytes(self._buf), last=True)
+      self._buf.clear()
+      while self._pending:
+        self.fileobj.write(self._pending.popleft().result())
+      self.fileobj.write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+    finally:
+      self._executor.shutdown(wait=True)
+
+
+class Codec:
+  name = 'none'
+  media_type = 'application/vnd.oci.image.layer.v1.tar'
+  # oras only unpacks gzipped tars
+  unpack = False
+  default_level: typing.Optional[int] = None
+  # lowest and highest compression level, None: no levels
+  levels: typing.Optional[typing.Tuple[int, int]] = None
+
+  def level(self, level: typing.Optional[int] = None) -> typing.Optional[int]:
+    """level, or the default one if unset. Raises for levels out of range."""
+    if level is None:
+      return self.default_level
+    if self.levels and not self.levels[0] <= level <= self.levels[1]:
+      raise Exception(f"{self.name} compression level must be {self.levels[0]}-{self.levels[1]}, not {level}")
+    return level
+
+  def writer(self, fileobj: typing.BinaryIO, level: typing.Optional[int] = None, threads: typing.Optional[int] = None, mtime: typing.Optional[int] = None) -> typing.Any:
+    return PassThroughWriter(fileobj)
+
+  def reader(self, fileobj: typing.BinaryIO) -> typing.Any:
+    return fileobj
+
+
+class GzipCodec(Codec):
+  name = 'gzip'
+  media_type = 'application/vnd.oci.image.layer.v1.tar+gzip'
+  unpack = True
+  default_level = 6
+  levels = (0, 9)
+
+  def writer(self, fileobj: typing.BinaryIO, level: typing.Optional[int] = None, threads: typing.Optional[int] = None, mtime: typing.Optional[int] = None) -> typing.Any:
+    return ParallelGzipWriter(fileobj, level=typing.cast(int, self.level(level)), threads=threads, mtime=mtime)
+
+  def reader(self, fileobj: typing.BinaryIO) -> typing.Any:
+    return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+class ZstdCodec(Codec):
+  name = 'zstd'
+  media_type = 'application/vnd.oci.image.layer.v1.tar+zstd'
+  default_level = 3
+  levels = (1, 22)
+
+  def writer(self, fileobj: typing.BinaryIO, level: typing.Optional[int] = None, threads: typing.Optional[int] = None, mtime: typing.Optional[int] = None) -> typing.Any:
+    # multithreaded zstd output does not depend on the number of threads
+    try:
+      import zstandard
+    except ImportError:
+      raise Exception("zstd compression needs the zstandard package (pip install zstandard)")
+    comp = zstandard.ZstdCompressor(level=self.level(level), threads=threads or available_threads())
+    return comp.stream_writer(fileobj, closefd=False)
+
+  def reader(self, fileobj: typing.BinaryIO) -> typing.Any:
+    try:
+      import zstandard
+    except ImportError:
+      raise Exception("zstd archives need the zstandard package (pip install zstandard)")
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+
+
+CODECS: typing.Dict[str, Codec] = { c.name: c for c in (GzipCodec(), ZstdCodec(), Codec()) }
+
+def get_codec(name: str) -> Codec:
+  try:
+    return CODECS[name]
+  except KeyError:
+    raise Exception(f"unknown compression {name}, use one of {', '.join(CODECS)}")
+
+def codec_for_media_type(media_type: typing.Optional[str]) -> Codec:
+  """Codec of a layer, plain tar for unknown media types"""
+  return next((c for c in CODECS.values() if c.media_type == media_type), CODECS['none'])
@@ -0,0 +1,115 @@
+import dataclasses
+import re
+import sys
+import typing
+from datetime import datetime
+
+T = typing.TypeVar('T')
+
+
+class LazyDatetime:
+  """Field descriptor that keeps the iso string from the server and parses
+  it on first read. Listings rarely look at timestamps, so most of them are
+  never parsed at all.
+
+  :param slot: the slot holding the raw value
+  """
+  __slots__ = ('slot',)
+
+  def __init__(self, slot):
+    self.slot = slot
+
+  def __get__(self, obj, owner=None):
+    if obj is None:
+      return self
+    value = self.slot.__get__(obj, owner)
+    if isinstance(value, str):
+      value = datetime.fromisoformat(value)
+      self.slot.__set__(obj, value)
+    return value
+
+  def __set__(self, obj, value):
+    self.slot.__set__(obj, value)
+
+
+def _base_type(field: dataclasses.Field) -> str:
+  """`typing.Optional[bool]` -> `bool` (annotations are strings here)"""
+  t = field.type if isinstance(field.type, str) else getattr(field.type, '__name__', str(field.type))
+  if t.startswith('typing.Optional[') and t.endswith(']'):
+    t = t[len('typing.Optional['):-1]
+  return t
+
+
+def _model(t: str) -> typing.Optional[str]:
+  """name of the nested model class in `User` or `list[GroupMember]`"""
+  m = re.fullmatch(r'(?:list\[)?([A-Z]\w*)\]?', t)
+  return m.group(1) if m else None
+
+
+def compact(cls: typing.Type[T]) -> typing.Type[T]:
+  """Rebuild a dataclass with `__slots__`, like `dataclass(slots=True)`
+  does on python 3.10+. datetime fields become `LazyDatetime` backed by a
+  slot named `_<field>`.
+
+  ```python
+  @compact
+  @dataclass
+  class Container:
+    ...
+  ```
+  """
+  fields = dataclasses.fields(cls)
+  lazy = [ f.name for f in fields if _base_type(f) == 'datetime' ]
+  ns = dict(cls.__dict__)
+  for f in fields:
+    ns.pop(f.name, None)
+  ns.pop('__dict__', None)
+  ns.pop('__weakref__', None)
+  ns['__slots__'] = tuple(f"_{f.name}" if f.name in lazy else f.name for f in fields)
+  new_cls = type(cls)(cls.__name__, cls.__bases__, ns)
+  for name in lazy:
+    setattr(new_cls, name, LazyDatetime(new_cls.__dict__[f"_{name}"]))
+  return new_cls
+
+
+def decoder(cls: typing.Type[T]) -> typing.Callable[[dict], T]:
+  """Build `plainTo<cls>` for a `compact` dataclass: one `json.get` per
+  field, straight into the slots, without going through `__init__`.
+  Nested models are decoded with `plainTo<model>` from the module of cls.
+
+  The source is generated once per class, like dataclasses does for
+  `__init__`.
+  """
+  ns: typing.Dict[str, typing.Any] = { 'cls': cls, 'new': object.__new__, 'mod': sys.modules[cls.__module__] }
+  lines = [ f"def plainTo{cls.__name__}(json):", "  g = json.get", "  o = new(cls)" ]
+  for f in dataclasses.fields(cls):
+    t = _base_type(f)
+    model = _model(t)
+    if t == 'datetime':
+      lines.append(f"  o._{f.name} = g({f.name!r})")
+    elif model and t.startswith('list['):
+      lines.append(f"  v = g({f.name!r})")
+      lines.append(f"  o.{f.name} = [ mod.plainTo{model}(e) for e in v ] if isinstance(v, list) else []")
+    elif model:
+      lines.append(f"  v = g({f.name!r})")
+      lines.append(f"  o.{f.name} = None if v is None else mod.plainTo{model}(v)")
+    elif f.default_factory is list:
+      lines.append(f"  v = g({f.name!r})")
+      lines.append(f"  o.{f.name} = v if isinstance(v, list) else []")
+    elif f.default_factory is not dataclasses.MISSING:
+      ns[f"factory_{f.name}"] = f.default_factory
+      lines.append(f"  v = g({f.name!r})")
+      lines.append(f"  o.{f.name} = v if v is not None else factory_{f.name}()")
+    elif t == 'bool':
+      lines.append(f"  v = g({f.name!r})")
+      lines.append(f"  o.{f.name} = None if v is None else bool(v)")
+    elif f.default is not dataclasses.MISSING and f.default is not None:
+      ns[f"default_{f.name}"] = f.default
+      lines.append(f"  o.{f.name} = g({f.name!r}, default_{f.name})")
+    else:
+      lines.append(f"  o.{f.name} = g({f.name!r})")
+  lines.append("  return o")
+  exec("\n".join(lines), ns)
+  fn = ns[f"plainTo{cls.__name__}"]
+  fn.__module__ = cls.__module__
+  return fn
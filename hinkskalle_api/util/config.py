@@ -0,0 +1,44 @@
+import os
+import os.path
+import typing
+
+
+def load_config(path: str) -> dict:
+  """Read the hinkli config file (yaml).
+
+  yaml is imported only here, so that hinkli --help and completion, which
+  never read the config, do not pay for it.
+
+  :raises FileNotFoundError: no config file
+  """
+  with open(path, 'r') as fh:
+    text = fh.read()
+  import yaml
+  cfg = yaml.load(text, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+  return cfg if isinstance(cfg, dict) else {}
+
+
+def read_settings(config_file: str, base: typing.Optional[str] = None, key: typing.Optional[str] = None) -> typing.Tuple[str, typing.Optional[str], dict]:
+  """Server url, token and the whole config.
+
+  Arguments win over HINK_API_BASE/HINK_API_KEY, which win over the config
+  file.
+  """
+  if not base:
+    base = os.environ.get('HINK_API_BASE')
+  if not key:
+    key = os.environ.get('HINK_API_KEY')
+  try:
+    cfg = load_config(os.path.expanduser(config_file))
+  except FileNotFoundError:
+    cfg={}
+
+  if not base:
+    base=cfg.get('hink_api_base')
+  if not key:
+    key=cfg.get('hink_api_key')
+  if not base:
+    raise Exception("Please configure HINK_API_BASE!")
+  if base.endswith('/'):
+    base = base[:-1]
+  return base, key, cfg
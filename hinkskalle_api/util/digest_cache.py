@@ -0,0 +1,156 @@
+import contextlib
+import json
+import logging
+import os
+import os.path
+import stat
+import tempfile
+import threading
+import time
+import typing
+
+try:
+  import fcntl
+except ImportError: # pragma: no cover
+  fcntl = None # type: ignore
+
+logger = logging.getLogger()
+
+XATTR_NAME = 'user.hinkskalle.sha256'
+
+# (st_dev, st_ino, st_size, st_mtime_ns)
+CacheKey = typing.Tuple[int, int, int, int]
+
+
+class DigestCache:
+  """Remembers sha256 digests of local files so that unchanged files do not
+  have to be read again.
+
+  Entries are keyed by device and inode and only valid as long as size and
+  mtime_ns match. The cache is a json file, least recently used entries are
+  evicted once there are more than `max_entries`. Optionally the digest is
+  also stored in an extended attribute on the file itself.
+
+  Lookups only read the file. Hits are remembered and written together with
+  the next `store`, which holds a lock (flock on `<path>.lock`) while it
+  merges its changes into what is on disk, so parallel hash workers and
+  processes do not lose each other's entries.
+
+  :param path: cache file
+  :param max_entries: evict beyond this many entries
+  :param use_xattr: read/write digests from/to extended attributes
+  """
+  def __init__(self, path: str, max_entries: int = 10000, use_xattr: bool = False):
+    self.path = path
+    self.max_entries = max_entries
+    self.use_xattr = use_xattr and hasattr(os, 'setxattr')
+    # entry id -> last hit, not written yet
+    self._used: typing.Dict[str, float] = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def key_for(fh: typing.Any) -> typing.Optional[CacheKey]:
+    """Cache key for an open file, None for anything that is not a regular file."""
+    try:
+      st = os.fstat(fh.fileno())
+    except (AttributeError, OSError, ValueError):
+      return None
+    if not stat.S_ISREG(st.st_mode):
+      return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+  def _load(self) -> dict:
+    try:
+      with open(self.path, 'r') as fh:
+        entries = json.load(fh).get('entries', {})
+      return entries if isinstance(entries, dict) else {}
+    except FileNotFoundError:
+      return {}
+    except (ValueError, AttributeError) as err:
+      logger.warning(f"digest cache {self.path} unreadable, starting over: {err}")
+      return {}
+
+  def _save(self, entries: dict):
+    if len(entries) > self.max_entries:
+      keep = sorted(entries.items(), key=lambda e: e[1].get('used', 0), reverse=True)[:self.max_entries]
+      entries = dict(keep)
+    fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.digests')
+    try:
+      with os.fdopen(fd, 'w') as fh:
+        json.dump({ 'version': 1, 'entries': entries }, fh)
+      os.replace(tmpfn, self.path)
+    except:
+      os.unlink(tmpfn)
+      raise
+
+  @staticmethod
+  def _id(key: CacheKey) -> str:
+    return f"{key[0]}:{key[1]}"
+
+  def lookup(self, key: CacheKey, fh: typing.Any = None) -> typing.Optional[str]:
+    """Returns the hex digest for key if known and still valid."""
+    dev, ino, size, mtime_ns = key
+    if self.use_xattr and fh is not None:
+      digest = self._get_xattr(fh, size, mtime_ns)
+      if digest:
+        return digest
+    entries = self._load()
+    entry = entries.get(self._id(key))
+    if not entry or entry.get('size') != size or entry.get('mtime_ns') != mtime_ns:
+      return None
+    with self._lock:
+      self._used[self._id(key)] = time.time()
+    return entry.get('digest')
+
+  def store(self, key: CacheKey, digest: str, fh: typing.Any = None):
+    dev, ino, size, mtime_ns = key
+    if fh is not None and self.key_for(fh) != key:
+      logger.debug(f"file changed while hashing, not caching digest")
+      return
+    if self.use_xattr and fh is not None:
+      self._set_xattr(fh, size, mtime_ns, digest)
+    try:
+      with self._lock, self._locked():
+        entries = self._load()
+        for id, used in self._used.items():
+          if id in entries:
+            entries[id]['used'] = max(entries[id].get('used', 0), used)
+        self._used = {}
+        entries[self._id(key)] = { 'size': size, 'mtime_ns': mtime_ns, 'digest': digest, 'used': time.time() }
+        self._save(entries)
+    except OSError as err:
+      logger.debug(f"could not write digest cache: {err}")
+
+  @contextlib.contextmanager
+  def _locked(self) -> typing.Iterator[None]:
+    """exclusive lock on the cache file, across threads and processes"""
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    if fcntl is None:
+      yield
+      return
+    fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      yield
+    finally:
+      os.close(fd)
+
+  def _get_xattr(self, fh: typing.Any, size: int, mtime_ns: int) -> typing.Optional[str]:
+    try:
+      value = os.getxattr(fh.fileno(), XATTR_NAME).decode('ascii') # type: ignore
+    except (OSError, UnicodeDecodeError):
+      return None
+    try:
+      x_size, x_mtime_ns, digest = value.split(':')
+      if int(x_size) != size or int(x_mtime_ns) != mtime_ns:
+        return None
+    except ValueError:
+      # not ours, or damaged: a miss
+      return None
+    return digest
+
+  def _set_xattr(self, fh: typing.Any, size: int, mtime_ns: int, digest: str):
+    try:
+      os.setxattr(fh.fileno(), XATTR_NAME, f"{size}:{mtime_ns}:{digest}".encode('ascii')) # type: ignore
+    except OSError as err:
+      logger.debug(f"cannot store digest in xattr: {err}")
@@ -0,0 +1,248 @@
+import base64
+import json
+import logging
+import os
+import re
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .hashing import ResumableSha256, hash_range
+
+logger = logging.getLogger()
+
+DEFAULT_SEGMENT_SIZE = 64*1024*1024
+CHUNK_SIZE = 1024*1024
+
+_content_range = re.compile(r'^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+)$')
+
+def parse_content_range(value: typing.Optional[str]) -> typing.Tuple[int, int, int]:
+  """Parse a `Content-Range: bytes start-end/total` header."""
+  match = _content_range.match(value or '')
+  if not match:
+    raise Exception(f"Invalid Content-Range: {value}")
+  return int(match.group('start')), int(match.group('end')), int(match.group('total'))
+
+def preallocate(fn: str, size: int):
+  with open(fn, 'wb') as fh:
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+      try:
+        os.posix_fallocate(fh.fileno(), 0, size)
+        return
+      except OSError:
+        pass
+    fh.truncate(size)
+
+
+class PartialState:
+  """Progress of an interrupted download, kept in a json sidecar next to the
+  `.partial` file.
+
+  Records the completed segments and a checkpoint of the sha256 state over
+  the contiguous prefix that has been hashed already. Only a state read back
+  by `load()` is `restored`, a new one starts from an empty file.
+  """
+  def __init__(self, fn: str, digest: str, size: int, segment_size: int):
+    self.fn = fn
+    self.digest = digest
+    self.size = size
+    self.segment_size = segment_size
+    self.completed: typing.Set[int] = set()
+    self.hash_offset = 0
+    self.hash_state: typing.Optional[bytes] = None
+    self.restored = False
+    self._lock = threading.Lock()
+
+  @classmethod
+  def load(cls, fn: str) -> typing.Optional['PartialState']:
+    try:
+      with open(fn, 'r') as fh:
+        data = json.load(fh)
+      state = cls(fn, digest=data['digest'], size=int(data['size']), segment_size=int(data['segment_size']))
+      state.completed = set(int(s) for s in data['completed'])
+      if data.get('hash_state'):
+        state.hash_offset = int(data['hash_offset'])
+        state.hash_state = base64.b64decode(data['hash_state'])
+      state.restored = True
+    except FileNotFoundError:
+      return None
+    except (ValueError, KeyError, TypeError) as err:
+      logger.warning(f"ignoring invalid download state {fn}: {err}")
+      return None
+    return state
+
+  def complete(self, start: int):
+    with self._lock:
+      self.completed.add(start)
+
+  def checkpoint(self, offset: int, hl: ResumableSha256):
+    with self._lock:
+      self.hash_offset = offset
+      self.hash_state = hl.state()
+
+  def save(self):
+    with self._lock:
+      data = {
+        'digest': self.digest,
+        'size': self.size,
+        'segment_size': self.segment_size,
+        'completed': sorted(self.completed),
+        'hash_offset': self.hash_offset if self.hash_state else 0,
+        'hash_state': base64.b64encode(self.hash_state).decode('ascii') if self.hash_state else None,
+      }
+    tmpfn = f"{self.fn}.tmp"
+    with open(tmpfn, 'w') as fh:
+      json.dump(data, fh)
+    os.replace(tmpfn, self.fn)
+
+  def remove(self):
+    try:
+      os.unlink(self.fn)
+    except FileNotFoundError:
+      pass
+
+
+class RangedDownload:
+  """Fetch a blob in byte ranges over several connections.
+
+  Segments are written into a preallocated output file as they arrive and
+  hashed in order while later segments are still downloading.
+
+  :param session: HinkSession (or any requests.Session) to use
+  :param url: download url, must support Range requests
+  :param headers: extra headers (Authorization)
+  :param outfn: output filename
+  :param size: total size of the blob
+  :param connections: number of concurrent range requests
+  :param segment_size: size of each byte range
+  :param progress: called with the number of bytes written
+  :param retries: how often to retry a broken segment
+  :param state: skip segments already completed in an earlier run and
+    record progress
+  :param block_size: read/hash buffer size
+  """
+  def __init__(self, session: requests.Session, url: str, headers: dict, outfn: str, size: int, connections: int = 4, segment_size: int = DEFAULT_SEGMENT_SIZE, progress: typing.Optional[typing.Callable[[int], typing.Any]] = None, retries: int = 3, state: typing.Optional[PartialState] = None, block_size: int = CHUNK_SIZE):
+    self.session = session
+    self.url = url
+    self.headers = headers
+    self.outfn = outfn
+    self.size = size
+    self.connections = connections
+    self.segment_size = segment_size
+    self.retries = retries
+    self.state = state
+    self.block_size = block_size
+    if state:
+      self.segment_size = state.segment_size
+    self._progress = progress
+    self._lock = threading.Lock()
+    self._abort = threading.Event()
+
+  @property
+  def segments(self) -> typing.List[typing.Tuple[int, int]]:
+    return [ (start, min(start+self.segment_size, self.size)-1) for start in range(0, self.size, self.segment_size) ]
+
+  @property
+  def pending(self) -> typing.List[typing.Tuple[int, int]]:
+    if not self.state:
+      return self.segments
+    return [ (start, end) for start, end in self.segments if start not in self.state.completed ]
+
+  def progress(self, length: int):
+    if self._progress:
+      with self._lock:
+        self._progress(length)
+
+  def _request(self, start: int, end: int) -> requests.Response:
+    ret = self.session.get(self.url, headers={ **self.headers, 'Range': f'bytes={start}-{end}' }, stream=True)
+    if ret.status_code != requests.codes.partial_content:
+      ret.close()
+      raise Exception(f"Range request failed with status {ret.status_code}")
+    return ret
+
+  def _fetch_segment(self, start: int, end: int):
+    ret: typing.Optional[requests.Response] = None
+    attempt = 0
+    with open(self.outfn, 'r+b') as outfh:
+      outfh.seek(start)
+      pos = start
+      while pos <= end:
+        if self._abort.is_set():
+          raise Exception("Download aborted")
+        try:
+          if ret is None:
+            ret = self._request(pos, end)
+          with ret:
+            for chunk in ret.iter_content(chunk_size=self.block_size):
+              if self._abort.is_set():
+                raise Exception("Download aborted")
+              chunk = chunk[:end+1-pos]
+              outfh.write(chunk)
+              pos += len(chunk)
+              self.progress(len(chunk))
+              if pos > end:
+                break
+          if pos <= end:
+            raise requests.exceptions.ChunkedEncodingError(f"connection closed at {pos}")
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as err:
+          attempt += 1
+          if attempt > self.retries:
+            raise
+          logger.warning(f"segment {start}-{end} broke at {pos}, retrying ({attempt}/{self.retries}): {err}")
+        finally:
+          ret = None
+    if self.state:
+      self.state.complete(start)
+
+  def _hash_segment(self, fh: typing.BinaryIO, hl, start: int, end: int):
+    hash_range(fh, hl, start, end+1-start, block_size=self.block_size)
+
+  def run(self) -> str:
+    """Download all pending segments, returns the sha256 hexdigest."""
+    hl: typing.Any = None
+    hash_from = 0
+    if self.state and self.state.restored and os.path.exists(self.outfn):
+      if self.state.hash_state:
+        try:
+          hl = ResumableSha256(self.state.hash_state)
+          hash_from = self.state.hash_offset
+        except ValueError as err:
+          # no libcrypto (anymore), or a different one: the segments on disk
+          # are still good, they only have to be hashed again
+          logger.warning(f"cannot restore sha256 state, hashing from the start: {err}")
+    else:
+      if self.state:
+        self.state.completed.clear()
+      # truncates whatever an earlier (different) download left behind
+      preallocate(self.outfn, self.size)
+    if not hl:
+      hl = ResumableSha256()
+    pending = self.pending
+    self.progress(self.size - sum(end+1-start for start, end in pending))
+    if self.state:
+      logger.debug(f"resuming: {len(self.segments)-len(pending)} segments on disk, hashed up to {hash_from}")
+
+    try:
+      with ThreadPoolExecutor(max_workers=self.connections) as executor, open(self.outfn, 'rb', buffering=0) as hashfh:
+        futures = { seg: executor.submit(self._fetch_segment, seg[0], seg[1]) for seg in pending }
+        try:
+          for start, end in self.segments:
+            if start < hash_from:
+              continue
+            if (start, end) in futures:
+              futures[(start, end)].result()
+            self._hash_segment(hashfh, hl, start, end)
+            if self.state:
+              self.state.checkpoint(end+1, hl)
+              self.state.save()
+        except BaseException:
+          self._abort.set()
+          for fut in futures.values():
+            fut.cancel()
+          raise
+    finally:
+      if self.state:
+        self.state.save()
+    return hl.hexdigest()
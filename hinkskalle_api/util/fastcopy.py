@@ -0,0 +1,131 @@
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import typing
+
+try:
+  import fcntl
+except ImportError: # pragma: no cover
+  fcntl = None # type: ignore
+
+from .hashing import DEFAULT_BLOCK_SIZE
+
+logger = logging.getLogger()
+
+STAGE_MODES = ('hardlink', 'reflink', 'copy_file_range', 'copy')
+# uploads bigger than this are staged, if there is a staging path
+DEFAULT_STAGING_THRESHOLD = 100*1024*1024
+# linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(src: int, dest: int):
+  """Clone the file behind fd src into the (empty) file dest. Only works
+  within one filesystem that shares extents (btrfs, xfs, ...)."""
+  if fcntl is None or not hasattr(fcntl, 'ioctl'):
+    raise OSError(errno.EOPNOTSUPP, 'no reflinks here')
+  fcntl.ioctl(dest, FICLONE, src)
+
+
+def copy_range(src: int, dest: int, size: int):
+  """Copy size bytes from the start of src to dest inside the kernel
+  (`copy_file_range`). Depending on the filesystem that is a reflink, a
+  server side copy (NFS 4.2) or at least no detour through user space."""
+  if not hasattr(os, 'copy_file_range'):
+    raise OSError(errno.ENOSYS, 'no copy_file_range here')
+  done = 0
+  while done < size:
+    n = os.copy_file_range(src, dest, size-done, done, done) # type: ignore
+    if not n:
+      raise OSError(errno.EIO, f"short copy at {done}")
+    done += n
+
+
+def copy_hashing(src: typing.BinaryIO, dest: typing.BinaryIO, block_size: int = DEFAULT_BLOCK_SIZE, progress: typing.Optional[typing.Callable[[int], typing.Any]] = None) -> typing.Tuple[str, int]:
+  """Copy src from its current position to dest through one buffer,
+  hashing on the way. Returns the sha256 hexdigest and bytes copied."""
+  hl = hashlib.sha256()
+  buf = bytearray(block_size)
+  view = memoryview(buf)
+  total = 0
+  while True:
+    n = src.readinto(view) # type: ignore
+    if not n:
+      break
+    hl.update(view[:n])
+    dest.write(view[:n])
+    total += n
+    if progress:
+      progress(n)
+  return hl.hexdigest(), total
+
+
+def _same_file(data: typing.BinaryIO) -> typing.Optional[str]:
+  """path of data if its name still points to the open file"""
+  name = getattr(data, 'name', None)
+  if not isinstance(name, str):
+    return None
+  try:
+    st, fst = os.stat(name), os.fstat(data.fileno())
+  except (OSError, ValueError):
+    return None
+  return name if (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino) else None
+
+
+def stage_file(data: typing.BinaryIO, dest: str, size: int, link: str = 'hardlink', block_size: int = DEFAULT_BLOCK_SIZE, progress: typing.Optional[typing.Callable[[int], typing.Any]] = None) -> typing.Tuple[str, typing.Optional[str]]:
+  """Put the contents of data (size bytes, at position 0) at dest as
+  cheaply as possible: a hardlink, a reflink, `copy_file_range`, and only
+  if none of these work, a buffered copy. Starts at `link`, see STAGE_MODES.
+
+  The buffered copy hashes what it copies, the other modes never read the
+  data. Returns the mode used and, for a buffered copy, the sha256
+  hexdigest of what was written.
+  """
+  if link not in STAGE_MODES:
+    raise Exception(f"unknown staging mode {link}, use one of {', '.join(STAGE_MODES)}")
+  tmp = f"{dest}.hinkli-tmp"
+  if os.path.lexists(tmp):
+    os.unlink(tmp)
+  try:
+    offset = data.tell()
+  except (OSError, ValueError):
+    offset = -1
+  for mode in STAGE_MODES[STAGE_MODES.index(link):]:
+    digest = None
+    try:
+      if mode == 'hardlink':
+        path = _same_file(data)
+        if not path or offset != 0:
+          raise OSError(errno.EINVAL, 'not a named file')
+        os.link(path, tmp)
+      elif mode == 'copy':
+        with open(tmp, 'wb') as fh:
+          digest, _ = copy_hashing(data, fh, block_size=block_size, progress=progress)
+      else:
+        if offset != 0:
+          raise OSError(errno.EINVAL, 'not at the start of the file')
+        with open(tmp, 'wb') as fh:
+          if mode == 'reflink':
+            reflink(data.fileno(), fh.fileno())
+          else:
+            copy_range(data.fileno(), fh.fileno(), size)
+      written = os.stat(tmp).st_size
+    except (OSError, ValueError, AttributeError) as err:
+      logger.debug(f"{mode} {getattr(data, 'name', data)} -> {dest}: {err}")
+      if os.path.lexists(tmp):
+        os.unlink(tmp)
+      if mode == 'copy':
+        raise
+      continue
+    if written != size:
+      os.unlink(tmp)
+      raise Exception(f"{dest}: expected {size} bytes, staged {written}. Did the file change?")
+    os.replace(tmp, dest)
+    # replacing a hardlink of the same file is a no-op that leaves tmp
+    if os.path.lexists(tmp):
+      os.unlink(tmp)
+    logger.debug(f"{dest}: staged by {mode}")
+    return mode, digest
+  raise Exception(f"could not stage {dest}") # pragma: no cover
@@ -0,0 +1,191 @@
+import ctypes
+import hashlib
+import logging
+import mmap
+import os
+import stat
+import typing
+
+logger = logging.getLogger()
+
+# size of OpenSSL's SHA256_CTX: 8 state words, 2 length words,
+# 16 data words, num, md_len (all 32 bit)
+_SHA256_CTX_SIZE = 112
+_STATE_TAG = b'openssl-sha256:'
+
+DEFAULT_BLOCK_SIZE = 1024*1024
+# hashlib releases the GIL for updates bigger than this, too small for mmap
+MMAP_MIN_SIZE = 64*1024
+
+_libcrypto: typing.Any = None
+_libcrypto_loaded = False
+
+def _load_libcrypto():
+  global _libcrypto, _libcrypto_loaded
+  if _libcrypto_loaded:
+    return _libcrypto
+  _libcrypto_loaded = True
+  # ctypes.util pulls in subprocess, only load it when hashes are resumed
+  import ctypes.util
+  name = ctypes.util.find_library('crypto')
+  if not name:
+    return None
+  try:
+    lib = ctypes.CDLL(name)
+    for fn in ('SHA256_Init', 'SHA256_Update', 'SHA256_Final'):
+      getattr(lib, fn).restype = ctypes.c_int
+    lib.SHA256_Update.argtypes = [ ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t ]
+    _libcrypto = lib
+  except (OSError, AttributeError) as err:
+    logger.debug(f"libcrypto not usable for hash checkpoints: {err}")
+  return _libcrypto
+
+
+class ResumableSha256:
+  """sha256 whose intermediate state can be saved and restored.
+
+  hashlib does not expose the hash state, so this calls the SHA256_* functions
+  of libcrypto directly. Without libcrypto it falls back to hashlib and
+  `state()` returns None, callers then have to rehash from the start.
+
+  :param state: value of a previous `state()` call
+  """
+  def __init__(self, state: typing.Optional[bytes] = None):
+    self._lib = _load_libcrypto()
+    self._hl = None
+    if self._lib:
+      self._ctx = ctypes.create_string_buffer(_SHA256_CTX_SIZE)
+      if state:
+        if not state.startswith(_STATE_TAG) or len(state) != len(_STATE_TAG)+_SHA256_CTX_SIZE:
+          raise ValueError("invalid sha256 state")
+        ctypes.memmove(self._ctx, state[len(_STATE_TAG):], _SHA256_CTX_SIZE)
+      else:
+        self._lib.SHA256_Init(self._ctx)
+    else:
+      if state:
+        raise ValueError("cannot restore sha256 state without libcrypto")
+      self._hl = hashlib.sha256()
+
+  @property
+  def resumable(self) -> bool:
+    return self._hl is None
+
+  def update(self, data):
+    if self._hl is not None:
+      self._hl.update(data)
+      return
+    view = memoryview(data).cast('B')
+    if view.readonly:
+      buf = data if isinstance(data, bytes) else view.tobytes()
+    else:
+      buf = (ctypes.c_char * len(view)).from_buffer(view)
+    self._lib.SHA256_Update(self._ctx, buf, len(view))
+
+  def state(self) -> typing.Optional[bytes]:
+    if self._hl is not None:
+      return None
+    return _STATE_TAG + self._ctx.raw
+
+  def digest(self) -> bytes:
+    if self._hl is not None:
+      return self._hl.digest()
+    ctx = ctypes.create_string_buffer(self._ctx.raw, _SHA256_CTX_SIZE)
+    out = ctypes.create_string_buffer(32)
+    self._lib.SHA256_Final(out, ctx)
+    return out.raw
+
+  def hexdigest(self) -> str:
+    return self.digest().hex()
+
+
+
+def _regular_size(fh) -> typing.Optional[int]:
+  """Size of fh if it is a regular file, else None."""
+  try:
+    st = os.fstat(fh.fileno())
+  except (AttributeError, OSError, ValueError):
+    return None
+  return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+def hash_file(fh: typing.BinaryIO, hl: typing.Any = None, block_size: int = DEFAULT_BLOCK_SIZE, progress: typing.Optional[typing.Callable[[int], typing.Any]] = None, use_mmap: bool = True) -> typing.Tuple[str, int]:
+  """Hash fh from its current position to the end.
+
+  Regular files are memory-mapped and fed to the hash in `block_size`
+  slices without copying. Without mmap, regular files go through
+  `hashlib.file_digest` (Python 3.11+) if there is no progress callback and
+  no custom hash object. Everything else is read with `readinto` into one
+  preallocated buffer.
+  Afterwards fh is positioned at the end.
+
+  :param fh: file opened in binary mode
+  :param hl: hash object to update (default: new sha256)
+  :param block_size: bytes per update call
+  :param progress: called with the number of bytes hashed
+  :param use_mmap: try memory-mapping regular files
+  :return: hexdigest, number of bytes hashed
+  """
+  size = _regular_size(fh)
+  if size is not None and use_mmap:
+    offset = fh.tell()
+    if size - offset >= MMAP_MIN_SIZE:
+      try:
+        return _hash_mmap(fh, hl or hashlib.sha256(), offset, size, block_size, progress)
+      except (OSError, ValueError) as err:
+        logger.debug(f"cannot mmap {getattr(fh, 'name', fh)}: {err}")
+        fh.seek(offset)
+  if size is not None and hl is None and progress is None and hasattr(hashlib, 'file_digest'):
+    offset = fh.tell()
+    hl = hashlib.file_digest(fh, 'sha256') # type: ignore
+    return hl.hexdigest(), fh.tell()-offset
+  hl = hl or hashlib.sha256()
+  length = _hash_readinto(fh, hl, None, block_size, progress)
+  return hl.hexdigest(), length
+
+
+def hash_range(fh: typing.BinaryIO, hl: typing.Any, start: int, length: int, block_size: int = DEFAULT_BLOCK_SIZE):
+  """Update hl with `length` bytes of fh starting at `start`."""
+  fh.seek(start)
+  read = _hash_readinto(fh, hl, length, block_size)
+  if read < length:
+    raise Exception(f"short read at {start+read}")
+
+
+def _hash_mmap(fh, hl, offset: int, size: int, block_size: int, progress) -> typing.Tuple[str, int]:
+  with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+    # the file may have been truncated since fstat
+    size = min(size, len(mm))
+    view = memoryview(mm)
+    try:
+      for pos in range(offset, size, block_size):
+        end = min(pos+block_size, size)
+        with view[pos:end] as block:
+          hl.update(block)
+        if progress:
+          progress(end-pos)
+    finally:
+      view.release()
+  fh.seek(size)
+  return hl.hexdigest(), max(size-offset, 0)
+
+
+def _hash_readinto(fh, hl, length: typing.Optional[int], block_size: int, progress=None) -> int:
+  buf = bytearray(block_size if length is None else min(block_size, length))
+  view = memoryview(buf)
+  total = 0
+  readinto = getattr(fh, 'readinto', None)
+  while length is None or total < length:
+    want = len(buf) if length is None else min(len(buf), length-total)
+    if readinto:
+      n = readinto(view[:want])
+    else:
+      chunk = fh.read(want)
+      n = len(chunk)
+      view[:n] = chunk
+    if not n:
+      break
+    hl.update(view[:n])
+    total += n
+    if progress:
+      progress(n)
+  return total
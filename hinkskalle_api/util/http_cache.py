@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import re
+import tempfile
+import time
+import typing
+
+logger = logging.getLogger()
+
+DEFAULT_MAX_SIZE = 64*1024*1024
+
+_max_age = re.compile(r'max-age=(\d+)')
+
+
+class CacheEntry:
+  def __init__(self, url: str, body: str, etag: typing.Optional[str] = None, last_modified: typing.Optional[str] = None, expires: float = 0, stored: typing.Optional[float] = None):
+    self.url = url
+    self.body = body
+    self.etag = etag
+    self.last_modified = last_modified
+    self.expires = expires
+    self.stored = stored or time.time()
+
+  @property
+  def validators(self) -> dict:
+    """Headers for a conditional request."""
+    hdr = {}
+    if self.etag:
+      hdr['If-None-Match'] = self.etag
+    if self.last_modified:
+      hdr['If-Modified-Since'] = self.last_modified
+    return hdr
+
+  def to_dict(self) -> dict:
+    return { 'url': self.url, 'body': self.body, 'etag': self.etag, 'last_modified': self.last_modified, 'expires': self.expires, 'stored': self.stored }
+
+
+class HttpCache:
+  """On-disk cache for GET responses of the API.
+
+  Bodies are stored with their validators (ETag, Last-Modified) and an
+  expiry time, one json file per url and token. Until an entry expires it
+  is served without asking the server, afterwards a conditional request is
+  sent and a 304 answer is served from the cache again.
+
+  The expiry comes from `Cache-Control: max-age` or, without that, from
+  `ttl` (0: always revalidate). Responses that have neither validators nor
+  a lifetime are not stored. Once the files add up to more than `max_size`
+  bytes, the least recently used ones are removed.
+
+  :param path: cache directory
+  :param max_size: evict beyond this many bytes
+  :param ttl: seconds a response without max-age is considered fresh
+  """
+  def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE, ttl: float = 0):
+    self.path = path
+    self.max_size = max_size
+    self.ttl = ttl
+    self.hits = 0
+    self.revalidated = 0
+    self.misses = 0
+
+  @staticmethod
+  def key_for(url: str, token: typing.Optional[str], params: typing.Optional[dict] = None) -> str:
+    """Entries are per token, other users must not see our listings."""
+    hl = hashlib.sha256(url.encode('utf8'))
+    hl.update(b'\0' + (token or '').encode('utf8'))
+    if params:
+      hl.update(b'\0' + json.dumps(params, sort_keys=True, default=str).encode('utf8'))
+    return hl.hexdigest()
+
+  def _fn(self, key: str) -> str:
+    return os.path.join(self.path, f"{key}.json")
+
+  def _invalidated(self) -> float:
+    try:
+      return os.stat(os.path.join(self.path, '.invalidated')).st_mtime
+    except FileNotFoundError:
+      return 0
+
+  def lookup(self, key: str) -> typing.Optional[CacheEntry]:
+    try:
+      with open(self._fn(key), 'r') as fh:
+        entry = CacheEntry(**json.load(fh))
+    except FileNotFoundError:
+      return None
+    except (ValueError, TypeError) as err:
+      logger.debug(f"dropping broken cache entry {key}: {err}")
+      self.remove(key)
+      return None
+    if entry.stored < self._invalidated():
+      entry.expires = 0
+    try:
+      # mtime is our LRU clock
+      os.utime(self._fn(key))
+    except OSError:
+      pass
+    return entry
+
+  def fresh(self, entry: CacheEntry) -> bool:
+    return entry.expires > time.time()
+
+  def _expires(self, headers: typing.Mapping[str, str]) -> typing.Optional[float]:
+    """Expiry time from the response headers, None if it must not be stored."""
+    cache_control = headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control:
+      return None
+    if 'no-cache' in cache_control:
+      return 0
+    max_age = _max_age.search(cache_control)
+    if max_age:
+      return time.time() + int(max_age.group(1))
+    return time.time() + self.ttl if self.ttl else 0
+
+  def store(self, key: str, url: str, body: str, headers: typing.Mapping[str, str]) -> typing.Optional[CacheEntry]:
+    expires = self._expires(headers)
+    etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+    if expires is None or (not expires and not etag and not last_modified):
+      return None
+    entry = CacheEntry(url=url, body=body, etag=etag, last_modified=last_modified, expires=expires)
+    self._write(key, entry)
+    self._evict()
+    return entry
+
+  def refresh(self, key: str, entry: CacheEntry, headers: typing.Mapping[str, str]) -> CacheEntry:
+    """Server said 304: extend the lifetime, pick up new validators."""
+    expires = self._expires(headers)
+    entry.expires = expires or 0
+    entry.stored = time.time()
+    entry.etag = headers.get('ETag', entry.etag)
+    entry.last_modified = headers.get('Last-Modified', entry.last_modified)
+    self._write(key, entry)
+    return entry
+
+  def remove(self, key: str):
+    try:
+      os.unlink(self._fn(key))
+    except FileNotFoundError:
+      pass
+
+  def invalidate(self):
+    """Something changed on the server, revalidate everything before use."""
+    try:
+      os.makedirs(self.path, exist_ok=True)
+      with open(os.path.join(self.path, '.invalidated'), 'w'):
+        pass
+    except OSError as err:
+      logger.debug(f"could not invalidate http cache: {err}")
+
+  def _write(self, key: str, entry: CacheEntry):
+    try:
+      os.makedirs(self.path, exist_ok=True)
+      fd, tmpfn = tempfile.mkstemp(dir=self.path, prefix='.entry')
+      try:
+        with os.fdopen(fd, 'w') as fh:
+          json.dump(entry.to_dict(), fh)
+        os.replace(tmpfn, self._fn(key))
+      except:
+        os.unlink(tmpfn)
+        raise
+    except OSError as err:
+      logger.debug(f"could not write http cache entry: {err}")
+
+  def _evict(self):
+    try:
+      entries = [ e for e in os.scandir(self.path) if e.name.endswith('.json') and not e.name.startswith('.') ]
+    except FileNotFoundError:
+      return
+    stats = []
+    for entry in entries:
+      try:
+        stats.append((entry.path, entry.stat()))
+      except FileNotFoundError:
+        continue
+    total = sum(st.st_size for _, st in stats)
+    if total <= self.max_size:
+      return
+    for path, st in sorted(stats, key=lambda e: e[1].st_mtime):
+      if total <= self.max_size:
+        break
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      total -= st.st_size
+
+  def __str__(self):
+    return f"{self.hits} hits, {self.revalidated} revalidated, {self.misses} misses"
+
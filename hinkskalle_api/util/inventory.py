@@ -0,0 +1,190 @@
+import logging
+import typing
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+
+from humanize import naturalsize
+
+if typing.TYPE_CHECKING:
+  from ..api import HinkApi
+  from ..auto.models import Collection, Container, Image, Manifest
+
+logger = logging.getLogger()
+
+DEFAULT_WORKERS = 16
+
+
+class Usage:
+  """Aggregated numbers of one entity, collection, container or manifest.
+
+  used_quota is what the server accounts for the node (`usedQuota`, for a
+  manifest its `total_size`), size the sum of the manifest sizes below it.
+  expires is the earliest expiry of an image below it.
+  """
+  def __init__(self, level: str, path: str, used_quota: typing.Optional[int] = None, quota: typing.Optional[int] = None):
+    self.level = level
+    self.path = path
+    self.used_quota = used_quota
+    self.quota = quota
+    self.size = 0
+    self.manifests = 0
+    self.downloads = 0
+    self.expires: typing.Optional[datetime] = None
+    self.error: typing.Optional[str] = None
+
+  def add(self, other: 'Usage'):
+    self.size += other.size
+    self.manifests += other.manifests
+    self.downloads += other.downloads
+    self.expire(other.expires)
+
+  def expire(self, when: typing.Optional[datetime]):
+    if when and (self.expires is None or _ts(when) < _ts(self.expires)):
+      self.expires = when
+
+  def to_dict(self) -> dict:
+    return {
+      'level': self.level, 'path': self.path, 'usedQuota': self.used_quota, 'quota': self.quota, 'size': self.size,
+      'manifests': self.manifests, 'downloadCount': self.downloads,
+      'expiresAt': self.expires.isoformat() if self.expires else None, 'error': self.error,
+    }
+
+  def __str__(self):
+    used = naturalsize(self.used_quota) if self.used_quota is not None else '-'
+    expires = self.expires.strftime('%Y-%m-%d') if self.expires else '-'
+    return f"{used:>10} {naturalsize(self.size):>10} {self.manifests:>6} {self.downloads:>7} {expires:>10}  {self.path}{' ERROR: '+self.error if self.error else ''}"
+
+  @staticmethod
+  def header() -> str:
+    return f"{'used':>10} {'size':>10} {'files':>6} {'pulls':>7} {'expires':>10}  path"
+
+
+def _ts(when: datetime) -> float:
+  # naive timestamps from the server are utc
+  return when.timestamp() if when.tzinfo else when.replace(tzinfo=timezone.utc).timestamp()
+
+
+class DiskUsage:
+  """Walks entity -> collections -> containers -> manifests (and images,
+  for expiry) with up to `workers` requests in flight.
+
+  Every listing is started as soon as its parent arrives, so the whole walk
+  takes about as many round trips as the tree is deep (plus whatever the
+  pool has to queue). Containers are reported as soon as their manifests
+  are in, a collection when the last of its containers is done and the
+  entity at the very end. Listings that fail are reported with their error
+  and count as empty.
+
+  ```python
+  for usage in DiskUsage(api, 'test.hase'):
+    print(usage)
+  ```
+
+  :param api: client to use
+  :param entity: entity to walk, default: the user's
+  :param workers: requests in flight
+  :param manifests: also report each manifest
+  """
+  def __init__(self, api: 'HinkApi', entity: typing.Optional[str] = None, workers: int = DEFAULT_WORKERS, manifests: bool = False):
+    self.api = api
+    self.entity = entity
+    self.workers = workers
+    self.manifests = manifests
+
+  def __iter__(self) -> typing.Iterator[Usage]:
+    entity = self.api._get_entity(self.entity)
+    self.api.session.ensure_pool_size(self.workers)
+    top = Usage('entity', entity)
+    collections: typing.Dict[str, Usage] = {}
+    # containers still running per collection
+    remaining: typing.Dict[str, int] = {}
+    # manifest and image listings of a container, until both are in
+    parts: typing.Dict[typing.Tuple[str, str], dict] = {}
+
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      pending: typing.Dict[Future, tuple] = {
+        executor.submit(self.api.get_entity, entity): ('entity',),
+        executor.submit(self.api.list_collections, entity): ('collections',),
+      }
+      while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          task = pending.pop(future)
+          err = future.exception()
+          if err:
+            logger.debug(f"{task}: {err}")
+          if task[0] == 'entity':
+            if not err:
+              ent = future.result()
+              top.used_quota, top.quota = ent.usedQuota, ent.quota
+          elif task[0] == 'collections':
+            if err:
+              top.error = str(err)
+              continue
+            for coll in typing.cast(typing.List['Collection'], future.result()):
+              name = typing.cast(str, coll.name)
+              collections[name] = Usage('collection', f"{entity}/{name}", used_quota=coll.usedQuota)
+              remaining[name] = 0
+              pending[executor.submit(self.api.list_containers, name, entity)] = ('containers', name)
+          elif task[0] == 'containers':
+            coll_name = task[1]
+            if err:
+              collections[coll_name].error = str(err)
+              containers: typing.List['Container'] = []
+            else:
+              containers = future.result()
+            for cont in containers:
+              name = typing.cast(str, cont.name)
+              remaining[coll_name] += 1
+              parts[(coll_name, name)] = { 'container': cont }
+              pending[executor.submit(self.api.list_manifests, name, coll_name, entity)] = ('manifests', coll_name, name)
+              pending[executor.submit(self.api.list_images, name, coll_name, entity)] = ('images', coll_name, name)
+            if not remaining[coll_name]:
+              yield self._collection_done(top, collections[coll_name])
+          else:
+            _, coll_name, name = task
+            part = parts[(coll_name, name)]
+            part[task[0]] = err or future.result()
+            if 'manifests' not in part or 'images' not in part:
+              continue
+            del parts[(coll_name, name)]
+            yield from self._container_done(collections[coll_name], part)
+            remaining[coll_name] -= 1
+            if not remaining[coll_name]:
+              yield self._collection_done(top, collections[coll_name])
+    yield top
+
+  @staticmethod
+  def _collection_done(top: Usage, coll: Usage) -> Usage:
+    top.add(coll)
+    return coll
+
+  def _container_done(self, coll: Usage, part: dict) -> typing.Iterator[Usage]:
+    cont: 'Container' = part['container']
+    usage = Usage('container', f"{coll.path}/{cont.name}", used_quota=cont.usedQuota)
+    expiry: typing.Dict[str, datetime] = {}
+    if isinstance(part['images'], Exception):
+      # expiry is nice to have, older servers might not list images
+      logger.debug(f"{usage.path}: no images ({part['images']})")
+    else:
+      for img in typing.cast(typing.List['Image'], part['images']):
+        if img.hash and img.expiresAt:
+          expiry[img.hash.replace('sha256.', 'sha256:', 1)] = img.expiresAt
+        usage.expire(img.expiresAt)
+    if isinstance(part['manifests'], Exception):
+      usage.error = str(part['manifests'])
+      manifests: typing.List['Manifest'] = []
+    else:
+      manifests = part['manifests']
+    for m in manifests:
+      mani = Usage('manifest', f"{usage.path}/{m.filename or m.hash}:{','.join(m.tags)}", used_quota=m.total_size)
+      mani.size = m.total_size or 0
+      mani.manifests = 1
+      mani.downloads = m.downloadCount or 0
+      for digest in m.images:
+        mani.expire(expiry.get(digest))
+      usage.add(mani)
+      if self.manifests:
+        yield mani
+    coll.add(usage)
+    yield usage
@@ -0,0 +1,103 @@
+import codecs
+import json
+import typing
+
+_ws = ' \t\n\r'
+
+
+class _Buffer:
+  """Text from a stream of utf8 chunks, refilled on demand."""
+  def __init__(self, chunks: typing.Iterable[bytes]):
+    self.chunks = iter(chunks)
+    self.decoder = codecs.getincrementaldecoder('utf8')()
+    self.text = ''
+    self.pos = 0
+    self.eof = False
+
+  def fill(self) -> bool:
+    if self.eof:
+      return False
+    chunk = next(self.chunks, None)
+    if chunk is None:
+      self.eof = True
+      self.text = self.text[self.pos:] + self.decoder.decode(b'', final=True)
+    else:
+      self.text = self.text[self.pos:] + self.decoder.decode(chunk)
+    self.pos = 0
+    return True
+
+  def peek(self) -> str:
+    """next non-whitespace character ('' at the end)"""
+    while True:
+      while self.pos < len(self.text) and self.text[self.pos] in _ws:
+        self.pos += 1
+      if self.pos < len(self.text):
+        return self.text[self.pos]
+      if not self.fill():
+        return ''
+
+  def expect(self, char: str):
+    if self.peek() != char:
+      raise Exception(f"invalid listing: expected {char!r}, got {self.peek()!r}")
+    self.pos += 1
+
+  def value(self, decoder: json.JSONDecoder) -> typing.Any:
+    """decode the next value, reading more until it is complete. A value is
+    only taken once something follows it: `12` might still become `123`."""
+    self.peek()
+    while True:
+      try:
+        value, end = decoder.raw_decode(self.text, self.pos)
+      except json.JSONDecodeError:
+        if not self.fill():
+          raise
+        continue
+      if end < len(self.text) or self.eof:
+        self.pos = end
+        return value
+      self.fill()
+
+
+def iter_data(chunks: typing.Iterable[bytes]) -> typing.Iterator[typing.Any]:
+  """Yield the elements of the `data` array of an API response (or of a
+  bare array) while the response is still arriving. Other keys are decoded
+  and dropped, elements are only held one at a time.
+
+  :param chunks: the response body, e.g. `Response.iter_content`
+  """
+  buf = _Buffer(chunks)
+  decoder = json.JSONDecoder()
+
+  def elements():
+    buf.expect('[')
+    if buf.peek() == ']':
+      buf.pos += 1
+      return
+    while True:
+      yield buf.value(decoder)
+      if buf.peek() == ',':
+        buf.pos += 1
+      else:
+        buf.expect(']')
+        return
+
+  if buf.peek() == '[':
+    yield from elements()
+    return
+  buf.expect('{')
+  if buf.peek() == '}':
+    return
+  while True:
+    key = buf.value(decoder)
+    buf.expect(':')
+    if key == 'data' and buf.peek() == '[':
+      yield from elements()
+    elif key == 'data':
+      raise Exception(f"invalid listing: data is not a list")
+    else:
+      buf.value(decoder)
+    if buf.peek() == ',':
+      buf.pos += 1
+    else:
+      buf.expect('}')
+      return
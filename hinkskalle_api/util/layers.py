@@ -0,0 +1,200 @@
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import typing
+import zlib
+
+if typing.TYPE_CHECKING:
+  import tarfile
+
+logger = logging.getLogger()
+
+LAYER_MODES = ('subdirs', 'size')
+DEFAULT_LAYER_SIZE = 1024*1024*1024
+
+
+class Layer:
+  """Part of a directory that goes into its own tar layer.
+
+  :param name: layer title, e.g. `run/subdir`
+  :param entries: (path, lstat) of everything in the layer
+  """
+  def __init__(self, name: str, entries: typing.Optional[typing.List[typing.Tuple[str, os.stat_result]]] = None):
+    self.name = name
+    self.entries = entries if entries is not None else []
+
+  @property
+  def size(self) -> int:
+    return sum(st.st_size for _, st in self.entries if stat.S_ISREG(st.st_mode))
+
+  def __repr__(self):
+    return f"Layer({self.name}, {len(self.entries)} entries)"
+
+
+def split_layers(directory: str, entries: typing.List[typing.Tuple[str, os.stat_result]], mode: str = 'subdirs', layer_size: int = DEFAULT_LAYER_SIZE) -> typing.List[Layer]:
+  """Split the scan result of directory into layers.
+
+  subdirs: one layer per top level subdirectory, files directly in
+  directory go into a layer of their own.
+
+  size: files in path order, a new layer is started when the current one
+  holds layer_size bytes. To keep a new or resized file from shifting all
+  later boundaries, a layer is also closed after a file whose path hashes
+  to a boundary once it holds a quarter of layer_size. Unchanged stretches
+  of the tree then end up in the same layers again.
+  """
+  directory = directory.rstrip('/') or directory
+  base = os.path.basename(directory) or directory
+  entries = sorted(entries, key=lambda e: e[0])
+  if mode == 'subdirs':
+    layers: typing.Dict[str, Layer] = {}
+    for path, st in entries:
+      rel = os.path.relpath(path, directory)
+      top = rel.split(os.sep, 1)[0] if os.sep in rel else ''
+      name = f"{base}/{top}" if top else base
+      layers.setdefault(name, Layer(name)).entries.append((path, st))
+    return list(layers.values())
+  elif mode == 'size':
+    buckets: typing.List[Layer] = []
+    current: typing.Optional[Layer] = None
+    current_size = 0
+    for path, st in entries:
+      if current is None:
+        current = Layer(f"{base}/{len(buckets)+1}")
+        buckets.append(current)
+        current_size = 0
+      current.entries.append((path, st))
+      current_size += st.st_size if stat.S_ISREG(st.st_mode) else 0
+      rel = os.path.relpath(path, directory)
+      if current_size >= layer_size or (current_size >= layer_size // 4 and zlib.crc32(rel.encode('utf8')) % 8 == 0):
+        current = None
+    return buckets
+  raise Exception(f"unknown layer mode {mode}, use one of {', '.join(LAYER_MODES)}")
+
+
+def extract_tar(fileobj: typing.BinaryIO, dest: str):
+  """Unpack a (decompressed) tar stream into dest.
+
+  Members that would end up outside of dest (absolute paths, `..`, links
+  pointing outside) are refused.
+  """
+  import tarfile
+  dest = os.path.realpath(dest)
+  with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+    if hasattr(tarfile, 'data_filter'):
+      tar.extraction_filter = tarfile.data_filter # type: ignore
+      tar.extractall(dest)
+      return
+    for member in tar:
+      check_member(member, dest)
+      tar.extract(member, dest)
+
+
+def check_member(member: 'tarfile.TarInfo', dest: str):
+  target = os.path.realpath(os.path.join(dest, member.name))
+  if os.path.isabs(member.name) or os.path.commonpath([ dest, target ]) != dest:
+    raise Exception(f"refusing to extract {member.name} outside of {dest}")
+  if member.issym() or member.islnk():
+    link = os.path.join(os.path.dirname(target), member.linkname) if member.issym() else os.path.join(dest, member.linkname)
+    if os.path.isabs(member.linkname) or os.path.commonpath([ dest, os.path.realpath(link) ]) != dest:
+      raise Exception(f"refusing to extract link {member.name} -> {member.linkname} outside of {dest}")
+  if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+    raise Exception(f"refusing to extract special file {member.name}")
+
+
+def is_archive(layer: dict) -> bool:
+  """Whether a manifest layer is a directory archive that should be unpacked."""
+  annotations = layer.get('annotations') or {}
+  # oras only unpacks gzip, zstd layers come from hinkli
+  return annotations.get('io.deis.oras.content.unpack') == 'true' or (layer.get('mediaType') or '').endswith('+zstd')
+
+
+class HashingReader:
+  """File-like view of a stream of chunks (e.g. `Response.iter_content`)
+  that hashes every byte passing through.
+
+  :param chunks: the data
+  :param progress: called with the number of bytes taken from chunks
+  """
+  def __init__(self, chunks: typing.Iterable[bytes], progress: typing.Optional[typing.Callable[[int], typing.Any]] = None):
+    self.chunks = iter(chunks)
+    self.progress = progress
+    self.hl = hashlib.sha256()
+    self.length = 0
+    self._buf = bytearray()
+
+  def _next(self) -> bool:
+    chunk = next(self.chunks, None)
+    if chunk is None:
+      return False
+    self.hl.update(chunk)
+    self.length += len(chunk)
+    if self.progress:
+      self.progress(len(chunk))
+    self._buf += chunk
+    return True
+
+  def readable(self) -> bool:
+    return True
+
+  def read(self, size: typing.Optional[int] = -1) -> bytes:
+    if size is None or size < 0:
+      while self._next():
+        pass
+      size = len(self._buf)
+    while len(self._buf) < size and self._next():
+      pass
+    data = bytes(self._buf[:size])
+    del self._buf[:size]
+    return data
+
+  def drain(self):
+    """Hash whatever the consumer did not read (archive padding, trailers)."""
+    self._buf.clear()
+    while self._next():
+      self._buf.clear()
+
+  @property
+  def digest(self) -> str:
+    return f"sha256:{self.hl.hexdigest()}"
+
+
+class StagingDir:
+  """Unpack into a hidden directory next to the target, move the results
+  into place only when everything arrived and checked out.
+
+  ```python
+  with StagingDir(out) as staging:
+    extract_tar(..., staging.path)
+    staging.commit()
+  ```
+
+  Leaving the block without commit() removes everything.
+  """
+  def __init__(self, dest: str):
+    self.dest = dest
+    os.makedirs(dest, exist_ok=True)
+    self.path = tempfile.mkdtemp(dir=dest, prefix='.hinkli-unpack-')
+    self.keep = False
+
+  def commit(self) -> typing.List[str]:
+    entries = sorted(os.listdir(self.path))
+    conflicts = [ e for e in entries if os.path.lexists(os.path.join(self.dest, e)) ]
+    if conflicts:
+      self.keep = True
+      raise Exception(f"{', '.join(os.path.join(self.dest, c) for c in conflicts)} already exist(s), not overwriting. The download is in {self.path}")
+    for entry in entries:
+      os.rename(os.path.join(self.path, entry), os.path.join(self.dest, entry))
+    os.rmdir(self.path)
+    return [ os.path.join(self.dest, e) for e in entries ]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    if os.path.isdir(self.path) and not self.keep:
+      shutil.rmtree(self.path, ignore_errors=True)
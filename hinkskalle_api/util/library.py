@@ -0,0 +1,19 @@
+import typing
+
+
+def split_tagged_container(container: str) -> typing.Tuple[typing.Optional[str], str, str, typing.Optional[str]]:
+  if ':' in container:
+    container, tag = container.split(':')
+  else:
+    tag = None
+  entity, collection, container = split_container(container)
+  return entity, collection, container, tag
+
+def split_container(container: str) -> typing.Tuple[typing.Optional[str], str, str]:
+  el = container.split('/')
+  if len(el) == 3:
+    return el[0], el[1], el[2]
+  elif len(el) == 2:
+    return None, el[0], el[1]
+  else:
+    return None, 'default', container
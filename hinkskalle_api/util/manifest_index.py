@@ -0,0 +1,32 @@
+import typing
+
+from ..auto.models import Manifest
+
+
+class ManifestIndex:
+  """Tag and hash lookup tables for the manifests of one container.
+
+  Built once from a manifest listing, afterwards each lookup is a dict
+  access. As with a scan through the listing, the first manifest carrying
+  a tag wins.
+
+  :param manifests: result of HinkApi.list_manifests
+  """
+  def __init__(self, manifests: typing.List[Manifest]):
+    self.manifests = manifests
+    self.by_tag: typing.Dict[str, Manifest] = {}
+    self.by_hash: typing.Dict[str, Manifest] = {}
+    for m in manifests:
+      for tag in m.tags:
+        self.by_tag.setdefault(tag, m)
+      if m.hash:
+        self.by_hash.setdefault(m.hash, m)
+
+  def resolve(self, tag: typing.Optional[str] = None, hash: typing.Optional[str] = None) -> typing.Optional[Manifest]:
+    found = self.by_tag.get(tag) if tag else None
+    if not found and hash:
+      found = self.by_hash.get(hash) or self.by_hash.get(hash.replace('sha256:', '', 1))
+    return found
+
+  def __len__(self):
+    return len(self.manifests)
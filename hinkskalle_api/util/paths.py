@@ -0,0 +1,14 @@
+import os
+import os.path
+import typing
+
+def user_cache_dir(override: typing.Optional[str] = None) -> str:
+  """Base directory for hinkli's local caches.
+
+  `override` (hink_api_cache_dir from the config) wins, then
+  `$XDG_CACHE_HOME/hinkskalle_api`, then `~/.cache/hinkskalle_api`.
+  """
+  if override:
+    return os.path.expanduser(override)
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+  return os.path.join(base, 'hinkskalle_api')
@@ -0,0 +1,186 @@
+import logging
+import os
+import re
+import stat
+import time
+import typing
+
+from humanize import naturalsize
+
+logger = logging.getLogger()
+
+Pattern = typing.Union[typing.Pattern, str]
+
+
+def gitignore_to_regex(pattern: str) -> typing.Tuple[str, bool, bool]:
+  """Translate a gitignore line into a regex on paths relative to the root.
+
+  Supports `*`, `?`, `[...]`, `**`, anchoring with `/`, `!` negation and
+  trailing `/` for directories only.
+
+  :return: regex, negated, directories only
+  """
+  negate = pattern.startswith('!')
+  if negate:
+    pattern = pattern[1:]
+  elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+    pattern = pattern[1:]
+  dir_only = pattern.endswith('/')
+  pattern = pattern.rstrip('/')
+  anchored = '/' in pattern
+  pattern = pattern.lstrip('/')
+
+  out = ''
+  i = 0
+  while i < len(pattern):
+    if pattern.startswith('**/', i):
+      out += '(?:.*/)?'
+      i += 3
+    elif pattern.startswith('/**', i) and i+3 == len(pattern):
+      out += '/.*'
+      i += 3
+    elif pattern.startswith('**', i):
+      out += '.*'
+      i += 2
+    elif pattern[i] == '*':
+      out += '[^/]*'
+      i += 1
+    elif pattern[i] == '?':
+      out += '[^/]'
+      i += 1
+    elif pattern[i] == '[' and ']' in pattern[i+2:]:
+      end = pattern.index(']', i+2)
+      cls = pattern[i+1:end]
+      if cls.startswith('!'):
+        cls = '^' + cls[1:]
+      out += f"[{cls}]"
+      i = end+1
+    else:
+      out += re.escape(pattern[i])
+      i += 1
+  prefix = '^' if anchored else '^(?:.*/)?'
+  return prefix + out + '$', negate, dir_only
+
+
+def _combine(patterns: typing.List[str]) -> typing.Optional[typing.Pattern]:
+  if not patterns:
+    return None
+  return re.compile('|'.join(f'(?:{p})' for p in patterns))
+
+
+class ExcludeMatcher:
+  """Decides which paths to leave out when packing a directory.
+
+  In the default mode the patterns are regexes searched in the path (as
+  given to the scanner, e.g. `dir/sub/file`), all of them are combined into
+  one compiled regex. With `gitignore` they are gitignore-style globs
+  matched against the path relative to the packed directory; as in git the
+  last matching line wins, so `!pattern` can re-include files.
+
+  :param patterns: regexes or gitignore lines
+  :param gitignore: use gitignore semantics
+  """
+  def __init__(self, patterns: typing.Sequence[Pattern] = [], gitignore: bool = False):
+    self.gitignore = gitignore
+    self._rules: typing.List[typing.Tuple[typing.Pattern, bool, bool]] = []
+    self._regex: typing.Optional[typing.Pattern] = None
+    self._dir_regex: typing.Optional[typing.Pattern] = None
+    self._ordered = False
+    if gitignore:
+      for pat in patterns:
+        pat = pat.pattern if hasattr(pat, 'pattern') else pat
+        if not pat.strip() or pat.startswith('#'):
+          continue
+        regex, negate, dir_only = gitignore_to_regex(pat.rstrip())
+        self._rules.append((re.compile(regex), negate, dir_only))
+      self._ordered = any(negate for _, negate, _ in self._rules)
+      if not self._ordered:
+        self._regex = _combine([ r.pattern for r, _, dir_only in self._rules if not dir_only ])
+        self._dir_regex = _combine([ r.pattern for r, _, dir_only in self._rules if dir_only ])
+    else:
+      compiled = [ re.compile(pat) for pat in patterns ]
+      self._rules = [ (pat, False, False) for pat in compiled ]
+      try:
+        if compiled and len(set(p.flags for p in compiled)) == 1:
+          self._regex = re.compile('|'.join(f'(?:{p.pattern})' for p in compiled), compiled[0].flags)
+        else:
+          self._ordered = bool(compiled)
+      except re.error:
+        # e.g. duplicate group names, match one by one
+        self._ordered = True
+
+  def __bool__(self):
+    return bool(self._rules)
+
+  def excluded(self, path: str, relpath: str, is_dir: bool = False) -> bool:
+    if self.gitignore:
+      if self._ordered:
+        result = False
+        for regex, negate, dir_only in self._rules:
+          if dir_only and not is_dir:
+            continue
+          if regex.match(relpath):
+            result = not negate
+        return result
+      if self._regex and self._regex.match(relpath):
+        return True
+      return bool(is_dir and self._dir_regex and self._dir_regex.match(relpath))
+    if self._ordered:
+      return any(regex.search(path) for regex, _, _ in self._rules)
+    return bool(self._regex and self._regex.search(path))
+
+
+class ScanResult:
+  def __init__(self):
+    self.entries: typing.List[typing.Tuple[str, os.stat_result]] = []
+    self.files = 0
+    self.dirs = 0
+    self.excluded = 0
+    self.total_size = 0
+    self.elapsed = 0.0
+
+  def __str__(self):
+    rate = self.files / self.elapsed if self.elapsed > 0 else 0
+    return f"{self.files} files in {self.dirs} directories ({naturalsize(self.total_size)}), {self.excluded} excluded, {self.elapsed:.1f}s ({rate:.0f} files/s)"
+
+
+def scan_tree(directory: str, matcher: typing.Optional[ExcludeMatcher] = None) -> ScanResult:
+  """Collect everything below directory that is not excluded.
+
+  Uses os.scandir and keeps the lstat result of each entry, excluded
+  directories are not descended into. Directories themselves are not
+  returned, symlinks are returned as they are (not followed).
+  """
+  result = ScanResult()
+  start = time.monotonic()
+  stack = [ (directory, '') ]
+  while stack:
+    dirpath, reldir = stack.pop()
+    try:
+      it = os.scandir(dirpath)
+    except OSError as err:
+      logger.warning(f"cannot read {dirpath}: {err}")
+      continue
+    with it:
+      for entry in it:
+        relpath = f"{reldir}/{entry.name}" if reldir else entry.name
+        try:
+          is_dir = entry.is_dir(follow_symlinks=False)
+          if matcher and matcher.excluded(entry.path, relpath, is_dir):
+            logger.debug(f"excluding {entry.path}")
+            result.excluded += 1
+            continue
+          if is_dir:
+            result.dirs += 1
+            stack.append((entry.path, relpath))
+            continue
+          st = entry.stat(follow_symlinks=False)
+        except OSError as err:
+          logger.warning(f"cannot read {entry.path}: {err}")
+          continue
+        result.files += 1
+        if stat.S_ISREG(st.st_mode):
+          result.total_size += st.st_size
+        result.entries.append((entry.path, st))
+  result.elapsed = time.monotonic() - start
+  return result
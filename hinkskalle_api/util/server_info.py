@@ -0,0 +1,71 @@
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+import typing
+
+logger = logging.getLogger()
+
+DEFAULT_TTL = 86400
+
+
+class ServerInfo:
+  """Remembers what a server can do (e.g. which optional routes it has), so
+  that every invocation does not have to find out again.
+
+  Entries are keyed by base URL and feature and expire after `ttl` seconds,
+  in case the server gets upgraded.
+
+  :param path: cache file
+  :param ttl: seconds an entry is valid
+  """
+  def __init__(self, path: str, ttl: float = DEFAULT_TTL):
+    self.path = path
+    self.ttl = ttl
+
+  def _load(self) -> dict:
+    try:
+      with open(self.path, 'r') as fh:
+        entries = json.load(fh).get('entries', {})
+      return entries if isinstance(entries, dict) else {}
+    except FileNotFoundError:
+      return {}
+    except (ValueError, AttributeError) as err:
+      logger.debug(f"server info {self.path} unreadable, starting over: {err}")
+      return {}
+
+  def _save(self, entries: dict):
+    now = time.time()
+    entries = { k: v for k, v in entries.items() if v.get('expires', 0) > now }
+    try:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.server')
+      try:
+        with os.fdopen(fd, 'w') as fh:
+          json.dump({ 'version': 1, 'entries': entries }, fh)
+        os.replace(tmpfn, self.path)
+      except:
+        os.unlink(tmpfn)
+        raise
+    except OSError as err:
+      logger.debug(f"could not write server info: {err}")
+
+  @staticmethod
+  def _key(base: str, feature: str) -> str:
+    return f"{base} {feature}"
+
+  def lookup(self, base: str, feature: str) -> typing.Any:
+    """Returns what was stored for feature, None if unknown or expired."""
+    entry = self._load().get(self._key(base, feature))
+    if not entry or entry.get('expires', 0) <= time.time():
+      return None
+    return entry.get('value')
+
+  def store(self, base: str, feature: str, value: typing.Any):
+    if self.ttl <= 0:
+      return
+    entries = self._load()
+    entries[self._key(base, feature)] = { 'value': value, 'expires': time.time() + self.ttl }
+    self._save(entries)
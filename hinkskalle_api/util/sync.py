@@ -0,0 +1,279 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from humanize import naturalsize
+
+if typing.TYPE_CHECKING:
+  from ..api import HinkApi
+  from ..auto.models import Manifest
+
+logger = logging.getLogger()
+
+STATE_FILE = '.hinkli-sync.json'
+DEFAULT_WORKERS = 4
+
+
+class SyncFile:
+  """One file of a tag in the mirror."""
+  def __init__(self, tag: str, name: str, digest: str, size: int, url: str):
+    self.tag = tag
+    self.name = name
+    self.digest = digest
+    self.size = size
+    self.url = url
+
+  @property
+  def path(self) -> str:
+    return os.path.join(self.tag, self.name)
+
+
+class SyncState:
+  """What the last sync left in the mirror directory: per tag the manifest
+  hash and the files written for it.
+
+  :param fn: state file
+  :param container: `entity/collection/container` the mirror belongs to
+  """
+  def __init__(self, fn: str, container: str, tags: typing.Optional[dict] = None):
+    self.fn = fn
+    self.container = container
+    self.tags: typing.Dict[str, dict] = tags or {}
+
+  @classmethod
+  def load(cls, fn: str, container: str) -> 'SyncState':
+    try:
+      with open(fn) as fh:
+        data = json.load(fh)
+    except FileNotFoundError:
+      return cls(fn, container)
+    if data.get('container') != container:
+      raise Exception(f"{os.path.dirname(fn) or '.'} is a mirror of {data.get('container')}, not {container}")
+    return cls(fn, container, data.get('tags'))
+
+  def save(self):
+    tmp = f"{self.fn}.tmp"
+    with open(tmp, 'w') as fh:
+      json.dump({ 'container': self.container, 'tags': self.tags }, fh, indent=2, sort_keys=True)
+    os.replace(tmp, self.fn)
+
+  def files(self) -> typing.Iterator[typing.Tuple[str, str, dict]]:
+    """(tag, name, { digest, size }) of every file"""
+    for tag, entry in self.tags.items():
+      for name, f in entry.get('files', {}).items():
+        yield tag, name, f
+
+
+class SyncReport:
+  def __init__(self):
+    self.downloaded: typing.List[str] = []
+    self.linked: typing.List[str] = []
+    self.unchanged: typing.List[str] = []
+    self.removed: typing.List[str] = []
+    self.size = 0
+    self.seconds = 0.0
+
+  def __str__(self):
+    return f"{len(self.downloaded)} downloaded ({naturalsize(self.size)}), {len(self.linked)} linked, {len(self.unchanged)} unchanged, {len(self.removed)} removed in {self.seconds:.1f}s"
+
+
+def _safe_name(name: str, what: str) -> str:
+  if not name or name in ('.', '..') or '/' in name or '\0' in name or name.startswith('.hinkli'):
+    raise Exception(f"refusing to use {what} {name!r} as a file name")
+  return name
+
+
+class ContainerSync:
+  """Keeps a local directory in step with the tags of a container.
+
+  Each tag becomes a directory in out holding the layers of its manifest
+  (under their title, `/` replaced by `_`). A state file in out records the
+  manifest hash and blob digest of everything written, so a second run
+  only needs the manifest listing to see that nothing changed.
+
+  Blobs that are already somewhere in the mirror are hardlinked instead of
+  downloaded again, so tags pointing at the same data share their files.
+  Changed files are downloaded to a temporary file, checked and renamed
+  into place, which never touches the other links. With prune, tags that
+  are gone from the server are removed locally as well.
+
+  :param api: client to use
+  :param out: mirror directory
+  :param workers: parallel downloads
+  :param prune: remove tags that no longer exist on the server
+  :param on_file: called with (action, path) for every file touched
+  """
+  def __init__(self, api: 'HinkApi', container: str, collection: str, entity: str, out: str, workers: int = DEFAULT_WORKERS, prune=False, on_file: typing.Optional[typing.Callable[[str, str], typing.Any]] = None):
+    self.api = api
+    self.container = container
+    self.collection = collection
+    self.entity = entity
+    self.out = out
+    self.workers = workers
+    self.prune = prune
+    self.on_file = on_file
+    self.report = SyncReport()
+
+  def _done(self, action: str, path: str):
+    getattr(self.report, action).append(path)
+    if self.on_file:
+      self.on_file(action, path)
+
+  def _wanted(self, manifests: typing.Iterable['Manifest']) -> typing.Dict[str, typing.Tuple['Manifest', typing.List[SyncFile]]]:
+    """tag -> (manifest, files) from the server listing"""
+    base = f"{self.api.base}/v2/{self.entity}/{self.collection}/{self.container}/blobs"
+    wanted: typing.Dict[str, typing.Tuple['Manifest', typing.List[SyncFile]]] = {}
+    for m in manifests:
+      layers = (m.content or {}).get('layers') or []
+      for tag in m.tags:
+        # the first manifest carrying a tag wins, as in ManifestIndex
+        if tag in wanted:
+          continue
+        _safe_name(tag, 'tag')
+        if layers:
+          files = [ SyncFile(tag, _safe_name(((l.get('annotations') or {}).get('org.opencontainers.image.title') or l['digest']).replace('/', '_').replace(':', '_'), 'layer title'), l['digest'], int(l.get('size', 0)), f"{base}/{l['digest']}") for l in layers ]
+        else:
+          if not m.filename or not m.images:
+            logger.warning(f"{tag}: no layers and no file, skipping")
+            continue
+          files = [ SyncFile(tag, _safe_name(os.path.basename(m.filename), 'file name'), typing.cast(str, m.images[0]), m.total_size or 0, f"{self.api.base}/v1/manifests/{m.id}/download") ]
+        wanted[tag] = (m, files)
+    return wanted
+
+  def _have(self, state: SyncState) -> typing.Dict[str, str]:
+    """blob digest -> a path in the mirror that still holds it"""
+    have: typing.Dict[str, str] = {}
+    for tag, name, f in state.files():
+      path = os.path.join(self.out, tag, name)
+      if f['digest'] not in have and _intact(path, f['size']):
+        have[f['digest']] = path
+    return have
+
+  def _download(self, f: SyncFile) -> str:
+    """fetch f into a temporary file in the mirror, returns its name"""
+    fd, tmp = tempfile.mkstemp(dir=self.out, prefix='.hinkli-sync-')
+    try:
+      hl = hashlib.sha256()
+      with os.fdopen(fd, 'wb') as fh, self.api.session.get(f.url, headers=self.api._make_headers(), stream=True) as ret:
+        if ret.status_code != 200:
+          self.api.handle_error(ret)
+        for chunk in ret.iter_content(chunk_size=self.api.hash_block_size):
+          fh.write(chunk)
+          hl.update(chunk)
+      if f"sha256:{hl.hexdigest()}" != f.digest:
+        raise Exception(f"Checksum mismatch in {f.path}: sha256:{hl.hexdigest()} != {f.digest}")
+    except:
+      os.unlink(tmp)
+      raise
+    return tmp
+
+  def run(self) -> SyncReport:
+    start = time.perf_counter()
+    os.makedirs(self.out, exist_ok=True)
+    state = SyncState.load(os.path.join(self.out, STATE_FILE), f"{self.entity}/{self.collection}/{self.container}")
+    wanted = self._wanted(self.api.iter_manifests(self.container, self.collection, self.entity))
+    have = self._have(state)
+
+    # what is missing, once per digest; the other files with it are linked
+    fetch: typing.Dict[str, typing.List[SyncFile]] = {}
+    for tag, (_, files) in wanted.items():
+      old = state.tags.get(tag, {}).get('files', {})
+      for f in files:
+        path = os.path.join(self.out, f.path)
+        if old.get(f.name, {}).get('digest') == f.digest and _intact(path, f.size):
+          self._done('unchanged', f.path)
+        else:
+          fetch.setdefault(f.digest, []).append(f)
+
+    # everything is staged next to the mirror first and renamed into place
+    # at the end, so no file is replaced while it might still be a source
+    staged: typing.List[typing.Tuple[str, SyncFile, str]] = []
+    errors: typing.List[str] = []
+    try:
+      with ThreadPoolExecutor(max_workers=self.workers) as executor:
+        downloads = { digest: executor.submit(self._download, files[0]) for digest, files in fetch.items() if digest not in have }
+        for digest, files in fetch.items():
+          if digest in have:
+            staged.extend((self._stage_link(have[digest]), f, 'linked') for f in files)
+        for digest, future in downloads.items():
+          files = fetch[digest]
+          try:
+            tmp = future.result()
+          except Exception as err:
+            errors.append(f"{files[0].path}: {err}")
+            continue
+          staged.append((tmp, files[0], 'downloaded'))
+          self.report.size += files[0].size
+          staged.extend((self._stage_link(tmp), f, 'linked') for f in files[1:])
+      while staged:
+        tmp, f, action = staged.pop(0)
+        dest = os.path.join(self.out, f.path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(tmp, dest)
+        state.tags.setdefault(f.tag, { 'files': {} }).setdefault('files', {})[f.name] = { 'digest': f.digest, 'size': f.size }
+        self._done(action, f.path)
+    finally:
+      for tmp, _, _ in staged:
+        os.unlink(tmp)
+      # whatever made it so far is recorded, the next run picks up the rest
+      self._cleanup(state, wanted)
+      state.save()
+    self.report.seconds = time.perf_counter() - start
+    if errors:
+      raise Exception(f"{len(errors)} download(s) failed: {'; '.join(errors)}")
+    return self.report
+
+  def _stage_link(self, src: str) -> str:
+    """hardlink (or, where that fails, copy) src to a temporary name"""
+    fd, tmp = tempfile.mkstemp(dir=self.out, prefix='.hinkli-sync-')
+    os.close(fd)
+    os.unlink(tmp)
+    try:
+      os.link(src, tmp)
+    except OSError:
+      # no hardlinks here (FAT, some network filesystems)
+      shutil.copyfile(src, tmp)
+    return tmp
+
+  def _cleanup(self, state: SyncState, wanted: dict):
+    for tag in list(state.tags):
+      if tag in wanted:
+        manifest, files = wanted[tag]
+        names = { f.name for f in files }
+        entry = state.tags[tag]
+        stale = [ n for n in entry.get('files', {}) if n not in names ]
+        for name in stale:
+          self._remove(os.path.join(tag, name))
+          del entry['files'][name]
+        if all(entry['files'].get(f.name, {}).get('digest') == f.digest for f in files):
+          entry['manifest'] = manifest.hash
+      elif self.prune:
+        for name in state.tags[tag].get('files', {}):
+          self._remove(os.path.join(tag, name))
+        try:
+          os.rmdir(os.path.join(self.out, tag))
+        except OSError:
+          pass
+        del state.tags[tag]
+
+  def _remove(self, path: str):
+    try:
+      os.unlink(os.path.join(self.out, path))
+    except FileNotFoundError:
+      pass
+    self._done('removed', path)
+
+
+def _intact(path: str, size: int) -> bool:
+  try:
+    return os.stat(path).st_size == size
+  except OSError:
+    return False
+
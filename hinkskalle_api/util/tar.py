@@ -0,0 +1,102 @@
+import os
+import stat
+import tarfile
+import typing
+
+try:
+  import grp
+  import pwd
+except ImportError:
+  grp = pwd = None # type: ignore
+
+
+class TarInfoFactory:
+  """Builds TarInfo headers from stat results we already have.
+
+  Same as `TarFile.gettarinfo`, but without another lstat per file and
+  with user/group name lookups cached.
+
+  :param tar: archive the headers are for (hardlinks are tracked there)
+  :param names: look up user and group names
+  """
+  def __init__(self, tar: tarfile.TarFile, names: bool = True):
+    self.tar = tar
+    self.names = names
+    self._unames: typing.Dict[int, str] = {}
+    self._gnames: typing.Dict[int, str] = {}
+
+  def _uname(self, uid: int) -> str:
+    if uid not in self._unames:
+      try:
+        self._unames[uid] = pwd.getpwuid(uid)[0] if pwd else ''
+      except KeyError:
+        self._unames[uid] = ''
+    return self._unames[uid]
+
+  def _gname(self, gid: int) -> str:
+    if gid not in self._gnames:
+      try:
+        self._gnames[gid] = grp.getgrgid(gid)[0] if grp else ''
+      except KeyError:
+        self._gnames[gid] = ''
+    return self._gnames[gid]
+
+  def create(self, name: str, st: os.stat_result) -> typing.Optional[tarfile.TarInfo]:
+    arcname = os.path.splitdrive(name)[1].replace(os.sep, '/').lstrip('/')
+    info = self.tar.tarinfo()
+    info.tarfile = self.tar # type: ignore
+    linkname = ''
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+      inode = (st.st_ino, st.st_dev)
+      if st.st_nlink > 1 and inode in self.tar.inodes and arcname != self.tar.inodes[inode]:
+        type = tarfile.LNKTYPE
+        linkname = self.tar.inodes[inode]
+      else:
+        type = tarfile.REGTYPE
+        if inode[0]:
+          self.tar.inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+      type = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+      type = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+      type = tarfile.SYMTYPE
+      linkname = os.readlink(name)
+    elif stat.S_ISCHR(mode):
+      type = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+      type = tarfile.BLKTYPE
+    else:
+      return None
+
+    info.name = arcname
+    info.mode = mode
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.size = st.st_size if type == tarfile.REGTYPE else 0
+    info.mtime = st.st_mtime
+    info.type = type
+    info.linkname = linkname
+    if self.names:
+      info.uname = self._uname(st.st_uid)
+      info.gname = self._gname(st.st_gid)
+    if type in (tarfile.CHRTYPE, tarfile.BLKTYPE) and hasattr(os, 'major'):
+      info.devmajor = os.major(st.st_rdev)
+      info.devminor = os.minor(st.st_rdev)
+    return info
+
+
+def reproducible_tarinfo(epoch: typing.Optional[int] = None) -> typing.Callable[[tarfile.TarInfo], tarfile.TarInfo]:
+  """tarfile filter that strips everything from the tar headers that would
+  differ between two packings of the same tree: ownership and sub-second
+  mtimes. With `epoch` (or SOURCE_DATE_EPOCH) all mtimes are set to it.
+  """
+  if epoch is None and os.environ.get('SOURCE_DATE_EPOCH'):
+    epoch = int(os.environ['SOURCE_DATE_EPOCH'])
+  def normalize(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    info.mtime = epoch if epoch is not None else int(info.mtime)
+    return info
+  return normalize
@@ -0,0 +1,102 @@
+import threading
+import typing
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class TransportStats:
+  """Counts requests and newly opened connections of a HinkSession.
+
+  Every request checks out a connection from the pool, only some of them
+  have to be opened (TCP/TLS handshake) first. The rest were reused.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.requests = 0
+    self.connections = 0
+
+  def count_request(self):
+    with self._lock:
+      self.requests += 1
+
+  def count_connection(self):
+    with self._lock:
+      self.connections += 1
+
+  @property
+  def reused(self) -> int:
+    return max(self.requests - self.connections, 0)
+
+  def __str__(self):
+    return f"{self.requests} requests, {self.connections} new connections, {self.reused} reused"
+
+
+class _CountingPoolMixin:
+  stats: TransportStats
+
+  def _get_conn(self, timeout=None):
+    self.stats.count_request()
+    return super()._get_conn(timeout=timeout) # type: ignore
+
+  def _new_conn(self):
+    self.stats.count_connection()
+    return super()._new_conn() # type: ignore
+
+
+class CountingAdapter(HTTPAdapter):
+  """HTTPAdapter whose connection pools report to a TransportStats instance."""
+  def __init__(self, stats: TransportStats, **kwargs):
+    self.stats = stats
+    super().__init__(**kwargs)
+
+  def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+    super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+    stats = self.stats
+    http_cls = type('CountingHTTPConnectionPool', (_CountingPoolMixin, HTTPConnectionPool), { 'stats': stats })
+    https_cls = type('CountingHTTPSConnectionPool', (_CountingPoolMixin, HTTPSConnectionPool), { 'stats': stats })
+    self.poolmanager.pool_classes_by_scheme = { 'http': http_cls, 'https': https_cls }
+
+
+class HinkSession(requests.Session):
+  """requests.Session with a tunable, instrumented connection pool.
+
+  :param pool_connections: number of per-host pools to keep around
+  :param pool_maxsize: connections kept open per host
+  :param pool_block: block instead of opening extra connections when a
+    host's pool is exhausted (hard per-host limit)
+  :param keep_alive: reuse connections between requests
+  """
+  def __init__(self, pool_connections: int = 4, pool_maxsize: int = 8, pool_block: bool = False, keep_alive: bool = True):
+    super().__init__()
+    self.stats = TransportStats()
+    self.pool_connections = pool_connections
+    self.pool_block = pool_block
+    self._mount_adapter(pool_maxsize)
+    if not keep_alive:
+      self.headers['Connection'] = 'close'
+
+  def _mount_adapter(self, pool_maxsize: int):
+    self.pool_maxsize = pool_maxsize
+    adapter = CountingAdapter(self.stats, pool_connections=self.pool_connections, pool_maxsize=pool_maxsize, pool_block=self.pool_block)
+    self.mount('http://', adapter)
+    self.mount('https://', adapter)
+
+  def ensure_pool_size(self, connections: int):
+    """Grow the per-host pool so that `connections` parallel requests can keep their connections."""
+    if connections > self.pool_maxsize:
+      old = self.get_adapter('https://')
+      self._mount_adapter(connections)
+      old.close()
+
+  @classmethod
+  def from_config(cls, cfg: dict) -> 'HinkSession':
+    kwargs: typing.Dict[str, typing.Any] = {}
+    for key in ('pool_connections', 'pool_maxsize'):
+      if cfg.get(f'hink_api_{key}') is not None:
+        kwargs[key] = int(cfg[f'hink_api_{key}'])
+    for key in ('pool_block', 'keep_alive'):
+      if cfg.get(f'hink_api_{key}') is not None:
+        kwargs[key] = bool(cfg[f'hink_api_{key}'])
+    return cls(**kwargs)
@@ -0,0 +1,246 @@
+import hashlib
+import logging
+import os
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+
+logger = logging.getLogger()
+
+DEFAULT_CHUNK_SIZE = 64*1024*1024
+
+
+def upload_offset(range: typing.Optional[str], acknowledged: bool) -> int:
+  """Offset up to which an upload session has the data, from the `Range`
+  header of its status. An empty session reports 0-0 as well, so that only
+  counts as one byte once the server acknowledged a chunk."""
+  if not range:
+    return 0
+  end = int(range.split('-')[1])
+  if end == 0 and not acknowledged:
+    return 0
+  return end+1
+
+
+class UploadError(Exception):
+  def __init__(self, message: str, status_code: typing.Optional[int] = None):
+    super().__init__(message)
+    self.status_code = status_code
+
+
+class ChunkedUpload:
+  """Upload a blob through an OCI upload session.
+
+  Starts a session with POST, sends the data in PATCH requests of
+  `chunk_size` bytes and finishes with a PUT carrying the digest. After an
+  error the acknowledged offset is requested from the server and the upload
+  continues from there.
+
+  With `connections` > 1 several chunks are in flight at once. That needs a
+  server that accepts chunks out of order, if it answers with 416 we go back
+  to sending one chunk at a time.
+
+  :param session: HinkSession (or any requests.Session) to use
+  :param url: blob upload url (`.../v2/<entity>/<collection>/<container>/blobs/uploads/`)
+  :param headers: extra headers (Authorization)
+  :param data: file to upload, must be seekable
+  :param size: size of data
+  :param digest: sha256 hexdigest of data
+  :param params: extra query parameters (private, expiresAt)
+  :param chunk_size: bytes per PATCH
+  :param connections: chunks in flight at once
+  :param retries: how often to resume after an error
+  :param progress: called with the number of bytes acknowledged
+  """
+  def __init__(self, session: requests.Session, url: str, headers: dict, data: typing.BinaryIO, size: int, digest: str, params: dict = {}, chunk_size: int = DEFAULT_CHUNK_SIZE, connections: int = 1, retries: int = 3, progress: typing.Optional[typing.Callable[[int], typing.Any]] = None):
+    self.session = session
+    self.url = url
+    self.headers = headers
+    self.data = data
+    self.size = size
+    self.digest = digest
+    self.params = params
+    self.chunk_size = chunk_size
+    self.connections = connections
+    self.retries = retries
+    self.location: typing.Optional[str] = None
+    # whether the server took any chunk, see status()
+    self._acknowledged = False
+    self._progress = progress
+    self._lock = threading.Lock()
+
+  def progress(self, length: int):
+    if self._progress:
+      with self._lock:
+        self._progress(length)
+
+  def _check(self, ret: requests.Response, what: str, ok: typing.Tuple[int, ...]):
+    if ret.status_code not in ok:
+      raise UploadError(f"{what} failed with status {ret.status_code}: {ret.text[:200]}", ret.status_code)
+    if ret.headers.get('Location'):
+      self.location = urljoin(self.url, ret.headers['Location'])
+
+  def _read(self, start: int, length: int) -> bytes:
+    try:
+      return os.pread(self.data.fileno(), length, start)
+    except (AttributeError, OSError, ValueError):
+      with self._lock:
+        self.data.seek(start)
+        return self.data.read(length)
+
+  def start(self) -> str:
+    ret = self.session.post(self.url, params=self.params, headers=self.headers)
+    self._check(ret, 'starting upload', (requests.codes.accepted,))
+    if not self.location:
+      raise UploadError("no upload location returned")
+    logger.debug(f"upload session at {self.location}")
+    return self.location
+
+  def status(self) -> int:
+    """Returns the offset up to which the server has the data."""
+    ret = self.session.get(typing.cast(str, self.location), headers=self.headers)
+    self._check(ret, 'upload status', (requests.codes.no_content, requests.codes.accepted))
+    return upload_offset(ret.headers.get('Range'), self._acknowledged)
+
+  def _patch(self, start: int, end: int):
+    self._patch_bytes(start, self._read(start, end+1-start))
+
+  def _patch_bytes(self, start: int, chunk: bytes):
+    end = start+len(chunk)-1
+    ret = self.session.patch(typing.cast(str, self.location), data=chunk, headers={
+      **self.headers,
+      'Content-Type': 'application/octet-stream',
+      'Content-Range': f'{start}-{end}',
+      'Content-Length': str(len(chunk)),
+    })
+    self._check(ret, f'chunk {start}-{end}', (requests.codes.accepted, requests.codes.no_content))
+    self._acknowledged = True
+    self.progress(len(chunk))
+
+  def _send_from(self, offset: int):
+    chunks = [ (start, min(start+self.chunk_size, self.size)-1) for start in range(offset, self.size, self.chunk_size) ]
+    if self.connections <= 1:
+      for start, end in chunks:
+        self._patch(start, end)
+      return
+    with ThreadPoolExecutor(max_workers=self.connections) as executor:
+      futures = [ executor.submit(self._patch, start, end) for start, end in chunks ]
+      try:
+        for fut in futures:
+          fut.result()
+      except BaseException:
+        for fut in futures:
+          fut.cancel()
+        raise
+
+  def finish(self) -> requests.Response:
+    ret = self.session.put(typing.cast(str, self.location), params={ **self.params, 'digest': f"sha256:{self.digest}" }, headers={ **self.headers, 'Content-Length': '0' })
+    self._check(ret, 'finishing upload', (requests.codes.ok, requests.codes.created, requests.codes.accepted, requests.codes.no_content))
+    upload_digest = ret.headers.get('Docker-Content-Digest')
+    if upload_digest and upload_digest != f"sha256:{self.digest}":
+      raise UploadError(f"Upload checksum mismatch: {self.digest} != {upload_digest}")
+    return ret
+
+  def run(self) -> requests.Response:
+    self.start()
+    offset = 0
+    attempt = 0
+    while offset < self.size:
+      try:
+        self._send_from(offset)
+        break
+      except (UploadError, requests.exceptions.ConnectionError) as err:
+        attempt += 1
+        if attempt > self.retries:
+          raise
+        if isinstance(err, UploadError) and err.status_code == requests.codes.requested_range_not_satisfiable and self.connections > 1:
+          logger.info(f"server wants chunks in order, uploading sequentially")
+          self.connections = 1
+        offset = self.status()
+        logger.warning(f"upload broke ({err}), resuming at {offset} ({attempt}/{self.retries})")
+    return self.finish()
+
+
+class StreamingUpload(ChunkedUpload):
+  """Writable file object that uploads everything written to it through an
+  OCI upload session.
+
+  Data is hashed as it passes and sent in PATCH requests of `chunk_size`
+  bytes; the next chunk is collected while the previous one is being sent.
+  `close()` commits the upload with the digest, afterwards `digest` and
+  `size` are set.
+
+  A broken chunk is resent from the offset the server acknowledged, as long
+  as that is still within the chunk we have in memory.
+  """
+  def __init__(self, session: requests.Session, url: str, headers: dict, params: dict = {}, chunk_size: int = DEFAULT_CHUNK_SIZE, retries: int = 3, progress: typing.Optional[typing.Callable[[int], typing.Any]] = None):
+    super().__init__(session, url, headers, data=typing.cast(typing.BinaryIO, None), size=0, digest='', params=params, chunk_size=chunk_size, retries=retries, progress=progress)
+    self._hl = hashlib.sha256()
+    self._buf = bytearray()
+    self._offset = 0
+    self._executor = ThreadPoolExecutor(max_workers=1)
+    self._pending: typing.Optional[typing.Any] = None
+    self.closed = False
+
+  def writable(self) -> bool:
+    return True
+
+  def write(self, data) -> int:
+    if not self.location:
+      self.start()
+    self._hl.update(data)
+    self._buf += data
+    self.size += len(data)
+    if len(self._buf) >= self.chunk_size:
+      self._flush()
+    return len(data)
+
+  def _flush(self):
+    if self._pending:
+      self._pending.result()
+      self._pending = None
+    if not self._buf:
+      return
+    chunk = bytes(self._buf)
+    self._buf.clear()
+    start = self._offset
+    self._offset += len(chunk)
+    self._pending = self._executor.submit(self._send_chunk, start, chunk)
+
+  def _send_chunk(self, start: int, chunk: bytes):
+    attempt = 0
+    while chunk:
+      try:
+        self._patch_bytes(start, chunk)
+        return
+      except (UploadError, requests.exceptions.ConnectionError) as err:
+        attempt += 1
+        if attempt > self.retries:
+          raise
+        offset = self.status()
+        if offset < start or offset > start+len(chunk):
+          raise UploadError(f"cannot resume upload at {offset}, chunk starts at {start}")
+        logger.warning(f"upload broke ({err}), resuming at {offset} ({attempt}/{self.retries})")
+        chunk = chunk[offset-start:]
+        start = offset
+
+  def abort(self):
+    self.closed = True
+    self._executor.shutdown(wait=True)
+
+  def close(self):
+    if self.closed:
+      return
+    try:
+      if not self.location:
+        self.start()
+      self._flush()
+      if self._pending:
+        self._pending.result()
+      self.digest = self._hl.hexdigest()
+      self.finish()
+    finally:
+      self.abort()
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+import typing
+
+logger = logging.getLogger()
+
+DEFAULT_TTL = 3600
+
+
+class UserCache:
+  """Remembers who a token belongs to, so that commands do not have to ask
+  `/v1/token-status` first.
+
+  Entries are keyed by a sha256 fingerprint of server and token (the token
+  itself is not stored) and expire after `ttl` seconds.
+
+  :param path: cache file
+  :param ttl: seconds an entry is valid
+  """
+  def __init__(self, path: str, ttl: float = DEFAULT_TTL):
+    self.path = path
+    self.ttl = ttl
+
+  @staticmethod
+  def fingerprint(base: str, token: str) -> str:
+    return hashlib.sha256(f"{base}\0{token}".encode('utf8')).hexdigest()
+
+  def _load(self) -> dict:
+    try:
+      with open(self.path, 'r') as fh:
+        entries = json.load(fh).get('entries', {})
+      return entries if isinstance(entries, dict) else {}
+    except FileNotFoundError:
+      return {}
+    except (ValueError, AttributeError) as err:
+      logger.debug(f"user cache {self.path} unreadable, starting over: {err}")
+      return {}
+
+  def _save(self, entries: dict):
+    now = time.time()
+    entries = { k: v for k, v in entries.items() if v.get('expires', 0) > now }
+    try:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.users')
+      try:
+        with os.fdopen(fd, 'w') as fh:
+          json.dump({ 'version': 1, 'entries': entries }, fh)
+        os.chmod(tmpfn, 0o600)
+        os.replace(tmpfn, self.path)
+      except:
+        os.unlink(tmpfn)
+        raise
+    except OSError as err:
+      logger.debug(f"could not write user cache: {err}")
+
+  def lookup(self, base: str, token: str) -> typing.Optional[dict]:
+    """Returns the cached token-status data (username, isAdmin) if still valid."""
+    entry = self._load().get(self.fingerprint(base, token))
+    if not entry or entry.get('expires', 0) <= time.time():
+      return None
+    return entry.get('user')
+
+  def store(self, base: str, token: str, user: dict):
+    if self.ttl <= 0:
+      return
+    entries = self._load()
+    entries[self.fingerprint(base, token)] = { 'user': user, 'expires': time.time() + self.ttl }
+    self._save(entries)
+
+  def remove(self, base: str, token: str):
+    entries = self._load()
+    if entries.pop(self.fingerprint(base, token), None) is not None:
+      self._save(entries)
@@ -47,5 +47,7 @@ setup(
     },
     extras_require={
         'test': test_requirements,
+        'zstd': [ 'zstandard' ],
+        'async': [ 'httpx' ],
     }
 )
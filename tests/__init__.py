@@ -1 +1,9 @@
 """Unit test package for hinkskalle_api."""
+import atexit
+import os
+import shutil
+import tempfile
+
+# keep the tests away from the real ~/.cache
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='hinkskalle_api_test_cache')
+atexit.register(shutil.rmtree, os.environ['XDG_CACHE_HOME'], ignore_errors=True)
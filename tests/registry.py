@@ -0,0 +1,334 @@
+"""Minimal stand-in for a Hinkskalle server, good enough for the API tests."""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeRegistry:
+  def __init__(self, username='test.hase', is_admin=False, ranges=True):
+    self.username = username
+    self.ranges = ranges
+    self.fail_ranges_from: typing.Optional[int] = None
+    # upload sessions: id -> { offset: chunk }
+    self.uploads: dict = {}
+    self.upload_params: list = []
+    self.chunks_in_order = True
+    self.fail_patch_at: typing.Optional[int] = None
+    # leave Docker-Content-Digest off finished monolithic uploads
+    self.upload_digest = True
+    self.is_admin = is_admin
+    self.blobs: dict = {}
+    self.manifests: dict = {}
+    self.listing: dict = {}
+    self.requests: list = []
+    # answer GETs with an ETag and honor If-None-Match
+    self.etags = True
+    self.cache_control: typing.Optional[str] = None
+    self.not_modified = 0
+    # serve /v1/manifests/<entity>/<collection>/<container>:<tag>
+    self.direct_tags = False
+    # answer the direct tag route with this status instead
+    self.direct_tags_status: typing.Optional[int] = None
+    # honor limit/offset on listings
+    self.paging = False
+    # entity, collection and container records, images per container
+    self.entities: dict = {}
+    self.collections: dict = {}
+    self.containers: dict = {}
+    self.images: dict = {}
+    # seconds to wait before answering a listing
+    self.delay = 0.0
+    # where staged uploads are picked up, like the server's upload directory
+    self.staging_path: typing.Optional[str] = None
+    self.lock = threading.Lock()
+    registry = self
+
+    class Handler(_Handler):
+      reg = registry
+
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.server.daemon_threads = True
+    self.thread = threading.Thread(target=self.server.serve_forever, kwargs={ 'poll_interval': 0.05 }, daemon=True)
+
+  @property
+  def base(self) -> str:
+    return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+  def add_download(self, data: bytes, filename: str, tags: list, container: str = 'test.hase/default/test') -> dict:
+    """Register data as an oras manifest in container, returns the listing entry."""
+    digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+    self.blobs[digest] = data
+    manifest = {
+      'id': str(sum(len(l) for l in self.listing.values())+1),
+      'hash': digest.replace('sha256:', ''),
+      'filename': filename,
+      'tags': tags,
+      'type': 'oras',
+      'total_size': len(data),
+      'images': [digest],
+      'content': { 'layers': [{ 'digest': digest, 'size': len(data), 'annotations': { 'org.opencontainers.image.title': filename }}]},
+    }
+    self.listing.setdefault(container, []).append(manifest)
+    return manifest
+
+  def add_container(self, container: str, **kwargs) -> dict:
+    """Register container (`entity/collection/name`) and its collection."""
+    entity, collection, name = container.split('/')
+    colls = self.collections.setdefault(entity, [])
+    if not any(c['name'] == collection for c in colls):
+      colls.append({ 'name': collection, 'entityName': entity })
+    record = { 'name': name, 'collectionName': collection, 'entityName': entity, **kwargs }
+    self.containers.setdefault(f"{entity}/{collection}", []).append(record)
+    return record
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  reg: FakeRegistry
+
+  routes = [
+    ('GET', r'/v1/token-status$', 'token_status'),
+    ('POST', r'/v1/get-token$', 'get_token'),
+    ('POST', r'/v1/get-download-token$', 'get_download_token'),
+    ('GET', r'/v1/entities/(?P<entity>[^/]+)$', 'get_entity'),
+    ('GET', r'/v1/collections/(?P<entity>[^/]+)$', 'list_collections'),
+    ('GET', r'/v1/containers/(?P<coll>[^/]+/[^/]+)$', 'list_containers'),
+    ('GET', r'/v1/containers/(?P<repo>[^/]+/[^/]+/[^/]+)/manifests$', 'list_manifests'),
+    ('GET', r'/v1/containers/(?P<repo>[^/]+/[^/]+/[^/]+)/images$', 'list_images'),
+    ('GET', r'/v1/manifests/(?P<id>[^/]+)/download$', 'download'),
+    ('GET', r'/v1/manifests/(?P<repo>[^/]+/[^/]+/[^/:]+):(?P<tag>[^/]+)$', 'tagged_manifest'),
+    ('HEAD', r'/v2/(?P<repo>.+)/blobs/(?P<digest>sha256:\w+)$', 'head_blob'),
+    ('GET', r'/v2/(?P<repo>.+)/blobs/(?P<digest>sha256:\w+)$', 'get_blob'),
+    ('POST', r'/v2/(?P<repo>.+)/blobs/uploads/$', 'post_upload'),
+    ('PATCH', r'/v2/(?P<repo>.+)/blobs/uploads/(?P<id>[^/]+)$', 'patch_upload'),
+    ('GET', r'/v2/(?P<repo>.+)/blobs/uploads/(?P<id>[^/]+)$', 'upload_status'),
+    ('PUT', r'/v2/(?P<repo>.+)/blobs/uploads/(?P<id>[^/]+)$', 'put_upload'),
+    ('PUT', r'/v2/(?P<repo>.+)/manifests/(?P<tag>[^/]+)$', 'put_manifest'),
+  ]
+
+  def log_message(self, format, *args):
+    pass
+
+  def _dispatch(self, method: str):
+    url = urlparse(self.path)
+    self.query = { k: v[0] for k, v in parse_qs(url.query).items() }
+    with self.reg.lock:
+      self.reg.requests.append((method, url.path))
+    for route_method, pattern, name in self.routes:
+      match = re.match(pattern, url.path)
+      if route_method == method and match:
+        return getattr(self, name)(**match.groupdict())
+    self._json(404, { 'errors': [{ 'detail': f'{method} {url.path} not found' }]})
+
+  def do_GET(self):
+    self._dispatch('GET')
+
+  def do_HEAD(self):
+    self._dispatch('HEAD')
+
+  def do_POST(self):
+    self._dispatch('POST')
+
+  def do_PUT(self):
+    self._dispatch('PUT')
+
+  def do_PATCH(self):
+    self._dispatch('PATCH')
+
+  def _body(self) -> bytes:
+    length = int(self.headers.get('Content-Length', 0))
+    return self.rfile.read(length) if length else b''
+
+  def _send(self, status: int, body: bytes = b'', headers: dict = {}):
+    self.send_response(status)
+    for k, v in headers.items():
+      self.send_header(k, v)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if body and self.command != 'HEAD':
+      self.wfile.write(body)
+
+  def _json(self, status: int, data, headers: dict = {}):
+    body = json.dumps(data).encode('utf8')
+    if self.command == 'GET' and status == 200 and self.reg.etags:
+      etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+      headers = { **headers, 'ETag': etag }
+      if self.reg.cache_control:
+        headers['Cache-Control'] = self.reg.cache_control
+      if self.headers.get('If-None-Match') == etag:
+        with self.reg.lock:
+          self.reg.not_modified += 1
+        return self._send(304, headers=headers)
+    self._send(status, body, { 'Content-Type': 'application/json', **headers })
+
+  def token_status(self):
+    self._json(200, { 'data': { 'username': self.reg.username, 'isAdmin': self.reg.is_admin }})
+
+  def get_token(self):
+    self._body()
+    self._json(200, { 'data': { 'token': 'new-secret', 'id': '1' }})
+
+  def get_download_token(self):
+    request = json.loads(self._body())
+    self._json(200, { 'data': { 'id': 'dl-1', 'location': f"{self.reg.base}/v1/manifests/{request['id']}/download?temp_token=dl-1" }})
+
+  def get_entity(self, entity: str):
+    if entity not in self.reg.entities:
+      return self._json(404, { 'errors': [{ 'detail': 'entity not found' }]})
+    self._json(200, { 'data': self.reg.entities[entity] })
+
+  def list_collections(self, entity: str):
+    time.sleep(self.reg.delay)
+    self._json(200, { 'data': self.reg.collections.get(entity, []) })
+
+  def list_containers(self, coll: str):
+    time.sleep(self.reg.delay)
+    self._json(200, { 'data': self.reg.containers.get(coll, []) })
+
+  def list_images(self, repo: str):
+    time.sleep(self.reg.delay)
+    self._json(200, { 'data': self.reg.images.get(repo, []) })
+
+  def list_manifests(self, repo: str):
+    time.sleep(self.reg.delay)
+    listing = self.reg.listing.get(repo, [])
+    if self.reg.paging and 'limit' in self.query:
+      offset = int(self.query.get('offset', 0))
+      listing = listing[offset:offset+int(self.query['limit'])]
+    self._json(200, { 'data': listing })
+
+  def tagged_manifest(self, repo: str, tag: str):
+    if self.reg.direct_tags_status:
+      return self._json(self.reg.direct_tags_status, { 'errors': [{ 'detail': 'oops' }]})
+    manifest = next((m for m in self.reg.listing.get(repo, []) if tag in m['tags']), None)
+    if not self.reg.direct_tags or not manifest:
+      return self._json(404, { 'errors': [{ 'detail': 'not found' }]})
+    self._json(200, { 'data': manifest })
+
+  def download(self, id: str):
+    manifest = next((m for lst in self.reg.listing.values() for m in lst if m['id'] == id), None)
+    if not manifest:
+      return self._json(404, { 'errors': [{ 'detail': 'manifest not found' }]})
+    digest = manifest['content']['layers'][0]['digest']
+    data = self.reg.blobs[digest]
+    headers = { 'Docker-Content-Digest': digest, 'Accept-Ranges': 'bytes' }
+    match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+    if match and self.reg.ranges:
+      start = int(match.group(1))
+      if self.reg.fail_ranges_from is not None and start >= self.reg.fail_ranges_from:
+        return self._json(503, { 'errors': [{ 'detail': 'try again later' }]})
+      end = min(int(match.group(2)) if match.group(2) else len(data)-1, len(data)-1)
+      headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+      return self._send(206, data[start:end+1], headers)
+    self._send(200, data, headers)
+
+  def head_blob(self, repo: str, digest: str):
+    if digest in self.reg.blobs:
+      self._send(200, headers={ 'Docker-Content-Digest': digest })
+    else:
+      self._send(404)
+
+  def get_blob(self, repo: str, digest: str):
+    if digest not in self.reg.blobs:
+      return self._json(404, { 'errors': [{ 'detail': 'blob unknown' }]})
+    self._send(200, self.reg.blobs[digest], { 'Docker-Content-Digest': digest })
+
+  def post_upload(self, repo: str):
+    data = self._body()
+    if not self.query.get('digest'):
+      with self.reg.lock:
+        upload_id = str(len(self.reg.uploads)+1)
+        self.reg.uploads[upload_id] = {}
+        self.reg.upload_params.append(dict(self.query))
+      return self._send(202, headers={ 'Location': f'/v2/{repo}/blobs/uploads/{upload_id}', 'Range': '0-0' })
+    if self.query.get('staged') and self.reg.staging_path:
+      staged_fn = os.path.join(self.reg.staging_path, self.query['digest'].replace(':', '.', 1))
+      with open(staged_fn, 'rb') as fh:
+        data = fh.read()
+      os.unlink(staged_fn)
+    digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+    if digest != self.query.get('digest'):
+      return self._json(400, { 'errors': [{ 'detail': 'digest mismatch' }]})
+    self.reg.blobs[digest] = data
+    self._json(200, { 'data': { 'id': digest }}, { 'Docker-Content-Digest': digest } if self.reg.upload_digest else {})
+
+  def _upload_offset(self, chunks: dict) -> int:
+    offset = 0
+    while offset in chunks:
+      offset += len(chunks[offset])
+    return offset
+
+  def _range(self, offset: int) -> dict:
+    return { 'Range': f'0-{offset-1}' if offset else '0-0' }
+
+  def patch_upload(self, repo: str, id: str):
+    chunks = self.reg.uploads[id]
+    start, end = [ int(v) for v in self.headers['Content-Range'].split('-') ]
+    data = self._body()
+    with self.reg.lock:
+      if self.reg.fail_patch_at is not None and start >= self.reg.fail_patch_at:
+        self.reg.fail_patch_at = None
+        return self._json(500, { 'errors': [{ 'detail': 'oops' }]})
+      if self.reg.chunks_in_order and start != self._upload_offset(chunks):
+        return self._send(416, headers=self._range(self._upload_offset(chunks)))
+      chunks[start] = data
+      offset = self._upload_offset(chunks)
+    self._send(202, headers={ 'Location': f'/v2/{repo}/blobs/uploads/{id}', **self._range(offset) })
+
+  def upload_status(self, repo: str, id: str):
+    self._send(204, headers={ 'Location': f'/v2/{repo}/blobs/uploads/{id}', **self._range(self._upload_offset(self.reg.uploads[id])) })
+
+  def put_upload(self, repo: str, id: str):
+    chunks = self.reg.uploads.pop(id)
+    data = b''.join(chunks[k] for k in sorted(chunks))
+    if self.query.get('staged') and self.reg.staging_path:
+      staged_fn = os.path.join(self.reg.staging_path, self.query['digest'].replace(':', '.', 1))
+      with open(staged_fn, 'rb') as fh:
+        data = fh.read()
+      os.unlink(staged_fn)
+    digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+    if digest != self.query.get('digest'):
+      return self._json(400, { 'errors': [{ 'detail': 'digest mismatch' }]})
+    self.reg.blobs[digest] = data
+    self.reg.upload_params.append(dict(self.query))
+    self._send(201, headers={ 'Docker-Content-Digest': digest, 'Location': f'/v2/{repo}/blobs/{digest}' })
+
+  def put_manifest(self, repo: str, tag: str):
+    data = self._body()
+    digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+    manifest = json.loads(data)
+    self.reg.manifests[f"{repo}:{tag}"] = manifest
+    layers = manifest.get('layers', [])
+    # list what was pushed, like the server does
+    with self.reg.lock:
+      if layers:
+        listing = self.reg.listing.setdefault(repo, [])
+        for entry in listing:
+          if tag in entry['tags']:
+            entry['tags'].remove(tag)
+        listing.append({
+          'id': str(sum(len(l) for l in self.reg.listing.values())+1),
+          'hash': digest.replace('sha256:', ''),
+          'filename': (layers[0].get('annotations') or {}).get('org.opencontainers.image.title') if len(layers) == 1 else '(multiple)',
+          'tags': [tag],
+          'type': 'oras',
+          'total_size': sum(l['size'] for l in layers),
+          'images': [ l['digest'] for l in layers ],
+          'content': manifest,
+        })
+    self._json(200, {}, { 'Docker-Content-Digest': digest })
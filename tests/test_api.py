@@ -4,10 +4,33 @@ from unittest import mock
 import os
 import os.path
 import tempfile
+import time
 import typing
 import tarfile
+import io
+import gzip
+import hashlib
+import json
+import mmap
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from hinkskalle_api import HinkApi
+from hinkskalle_api.util.download import RangedDownload
+from hinkskalle_api.util.hashing import ResumableSha256, hash_file, hash_range
+from hinkskalle_api.util.digest_cache import DigestCache
+from hinkskalle_api.util.codecs import ParallelGzipWriter, get_codec
+from hinkskalle_api.util.scan import ExcludeMatcher, scan_tree
+from hinkskalle_api.util.http_cache import HttpCache
+from hinkskalle_api.util.config import load_config
+from hinkskalle_api.util.batch import parse_pull_spec, BatchPush
+from hinkskalle_api.util.layers import split_layers, extract_tar
+from hinkskalle_api.util.json_stream import iter_data
+from hinkskalle_api.util.blob_cache import BlobCache, parse_digest
+from hinkskalle_api.util.fastcopy import stage_file
+from hinkskalle_api.auto.models import plainToGroup, plainToManifest, serializeToken, plainToToken
+from .registry import FakeRegistry
 
 class TestApi(unittest.TestCase):
   def test_init(self):
@@ -55,7 +78,7 @@ class TestApi(unittest.TestCase):
   @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
   def test_push_private(self):
     api = HinkApi()
-    with mock.patch('hinkskalle_api.api.requests.post') as mock_post, mock.patch('hinkskalle_api.api.requests.head') as mock_head:
+    with mock.patch.object(api.session, 'post') as mock_post, mock.patch.object(api.session, 'head') as mock_head:
       testdata = tempfile.TemporaryFile('wb+')
       testdata.write(b"oink\n")
       testdata.flush()
@@ -66,7 +89,7 @@ class TestApi(unittest.TestCase):
   @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
   def test_push_expires(self):
     api = HinkApi()
-    with mock.patch('hinkskalle_api.api.requests.post') as mock_post, mock.patch('hinkskalle_api.api.requests.head') as mock_head:
+    with mock.patch.object(api.session, 'post') as mock_post, mock.patch.object(api.session, 'head') as mock_head:
       testdata = tempfile.TemporaryFile('wb+')
       testdata.write(b"oink\n")
       testdata.flush()
@@ -110,4 +133,1152 @@ class TestApi(unittest.TestCase):
       self.assertCountEqual(tar.getnames(), ['packme/testfile'])
 
 
-    os.chdir(cwd)
\ No newline at end of file
+    os.chdir(cwd)
+  def test_connection_reuse(self):
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      api = HinkApi(base=reg.base, key='secret')
+      fn = os.path.join(tmpdir, 'testfile')
+      with open(fn, 'wb') as fh:
+        fh.write(b"oink\n")
+      api.push_file(tag='v1', container='test', filename=fn)
+      api.close()
+    # token-status, 2xHEAD, 2xPOST, PUT manifest all over the same connection
+    self.assertEqual(api.session.stats.requests, 6)
+    self.assertEqual(api.session.stats.connections, 1)
+    self.assertEqual(api.session.stats.reused, 5)
+    self.assertIn('test.hase/default/test:v1', reg.manifests)
+
+  def test_session_config(self):
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch('hinkskalle_api.api.os.path.expanduser') as mock_exp:
+      mock_exp.return_value = os.path.join(tmp_dir, 'test.yml')
+      with open(mock_exp(), 'w') as tmpfh:
+        tmpfh.write("hink_api_base: http://testha.se/\nhink_api_pool_maxsize: 32\nhink_api_keep_alive: false\n")
+      api = HinkApi()
+    self.assertEqual(api.session.pool_maxsize, 32)
+    self.assertEqual(api.session.headers['Connection'], 'close')
+
+  def test_fetch_parallel(self):
+    data = os.urandom(1000)
+    cwd = os.getcwd()
+    for ranges in (True, False):
+      with FakeRegistry(ranges=ranges) as reg, tempfile.TemporaryDirectory() as tmpdir:
+        reg.add_download(data, 'test.bin', ['v1'])
+        api = HinkApi(base=reg.base, key='secret')
+        os.chdir(tmpdir)
+        try:
+          outfn = api.fetch_blob(container='test', tag='v1', connections=4, segment_size=128)
+          with open(outfn, 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+        finally:
+          os.chdir(cwd)
+        downloads = [ r for r in reg.requests if r[1].endswith('/download') ]
+        # probe + 8 segments
+        self.assertEqual(len(downloads), 9 if ranges else 1)
+
+  def test_pull_many(self):
+    data = { name: os.urandom(1000) for name in ('a.bin', 'b.bin', 'c.bin') }
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      reg.add_download(data['a.bin'], 'a.bin', ['v1'])
+      reg.add_download(data['b.bin'], 'b.bin', ['v2'])
+      reg.add_download(data['c.bin'], 'c.bin', ['v1'], container='test.hase/other/test')
+      api = HinkApi(base=reg.base, key='secret', use_cache=False)
+      seen = []
+      report = api.pull_many(['test:v1', 'test.hase/default/test:v2', 'other/test:v1', 'test:v3', 'test.hase/default/test:v1'], out=tmpdir, workers=3, on_result=seen.append)
+      for name, content in data.items():
+        with open(os.path.join(tmpdir, name), 'rb') as fh:
+          self.assertEqual(fh.read(), content)
+    self.assertEqual(len(seen), 5)
+    self.assertListEqual([ r.ok for r in report.results ], [True, True, True, False, False])
+    self.assertRegex(typing.cast(str, report.results[3].error), r'not found')
+    self.assertRegex(typing.cast(str, report.results[4].error), r'also the target')
+    self.assertEqual(report.size, 3000)
+    self.assertRegex(str(report), r'^3/5 downloaded')
+    # one user lookup, one listing per container
+    self.assertEqual(len([ r for r in reg.requests if r[1] == '/v1/token-status' ]), 1)
+    self.assertEqual(len([ r for r in reg.requests if r[1].endswith('/manifests') ]), 2)
+
+  def test_push_many(self):
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      contents = { 'a.bin': os.urandom(1000), 'b.bin': os.urandom(500), 'c.bin': None, 'd.bin': os.urandom(300) }
+      contents['c.bin'] = contents['a.bin']
+      for name, content in contents.items():
+        with open(os.path.join(tmpdir, name), 'wb') as fh:
+          fh.write(typing.cast(bytes, content))
+      os.mkdir(os.path.join(tmpdir, 'dir'))
+      with open(os.path.join(tmpdir, 'dir', 'e.txt'), 'wb') as fh:
+        fh.write(b"oink\n")
+      # already on the server
+      reg.blobs[f"sha256:{hashlib.sha256(contents['d.bin']).hexdigest()}"] = contents['d.bin']
+      api = HinkApi(base=reg.base, key='secret', use_cache=False)
+      api.digest_cache = None
+      seen = []
+      report = api.push_many([
+        (os.path.join(tmpdir, 'a.bin'), 'test:a'),
+        (os.path.join(tmpdir, 'b.bin'), 'test:b'),
+        (os.path.join(tmpdir, 'c.bin'), 'test:c'),
+        (os.path.join(tmpdir, 'd.bin'), 'other/test:d'),
+        (os.path.join(tmpdir, 'dir/'), 'test:dir'),
+        (os.path.join(tmpdir, 'nope.bin'), 'test:nope'),
+      ], workers=3, hash_workers=2, on_result=seen.append)
+    self.assertEqual(len(seen), 6)
+    self.assertListEqual([ r.ok for r in report.results ], [True, True, True, True, True, False])
+    self.assertListEqual([ r.uploaded for r in report.results[:4] ], [True, True, False, False])
+    self.assertEqual(report.skipped, 1300)
+    self.assertEqual(report.uploaded, 1500 + report.results[4].size)
+    self.assertRegex(str(report), r'^5/6 pushed')
+    self.assertCountEqual(reg.manifests.keys(), [ f'test.hase/default/test:{t}' for t in ('a', 'b', 'c', 'dir') ] + ['test.hase/other/test:d'])
+    self.assertEqual(reg.manifests['test.hase/default/test:dir']['layers'][0]['mediaType'], 'application/vnd.oci.image.layer.v1.tar+gzip')
+    self.assertEqual(reg.manifests['test.hase/default/test:c']['layers'][0]['annotations']['org.opencontainers.image.title'], os.path.join(tmpdir, 'c.bin'))
+    # a/c, b, dir and the config in test, d and the config in other/test
+    self.assertEqual(len([ r for r in reg.requests if r[0] == 'HEAD' ]), 6)
+    self.assertEqual(len([ r for r in reg.requests if r[0] == 'POST' ]), 5)
+
+  def test_push_many_threads(self):
+    api = HinkApi(base='http://testha.se', key='secret', use_cache=False)
+    with mock.patch('hinkskalle_api.util.batch.available_threads', return_value=8):
+      # the cores are split between the hash workers
+      self.assertEqual(BatchPush(api, []).tar_options['threads'], 1)
+      self.assertEqual(BatchPush(api, [], hash_workers=2).tar_options['threads'], 4)
+      self.assertEqual(BatchPush(api, [], hash_workers=16).tar_options['threads'], 1)
+      self.assertEqual(BatchPush(api, [], hash_workers=2, threads=8).tar_options['threads'], 8)
+
+  def test_push_layers(self):
+    cwd = os.getcwd()
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      try:
+        for path, content in (('run/SampleSheet.csv', b"sample,index\n"), ('run/a/reads.fq', os.urandom(2000)), ('run/b/reads.fq', os.urandom(3000)), ('run/b/deep/stats.txt', b"ok\n")):
+          os.makedirs(os.path.dirname(path), exist_ok=True)
+          with open(path, 'wb') as fh:
+            fh.write(content)
+        api = HinkApi(base=reg.base, key='secret', use_cache=False)
+        api.push_file(tag='v1', container='test', filename='run/', layers='subdirs')
+        manifest = reg.manifests['test.hase/default/test:v1']
+        self.assertListEqual([ l['annotations']['org.opencontainers.image.title'] for l in manifest['layers'] ], ['run', 'run/a', 'run/b'])
+
+        # only the changed layer is sent again
+        with open('run/SampleSheet.csv', 'ab') as fh:
+          fh.write(b"oink,AAAA\n")
+        uploads = len([ r for r in reg.requests if r[0] == 'POST' ])
+        api.push_file(tag='v2', container='test', filename='run', layers='subdirs')
+        self.assertEqual(len([ r for r in reg.requests if r[0] == 'POST' ]), uploads+1)
+
+        out = api.fetch_blob(container='test', tag='v2', out='restore')
+        self.assertEqual(out, 'restore')
+        for path in ('run/SampleSheet.csv', 'run/a/reads.fq', 'run/b/reads.fq', 'run/b/deep/stats.txt'):
+          with open(path, 'rb') as orig, open(os.path.join('restore', path), 'rb') as restored:
+            self.assertEqual(orig.read(), restored.read())
+        self.assertListEqual([ f for f in os.listdir('restore') ], ['run'])
+      finally:
+        os.chdir(cwd)
+
+  def test_fetch_unpack(self):
+    cwd = os.getcwd()
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      try:
+        os.makedirs('run/sub')
+        data = os.urandom(5000)
+        with open('run/sub/reads.fq', 'wb') as fh:
+          fh.write(data)
+        api = HinkApi(base=reg.base, key='secret', use_cache=False)
+        api.push_file(tag='v1', container='test', filename='run')
+
+        out = api.fetch_blob(container='test', tag='v1', out='restore', unpack=True)
+        self.assertEqual(out, 'restore')
+        self.assertListEqual(os.listdir('restore'), ['run'])
+        with open('restore/run/sub/reads.fq', 'rb') as fh:
+          self.assertEqual(fh.read(), data)
+        # unpacked while streaming, from the blob
+        self.assertFalse([ r for r in reg.requests if r[1].endswith('/download') ])
+
+        # a second pull does not overwrite, the download is kept
+        with self.assertRaisesRegex(Exception, r'already exist'):
+          api.fetch_blob(container='test', tag='v1', out='restore', unpack=True)
+        self.assertEqual(len([ e for e in os.listdir('restore') if e.startswith('.hinkli-unpack-') ]), 1)
+
+        # nothing is left behind if the checksum does not match
+        digest = reg.manifests['test.hase/default/test:v1']['layers'][0]['digest']
+        blob = reg.blobs[digest]
+        with gzip.GzipFile(fileobj=io.BytesIO(blob)) as gz:
+          raw = gz.read()
+        reg.blobs[digest] = gzip.compress(raw+b"\0"*512)
+        with self.assertRaisesRegex(Exception, r'Checksum mismatch'):
+          api.fetch_blob(container='test', tag='v1', out='broken', unpack=True)
+        self.assertListEqual(os.listdir('broken'), [])
+      finally:
+        os.chdir(cwd)
+
+  def test_fetch_layers_closed(self):
+    cwd = os.getcwd()
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      try:
+        os.makedirs('run/sub')
+        with open('run/sub/reads.fq', 'wb') as fh:
+          fh.write(os.urandom(5000))
+        api = HinkApi(base=reg.base, key='secret', use_cache=False)
+        api.push_file(tag='v1', container='test', filename='run')
+        digest = reg.manifests['test.hase/default/test:v1']['layers'][0]['digest']
+        with gzip.GzipFile(fileobj=io.BytesIO(reg.blobs[digest])) as gz:
+          reg.blobs[digest] = gzip.compress(gz.read()+b"\0"*512)
+
+        opened, closed = [], []
+        real_get = api.session.get
+        def get(*args, **kwargs):
+          r = real_get(*args, **kwargs)
+          if kwargs.get('stream'):
+            opened.append(r)
+            real_close = r.close
+            r.close = lambda: (closed.append(r), real_close())
+          return r
+        with mock.patch.object(api.session, 'get', side_effect=get):
+          with self.assertRaisesRegex(Exception, r'Checksum mismatch'):
+            api.fetch_blob(container='test', tag='v1', out='broken', unpack=True)
+        self.assertTrue(opened)
+        self.assertListEqual(closed, opened)
+      finally:
+        os.chdir(cwd)
+
+  def test_fetch_unpack_traversal(self):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+      info = tarfile.TarInfo('../evil.txt')
+      info.size = 4
+      tar.addfile(info, io.BytesIO(b"oink"))
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      manifest = reg.add_download(buf.getvalue(), 'evil.tar.gz', ['v1'])
+      manifest['content']['layers'][0]['mediaType'] = 'application/vnd.oci.image.layer.v1.tar+gzip'
+      manifest['content']['layers'][0]['annotations']['io.deis.oras.content.unpack'] = 'true'
+      api = HinkApi(base=reg.base, key='secret', use_cache=False)
+      with self.assertRaises(Exception):
+        api.fetch_blob(container='test', tag='v1', out=os.path.join(tmpdir, 'out'), unpack=True)
+      self.assertListEqual(os.listdir(tmpdir), ['out'])
+      self.assertListEqual(os.listdir(os.path.join(tmpdir, 'out')), [])
+
+  def test_split_layers(self):
+    def entries(sizes: typing.Dict[str, int]):
+      return [ (f"top/{name}", os.stat_result((0o100644, 0, 0, 1, 0, 0, size, 0, 0, 0))) for name, size in sizes.items() ]
+    files = { f"f{i:03d}": 100 for i in range(200) }
+    layers = split_layers('top', entries(files), mode='size', layer_size=1000)
+    self.assertTrue(all(250 <= l.size <= 1000 for l in layers[:-1]))
+    self.assertEqual(sum(len(l.entries) for l in layers), 200)
+    # a new file early on only changes the layers up to the next boundary
+    changed = split_layers('top', entries({ 'f000a': 100, **files }), mode='size', layer_size=1000)
+    before = [ [ p for p, _ in l.entries ] for l in layers ]
+    after = [ [ p for p, _ in l.entries ] for l in changed ]
+    self.assertGreater(len([ l for l in after if l in before ]), len(before)//2)
+
+    with self.assertRaisesRegex(Exception, r'unknown layer mode'):
+      split_layers('top', [], mode='oink')
+
+  def test_extract_tar_traversal(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      buf = io.BytesIO()
+      with tarfile.open(fileobj=buf, mode='w') as tar:
+        info = tarfile.TarInfo('../evil.txt')
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b"oink"))
+      buf.seek(0)
+      with self.assertRaises(Exception):
+        extract_tar(buf, os.path.join(tmpdir, 'out'))
+      self.assertFalse(os.path.exists(os.path.join(tmpdir, 'evil.txt')))
+
+  def test_compact_models(self):
+    group = plainToGroup({ 'name': 'hasen', 'deleted': 0, 'createdAt': '2022-05-06T10:11:12+00:00', 'users': [ { 'role': 'admin', 'user': { 'username': 'hase', 'isAdmin': True } } ] })
+    self.assertEqual(group.name, 'hasen')
+    self.assertIs(group.deleted, False)
+    self.assertIsNone(group.updatedAt)
+    self.assertEqual(group.createdAt, datetime.fromisoformat('2022-05-06T10:11:12+00:00'))
+    self.assertTrue(group.users[0].user.is_admin)
+    self.assertFalse(hasattr(group, '__dict__'))
+
+    manifest = plainToManifest({ 'filename': 'test.bin', 'tags': 'v1', 'total_size': 3 })
+    self.assertListEqual(manifest.tags, [])
+    manifest.image_hash = [ 'sha256:oink' ]
+    with self.assertRaises(AttributeError):
+      manifest.oink = 1 # type: ignore
+
+    token = plainToToken({ 'comment': 'hase', 'user': { 'username': 'hase' } })
+    token.expiresAt = datetime(2022, 5, 6)
+    self.assertEqual(serializeToken(token)['expiresAt'], '2022-05-06T00:00:00')
+    self.assertEqual(serializeToken(token)['user']['username'], 'hase')
+
+  def test_parse_pull_spec(self):
+    items = parse_pull_spec([ '# project x\n', 'test.hase/raw/lib1:v1\n', '\n', 'lib2   out/lib2.fq  # renamed\n' ])
+    self.assertListEqual([ (i.entity, i.collection, i.container, i.tag, i.out) for i in items ], [
+      ('test.hase', 'raw', 'lib1', 'v1', None),
+      (None, 'default', 'lib2', 'latest', 'out/lib2.fq'),
+    ])
+    with self.assertRaisesRegex(Exception, r'line 1'):
+      parse_pull_spec([ 'a b c' ])
+
+  def test_fetch_out(self):
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      reg.add_download(b"oink\n", '../test.bin', ['v1'])
+      api = HinkApi(base=reg.base, key='secret')
+      outfn = api.fetch_blob(container='test', tag='v1', out=tmpdir)
+      self.assertEqual(outfn, os.path.join(tmpdir, 'test.bin'))
+      self.assertTrue(os.path.exists(outfn))
+
+  def test_fetch_checksum_mismatch(self):
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      manifest = reg.add_download(os.urandom(1000), 'test.bin', ['v1'])
+      reg.blobs[manifest['images'][0]] = os.urandom(1000)
+      api = HinkApi(base=reg.base, key='secret')
+      with self.assertRaisesRegex(Exception, r'Checksum mismatch'):
+        api.fetch_blob(container='test', tag='v1', out=tmpdir, connections=3, segment_size=100)
+
+  def test_fetch_resume(self):
+    data = os.urandom(1000)
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      reg.add_download(data, 'test.bin', ['v1'])
+      api = HinkApi(base=reg.base, key='secret')
+      reg.fail_ranges_from = 500
+      with self.assertRaisesRegex(Exception, r'status 503'):
+        api.fetch_blob(container='test', tag='v1', out=tmpdir, segment_size=100, resume=True)
+      outfn = os.path.join(tmpdir, 'test.bin')
+      self.assertFalse(os.path.exists(outfn))
+      self.assertTrue(os.path.exists(f"{outfn}.partial"))
+      with open(f"{outfn}.partial.json") as fh:
+        state = json.load(fh)
+      self.assertListEqual(state['completed'], [0, 100, 200, 300, 400])
+      self.assertEqual(state['hash_offset'], 500)
+
+      reg.fail_ranges_from = None
+      reg.requests.clear()
+      with mock.patch('hinkskalle_api.util.download.RangedDownload._hash_segment', autospec=True, side_effect=RangedDownload._hash_segment) as mock_hash:
+        api.fetch_blob(container='test', tag='v1', out=tmpdir, segment_size=100, resume=True)
+      # only the missing segments are downloaded and hashed
+      self.assertEqual(len([ r for r in reg.requests if r[1].endswith('/download') ]), 6)
+      self.assertEqual(mock_hash.call_count, 5)
+      with open(outfn, 'rb') as fh:
+        self.assertEqual(fh.read(), data)
+      self.assertFalse(os.path.exists(f"{outfn}.partial"))
+      self.assertFalse(os.path.exists(f"{outfn}.partial.json"))
+
+  def test_fetch_resume_changed(self):
+    data = os.urandom(1000)
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      manifest = reg.add_download(data, 'test.bin', ['v1'])
+      reg.fail_ranges_from = 500
+      with self.assertRaisesRegex(Exception, r'status 503'):
+        HinkApi(base=reg.base, key='secret', use_cache=False).fetch_blob(container='test', tag='v1', out=tmpdir, segment_size=100, resume=True)
+      outfn = os.path.join(tmpdir, 'test.bin')
+      self.assertEqual(os.path.getsize(f"{outfn}.partial"), 1000)
+
+      # re-pushed in the meantime, the leftovers must not end up in the new file
+      reg.fail_ranges_from = None
+      data = os.urandom(600)
+      digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+      reg.blobs[digest] = data
+      manifest['images'] = [digest]
+      manifest['content']['layers'][0].update(digest=digest, size=len(data))
+      HinkApi(base=reg.base, key='secret', use_cache=False).fetch_blob(container='test', tag='v1', out=tmpdir, segment_size=100, resume=True)
+      with open(outfn, 'rb') as fh:
+        self.assertEqual(fh.read(), data)
+
+  def test_fetch_resume_hash_state(self):
+    data = os.urandom(1000)
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      reg.add_download(data, 'test.bin', ['v1'])
+      api = HinkApi(base=reg.base, key='secret')
+      reg.fail_ranges_from = 500
+      with self.assertRaisesRegex(Exception, r'status 503'):
+        api.fetch_blob(container='test', tag='v1', out=tmpdir, segment_size=100, resume=True)
+      reg.fail_ranges_from = None
+
+      def restore(state=None):
+        if state:
+          raise ValueError("cannot restore sha256 state without libcrypto")
+        return ResumableSha256()
+      with mock.patch('hinkskalle_api.util.download.ResumableSha256', side_effect=restore):
+        outfn = api.fetch_blob(container='test', tag='v1', out=tmpdir, segment_size=100, resume=True)
+      with open(outfn, 'rb') as fh:
+        self.assertEqual(fh.read(), data)
+
+  def test_resumable_sha256(self):
+    data = os.urandom(10000)
+    hl = ResumableSha256()
+    hl.update(data[:3000])
+    if not hl.resumable:
+      self.skipTest("no libcrypto")
+    restored = ResumableSha256(hl.state())
+    restored.update(bytearray(data[3000:]))
+    self.assertEqual(restored.hexdigest(), hashlib.sha256(data).hexdigest())
+
+  def test_digest_cache(self):
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      api = HinkApi(base=reg.base, key='secret')
+      api.digest_cache = DigestCache(os.path.join(tmpdir, 'cache', 'digests.json'))
+      fn = os.path.join(tmpdir, 'testfile')
+      with open(fn, 'wb') as fh:
+        fh.write(b"oink\n")
+      with open(fn, 'rb') as fh:
+        first = api.push_blob(container='test', data=fh)
+      with open(fn, 'rb') as fh, mock.patch('hinkskalle_api.api.hashlib.sha256') as mock_sha:
+        second = api.push_blob(container='test', data=fh)
+      mock_sha.assert_not_called()
+      self.assertEqual(first, second)
+      self.assertEqual(first, (hashlib.sha256(b"oink\n").hexdigest(), 5))
+
+      # changed file is hashed again
+      with open(fn, 'wb') as fh:
+        fh.write(b"grunz\n")
+      with open(fn, 'rb') as fh:
+        third = api.push_blob(container='test', data=fh)
+      self.assertEqual(third, (hashlib.sha256(b"grunz\n").hexdigest(), 6))
+
+  def test_digest_cache_eviction(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = DigestCache(os.path.join(tmpdir, 'digests.json'), max_entries=2)
+      for i in range(3):
+        cache.store((1, i, 10, 100), f"digest{i}")
+      self.assertIsNone(cache.lookup((1, 0, 10, 100)))
+      self.assertEqual(cache.lookup((1, 1, 10, 100)), 'digest1')
+      self.assertEqual(cache.lookup((1, 2, 10, 100)), 'digest2')
+      self.assertIsNone(cache.lookup((1, 2, 11, 100)))
+
+  def test_digest_cache_concurrent(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, 'digests.json')
+      def store(i):
+        # a cache per worker, like separate processes
+        DigestCache(fn).store((1, i, 10, 100), f"digest{i}")
+      threads = [ threading.Thread(target=store, args=(i,)) for i in range(20) ]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+      cache = DigestCache(fn)
+      for i in range(20):
+        self.assertEqual(cache.lookup((1, i, 10, 100)), f"digest{i}")
+
+      # hits are not written until the next store
+      with mock.patch.object(cache, '_save') as mock_save:
+        cache.lookup((1, 0, 10, 100))
+      mock_save.assert_not_called()
+      cache.store((1, 99, 10, 100), 'digest99')
+      with open(fn) as fh:
+        entries = json.load(fh)['entries']
+      self.assertGreater(entries['1:0']['used'], entries['1:1']['used'])
+
+  def test_digest_cache_xattr(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = DigestCache(os.path.join(tmpdir, 'digests.json'), use_xattr=True)
+      fn = os.path.join(tmpdir, 'testfile')
+      with open(fn, 'wb') as fh:
+        fh.write(b"oink\n")
+      with open(fn, 'rb') as fh:
+        key = DigestCache.key_for(fh)
+        cache.store(key, 'oinkdigest', fh)
+        try:
+          os.getxattr(fn, 'user.hinkskalle.sha256')
+        except (OSError, AttributeError):
+          self.skipTest("no xattr support")
+        os.unlink(cache.path)
+        self.assertEqual(cache.lookup(key, fh), 'oinkdigest')
+
+  def test_digest_cache_xattr_invalid(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = DigestCache(os.path.join(tmpdir, 'digests.json'), use_xattr=True)
+      fn = os.path.join(tmpdir, 'testfile')
+      with open(fn, 'wb') as fh:
+        fh.write(b"oink\n")
+      with open(fn, 'rb') as fh:
+        key = DigestCache.key_for(fh)
+        for value in [ b'oink', b'five:100:digest', b'5:x:digest', b'\xff' ]:
+          with mock.patch('os.getxattr', create=True, return_value=value):
+            self.assertIsNone(cache.lookup(key, fh))
+
+  def test_push_chunked(self):
+    data = os.urandom(1000)
+    for in_order, connections in ((True, 1), (True, 4), (False, 4)):
+      with FakeRegistry() as reg, tempfile.TemporaryFile('wb+') as testdata:
+        reg.chunks_in_order = in_order
+        testdata.write(data)
+        testdata.seek(0)
+        api = HinkApi(base=reg.base, key='secret')
+        api.digest_cache = None
+        digest, size = api.push_blob(entity='test.hase', container='test', data=typing.cast(typing.BinaryIO, testdata), chunk_size=100, connections=connections, private=True, valid_for='2w')
+      self.assertEqual(size, 1000)
+      self.assertEqual(reg.blobs[f"sha256:{digest}"], data)
+      patches = len([ r for r in reg.requests if r[0] == 'PATCH' ])
+      if in_order and connections > 1:
+        # some chunks get rejected and are sent again in order
+        self.assertGreaterEqual(patches, 10)
+      else:
+        self.assertEqual(patches, 10)
+      self.assertEqual(reg.upload_params[-1]['private'], 'True')
+      self.assertIn('expiresAt', reg.upload_params[-1])
+
+  def test_push_chunked_resume(self):
+    data = os.urandom(1000)
+    with FakeRegistry() as reg, tempfile.TemporaryFile('wb+') as testdata:
+      reg.fail_patch_at = 500
+      testdata.write(data)
+      testdata.seek(0)
+      api = HinkApi(base=reg.base, key='secret')
+      api.digest_cache = None
+      digest, size = api.push_blob(entity='test.hase', container='test', data=typing.cast(typing.BinaryIO, testdata), chunk_size=100)
+    self.assertEqual(reg.blobs[f"sha256:{digest}"], data)
+    patches = [ r for r in reg.requests if r[0] == 'PATCH' ]
+    # 5 ok, 1 failed, 5 after resume
+    self.assertEqual(len(patches), 11)
+    self.assertIn(('GET', '/v2/test.hase/default/test/blobs/uploads/1'), reg.requests)
+
+  def test_push_chunked_first_fails(self):
+    data = os.urandom(1000)
+    with FakeRegistry() as reg, tempfile.TemporaryFile('wb+') as testdata:
+      # the session is still empty when asked, Range: 0-0
+      reg.fail_patch_at = 0
+      testdata.write(data)
+      testdata.seek(0)
+      api = HinkApi(base=reg.base, key='secret')
+      api.digest_cache = None
+      digest, size = api.push_blob(entity='test.hase', container='test', data=typing.cast(typing.BinaryIO, testdata), chunk_size=100)
+    self.assertEqual(reg.blobs[f"sha256:{digest}"], data)
+    patches = [ r for r in reg.requests if r[0] == 'PATCH' ]
+    self.assertEqual(len(patches), 11)
+
+  def test_push_tar_stream(self):
+    cwd = os.getcwd()
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      try:
+        os.mkdir('packme')
+        with open('packme/testfile', 'wb') as fh:
+          fh.write(os.urandom(5000))
+        with open('packme/excluded', 'w') as fh:
+          fh.write("something\n")
+        api = HinkApi(base=reg.base, key='secret')
+        with mock.patch.object(api, '_create_tar') as mock_create:
+          image_hash = api.push_file(tag='v1', container='test', filename='packme/', excludes=[r'excluded'], stream=True, chunk_size=1000)
+        mock_create.assert_not_called()
+      finally:
+        os.chdir(cwd)
+    self.assertGreater(len([ r for r in reg.requests if r[0] == 'PATCH' ]), 1)
+    blob = reg.blobs[f"sha256:{image_hash}"]
+    with tarfile.open(fileobj=io.BytesIO(blob), mode='r:gz') as tar:
+      self.assertCountEqual(tar.getnames(), ['packme/testfile'])
+    layer = reg.manifests['test.hase/default/test:v1']['layers'][0]
+    self.assertEqual(layer['size'], len(blob))
+    self.assertEqual(layer['annotations']['io.deis.oras.content.unpack'], 'true')
+
+  def test_push_tar_stream_first_fails(self):
+    cwd = os.getcwd()
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      reg.fail_patch_at = 0
+      os.chdir(tmpdir)
+      try:
+        os.mkdir('packme')
+        with open('packme/testfile', 'wb') as fh:
+          fh.write(os.urandom(5000))
+        api = HinkApi(base=reg.base, key='secret')
+        image_hash = api.push_file(tag='v1', container='test', filename='packme/', stream=True, chunk_size=1000)
+      finally:
+        os.chdir(cwd)
+    # the first chunk is sent again from byte 0
+    blob = reg.blobs[f"sha256:{image_hash}"]
+    with tarfile.open(fileobj=io.BytesIO(blob), mode='r:gz') as tar:
+      self.assertCountEqual(tar.getnames(), ['packme/testfile'])
+
+  def test_parallel_gzip(self):
+    data = os.urandom(100000) + b"oink" * 100000
+    out = io.BytesIO()
+    writer = ParallelGzipWriter(out, threads=4, block_size=10000)
+    for i in range(0, len(data), 3333):
+      writer.write(data[i:i+3333])
+    writer.close()
+    self.assertEqual(gzip.decompress(out.getvalue()), data)
+    # one gzip member
+    self.assertEqual(out.getvalue().count(b'\x1f\x8b\x08'), 1)
+
+  def test_codec_levels(self):
+    data = b"oink" * 100000
+    gz = get_codec('gzip')
+    self.assertEqual(gz.level(), 6)
+    # 0 is a level, not unset: stored blocks
+    out = io.BytesIO()
+    writer = gz.writer(out, level=0, threads=2)
+    writer.write(data)
+    writer.close()
+    self.assertEqual(gzip.decompress(out.getvalue()), data)
+    self.assertGreater(len(out.getvalue()), len(data))
+    with self.assertRaisesRegex(Exception, r'gzip compression level must be 0-9'):
+      gz.writer(io.BytesIO(), level=10)
+    with self.assertRaisesRegex(Exception, r'zstd compression level must be 1-22'):
+      get_codec('zstd').level(0)
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_tar_codecs(self):
+    api = HinkApi()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      try:
+        os.mkdir('packme')
+        with open('packme/testfile', 'w') as fh:
+          fh.write("something\n")
+        for codec, mode in (('gzip', 'r:gz'), ('none', 'r:')):
+          tarf = api._create_tar('packme', codec=codec, compress_level=1, threads=2)
+          with tarfile.open(tarf, mode) as tar:
+            self.assertCountEqual(tar.getnames(), ['packme/testfile'])
+        try:
+          import zstandard
+        except ImportError:
+          return
+        tarf = api._create_tar('packme', codec='zstd')
+        with open(tarf, 'rb') as fh, zstandard.ZstdDecompressor().stream_reader(fh) as zfh, tarfile.open(fileobj=zfh, mode='r|') as tar:
+          self.assertCountEqual(tar.getnames(), ['packme/testfile'])
+      finally:
+        os.chdir(cwd)
+
+  def test_push_codec_manifest(self):
+    cwd = os.getcwd()
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      try:
+        os.mkdir('packme')
+        with open('packme/testfile', 'w') as fh:
+          fh.write("something\n")
+        api = HinkApi(base=reg.base, key='secret')
+        api.push_file(tag='v1', container='test', filename='packme', codec='none')
+      finally:
+        os.chdir(cwd)
+    layer = reg.manifests['test.hase/default/test:v1']['layers'][0]
+    self.assertEqual(layer['mediaType'], 'application/vnd.oci.image.layer.v1.tar')
+    self.assertEqual(layer['annotations']['io.deis.oras.content.unpack'], 'false')
+
+  def test_reproducible_tar(self):
+    cwd = os.getcwd()
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      try:
+        os.makedirs('packme/subdir')
+        for fn in ('packme/b', 'packme/a', 'packme/subdir/c'):
+          with open(fn, 'w') as fh:
+            fh.write(f"{fn}\n")
+        api = HinkApi(base=reg.base, key='secret')
+        first = api.push_file(tag='v1', container='test', filename='packme')
+        with mock.patch('hinkskalle_api.util.codecs.time.time', return_value=4711):
+          second = api.push_file(tag='v2', container='test', filename='packme')
+        self.assertEqual(first, second)
+        # only the first push uploaded data
+        self.assertEqual(len([ r for r in reg.requests if r[0] == 'POST' ]), 2)
+
+        tarf = api._create_tar('packme')
+        with open(tarf, 'rb') as fh:
+          self.assertEqual(fh.read(8)[4:], b'\0\0\0\0')
+        with tarfile.open(tarf, 'r:gz') as tar:
+          self.assertListEqual(tar.getnames(), ['packme/a', 'packme/b', 'packme/subdir/c'])
+          for info in tar.getmembers():
+            self.assertEqual((info.uid, info.gid, info.uname, info.gname), (0, 0, '', ''))
+            self.assertEqual(info.mtime, int(os.stat(info.name).st_mtime))
+
+        with mock.patch.dict(os.environ, { 'SOURCE_DATE_EPOCH': '4711' }):
+          tarf = api._create_tar('packme')
+        with tarfile.open(tarf, 'r:gz') as tar:
+          self.assertSetEqual(set(info.mtime for info in tar.getmembers()), { 4711 })
+      finally:
+        os.chdir(cwd)
+
+  def test_exclude_matcher(self):
+    matcher = ExcludeMatcher([re.compile(r'\.pyc$'), r'/build/'])
+    self.assertTrue(matcher.excluded('packme/a.pyc', 'a.pyc'))
+    self.assertTrue(matcher.excluded('packme/build/x', 'build/x'))
+    self.assertFalse(matcher.excluded('packme/a.py', 'a.py'))
+    self.assertFalse(ExcludeMatcher())
+
+    matcher = ExcludeMatcher(['*.log', '!keep.log', 'build/', '/top', 'docs/**/*.tmp', '# comment', ''], gitignore=True)
+    self.assertTrue(matcher.excluded('packme/sub/x.log', 'sub/x.log'))
+    self.assertFalse(matcher.excluded('packme/sub/keep.log', 'sub/keep.log'))
+    self.assertTrue(matcher.excluded('packme/sub/build', 'sub/build', is_dir=True))
+    self.assertFalse(matcher.excluded('packme/sub/build', 'sub/build', is_dir=False))
+    self.assertTrue(matcher.excluded('packme/top', 'top'))
+    self.assertFalse(matcher.excluded('packme/sub/top', 'sub/top'))
+    self.assertTrue(matcher.excluded('packme/docs/a/b/c.tmp', 'docs/a/b/c.tmp'))
+    self.assertTrue(matcher.excluded('packme/docs/c.tmp', 'docs/c.tmp'))
+
+  def test_scan_tree(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.makedirs(os.path.join(tmpdir, 'keep/sub'))
+      os.makedirs(os.path.join(tmpdir, 'node_modules/deep'))
+      for fn in ('a', 'keep/sub/b', 'node_modules/deep/c'):
+        with open(os.path.join(tmpdir, fn), 'w') as fh:
+          fh.write('oink')
+      os.symlink('keep', os.path.join(tmpdir, 'link'))
+      with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+        result = scan_tree(tmpdir, ExcludeMatcher(['node_modules/'], gitignore=True))
+      # excluded directory was not even listed
+      self.assertNotIn(mock.call(os.path.join(tmpdir, 'node_modules')), scandir.call_args_list)
+      self.assertCountEqual([ os.path.relpath(p, tmpdir) for p, _ in result.entries ], ['a', 'keep/sub/b', 'link'])
+      self.assertEqual((result.files, result.dirs, result.excluded, result.total_size), (3, 2, 1, 8))
+
+  def test_tar_gitignore(self):
+    api = HinkApi(base='http://localhost', key='secret')
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      try:
+        os.makedirs('packme/subdir')
+        for fn in ('packme/a.log', 'packme/keep.log', 'packme/subdir/c'):
+          with open(fn, 'w') as fh:
+            fh.write(f"{fn}\n")
+        os.link('packme/subdir/c', 'packme/d')
+        os.symlink('subdir', 'packme/link')
+        tarf = api._create_tar('packme', excludes=['*.log', '!keep.log'], gitignore=True)
+        with tarfile.open(tarf, 'r:gz') as tar:
+          self.assertListEqual(tar.getnames(), ['packme/d', 'packme/keep.log', 'packme/link', 'packme/subdir/c'])
+          self.assertTrue(tar.getmember('packme/link').issym())
+          self.assertTrue(tar.getmember('packme/subdir/c').islnk())
+          self.assertEqual(tar.extractfile('packme/d').read(), b"packme/subdir/c\n")
+      finally:
+        os.chdir(cwd)
+
+  def test_hash_file(self):
+    data = os.urandom(3*1024*1024+17)
+    expected = hashlib.sha256(data).hexdigest()
+    with tempfile.NamedTemporaryFile() as tmp:
+      tmp.write(data)
+      tmp.flush()
+      with open(tmp.name, 'rb') as fh:
+        with mock.patch('hinkskalle_api.util.hashing.mmap.mmap', wraps=mmap.mmap) as mm:
+          self.assertEqual(hash_file(fh), (expected, len(data)))
+        mm.assert_called_once()
+        self.assertEqual(fh.tell(), len(data))
+
+        fh.seek(4711)
+        self.assertEqual(hash_file(fh, use_mmap=False), (hashlib.sha256(data[4711:]).hexdigest(), len(data)-4711))
+
+        fh.seek(0)
+        progress = []
+        self.assertEqual(hash_file(fh, block_size=1024*1024, use_mmap=False, progress=progress.append), (expected, len(data)))
+        self.assertListEqual(progress, [1024*1024]*3+[17])
+
+        hl = ResumableSha256()
+        hash_range(fh, hl, 10, 100000, block_size=4096)
+        self.assertEqual(hl.hexdigest(), hashlib.sha256(data[10:100010]).hexdigest())
+        with self.assertRaisesRegex(Exception, r'short read'):
+          hash_range(fh, hashlib.sha256(), len(data)-10, 20)
+
+    self.assertEqual(hash_file(io.BytesIO(data), block_size=1000), (expected, len(data)))
+    self.assertEqual(hash_file(io.BytesIO(b'')), (hashlib.sha256().hexdigest(), 0))
+
+  def test_http_cache(self):
+    with FakeRegistry() as reg:
+      reg.add_download(b"oink\n", 'testfile', ['v1'])
+      api = HinkApi(base=reg.base, key='secret')
+      first = api.list_manifests('test', entity='test.hase')
+      second = api.list_manifests('test', entity='test.hase')
+      self.assertListEqual([ m.id for m in first ], [ m.id for m in second ])
+      self.assertEqual(reg.not_modified, 1)
+      self.assertEqual(api.http_cache.revalidated, 1) # type: ignore
+
+      # another token does not see our entries
+      other = HinkApi(base=reg.base, key='other')
+      other.list_manifests('test', entity='test.hase')
+      self.assertEqual(reg.not_modified, 1)
+
+      # changes on the server are picked up
+      reg.add_download(b"grunz\n", 'otherfile', ['v2'])
+      self.assertEqual(len(api.list_manifests('test', entity='test.hase')), 2)
+
+      uncached = HinkApi(base=reg.base, key='secret', use_cache=False)
+      uncached.list_manifests('test', entity='test.hase')
+      self.assertEqual(reg.not_modified, 1)
+
+  def test_iter_data(self):
+    doc = json.dumps({ 'meta': { 'count': [ 1, 2 ] }, 'data': [ { 'name': 'hasé', 'size': 12345 }, 678, 'x', None, [ 1, { 'a': '}' } ] ], 'more': 'stuff' }).encode('utf8')
+    expected = json.loads(doc)['data']
+    for size in (1, 3, 1000):
+      chunks = [ doc[i:i+size] for i in range(0, len(doc), size) ]
+      self.assertListEqual(list(iter_data(chunks)), expected)
+    self.assertListEqual(list(iter_data([ b' [1, 2', b'3 ] ' ])), [ 1, 23 ])
+    self.assertListEqual(list(iter_data([ b'{"data": []}' ])), [])
+    self.assertListEqual(list(iter_data([ b'{}' ])), [])
+    with self.assertRaisesRegex(Exception, r'not a list'):
+      list(iter_data([ b'{"data": {}}' ]))
+
+  def test_iter_manifests(self):
+    with FakeRegistry() as reg:
+      for i in range(5):
+        reg.add_download(f"oink {i}\n".encode('utf8'), f'testfile{i}', [f'v{i}'])
+      api = HinkApi(base=reg.base, key='secret', use_cache=False)
+      it = api.iter_manifests('test', entity='test.hase')
+      self.assertEqual(next(it).filename, 'testfile0')
+      self.assertListEqual([ m.filename for m in it ], [ f'testfile{i}' for i in range(1, 5) ])
+
+      api.page_size = 2
+      for paging in (True, False):
+        reg.paging = paging
+        reg.requests.clear()
+        self.assertListEqual([ m.filename for m in api.iter_manifests('test', entity='test.hase') ], [ f'testfile{i}' for i in range(5) ])
+        self.assertEqual(len([ r for r in reg.requests if r[1].endswith('/manifests') ]), 3 if paging else 1)
+
+      # exactly one page, server ignores the parameters
+      del reg.listing['test.hase/default/test'][2:]
+      reg.requests.clear()
+      self.assertEqual(len(api.list_manifests('test', entity='test.hase')), 2)
+      self.assertEqual(len([ r for r in reg.requests if r[1].endswith('/manifests') ]), 2)
+
+  def test_disk_usage(self):
+    with FakeRegistry() as reg:
+      reg.entities['test.hase'] = { 'name': 'test.hase', 'usedQuota': 4711, 'quota': 10000 }
+      for coll in ('raw', 'results', 'empty'):
+        if coll == 'empty':
+          reg.collections['test.hase'].append({ 'name': 'empty' })
+          continue
+        for cont in ('a', 'b', 'c'):
+          path = f'test.hase/{coll}/{cont}'
+          reg.add_container(path, usedQuota=100)
+          for i in range(2):
+            m = reg.add_download(f"{path} {i}\n".encode('utf8'), f'file{i}', [f'v{i}'], container=path)
+            m['downloadCount'] = 3
+          reg.images[path] = [ { 'hash': m['images'][0].replace('sha256:', 'sha256.'), 'expiresAt': f'2030-01-0{ord(cont)-96}T00:00:00' } ]
+      reg.delay = 0.2
+      api = HinkApi(base=reg.base, key='secret', use_cache=False)
+      start = time.perf_counter()
+      usage = list(api.disk_usage(workers=16))
+      # 1 + 3 + 6*2 listings, one after the other they would take 3.2s
+      self.assertLess(time.perf_counter() - start, 2.0)
+
+    self.assertEqual([ u.level for u in usage ].count('container'), 6)
+    by_path = { u.path: u for u in usage }
+    self.assertEqual(by_path['test.hase/raw/b'].manifests, 2)
+    self.assertEqual(by_path['test.hase/raw/b'].downloads, 6)
+    self.assertEqual(by_path['test.hase/raw/b'].used_quota, 100)
+    self.assertEqual(by_path['test.hase/raw/b'].expires, datetime(2030, 1, 2))
+    self.assertEqual(by_path['test.hase/results'].manifests, 6)
+    self.assertEqual(by_path['test.hase/results'].expires, datetime(2030, 1, 1))
+    self.assertEqual(by_path['test.hase/empty'].manifests, 0)
+    top = usage[-1]
+    self.assertEqual((top.level, top.manifests, top.downloads, top.used_quota, top.quota), ('entity', 12, 36, 4711, 10000))
+    self.assertEqual(top.size, sum(u.size for u in usage if u.level == 'container'))
+    # every collection comes after its containers
+    for i, u in enumerate(usage):
+      if u.level == 'container':
+        self.assertTrue(any(c.path == u.path.rsplit('/', 1)[0] for c in usage[i+1:]))
+
+  def test_sync(self):
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      out = os.path.join(tmpdir, 'mirror')
+      reg.add_download(b"oink\n", 'test.bin', ['v1', 'latest'])
+      reg.add_download(b"grunz\n", 'other.bin', ['v2'])
+      api = HinkApi(base=reg.base, key='secret', use_cache=False)
+      report = api.sync('test', out, entity='test.hase')
+      self.assertEqual((len(report.downloaded), len(report.linked)), (2, 1))
+      with open(os.path.join(out, 'latest', 'test.bin'), 'rb') as fh:
+        self.assertEqual(fh.read(), b"oink\n")
+      self.assertTrue(os.path.samefile(os.path.join(out, 'v1', 'test.bin'), os.path.join(out, 'latest', 'test.bin')))
+
+      # unchanged: one listing, no data
+      reg.requests.clear()
+      report = api.sync('test', out, entity='test.hase')
+      self.assertEqual(len(report.unchanged), 3)
+      self.assertListEqual([ r[1] for r in reg.requests ], [ '/v1/containers/test.hase/default/test/manifests' ])
+
+      # tags swap their data: nothing to download
+      listing = reg.listing['test.hase/default/test']
+      listing[0]['tags'], listing[1]['tags'] = ['v2'], ['v1', 'latest']
+      reg.requests.clear()
+      report = api.sync('test', out, entity='test.hase')
+      self.assertEqual((len(report.downloaded), len(report.linked), len(report.removed)), (0, 3, 3))
+      self.assertFalse(any('/blobs/' in r[1] for r in reg.requests))
+      with open(os.path.join(out, 'v1', 'other.bin'), 'rb') as fh:
+        self.assertEqual(fh.read(), b"grunz\n")
+      with open(os.path.join(out, 'v2', 'test.bin'), 'rb') as fh:
+        self.assertEqual(fh.read(), b"oink\n")
+      self.assertFalse(os.path.exists(os.path.join(out, 'v1', 'test.bin')))
+
+      # removed tags stay without prune
+      listing[1]['tags'] = ['latest']
+      api.sync('test', out, entity='test.hase')
+      self.assertTrue(os.path.exists(os.path.join(out, 'v1', 'other.bin')))
+      report = api.sync('test', out, entity='test.hase', prune=True)
+      self.assertListEqual(report.removed, [ os.path.join('v1', 'other.bin') ])
+      self.assertFalse(os.path.exists(os.path.join(out, 'v1')))
+      self.assertListEqual(sorted(os.listdir(out)), [ '.hinkli-sync.json', 'latest', 'v2' ])
+
+      with self.assertRaisesRegex(Exception, r'mirror of test.hase/default/test'):
+        api.sync('other', out, entity='test.hase')
+
+      # broken download: reported, nothing left behind, the rest is synced
+      bad = reg.add_download(b"quiek\n", 'bad.bin', ['v3'])
+      reg.add_download(b"piep\n", 'good.bin', ['v4'])
+      reg.blobs[bad['images'][0]] = b"kaputt"
+      with self.assertRaisesRegex(Exception, r'1 download\(s\) failed.*Checksum mismatch'):
+        api.sync('test', out, entity='test.hase')
+      self.assertTrue(os.path.exists(os.path.join(out, 'v4', 'good.bin')))
+      self.assertFalse(os.path.exists(os.path.join(out, 'v3')))
+      self.assertFalse([ f for f in os.listdir(out) if f.startswith('.hinkli-sync-') ])
+
+  def test_blob_cache(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = BlobCache(os.path.join(tmpdir, 'cache'), max_size=10)
+      digests = []
+      for i, data in enumerate([ b"oink", b"grunz", b"quiek" ]):
+        digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+        digests.append(digest)
+        with open(cache.tmp_path(digest), 'wb') as fh:
+          fh.write(data)
+        cache.store(cache.tmp_path(digest), digest)
+        os.utime(cache.blob_path(digest), (1000+i, 1000+i))
+      # 4+5+5 bytes: the oldest one had to go
+      self.assertIsNone(cache.lookup(digests[0]))
+      self.assertListEqual([ b.digest for b in cache.entries() ], digests[1:])
+
+      self.assertEqual(cache.lookup(digests[1]), cache.blob_path(digests[1]))
+      self.assertEqual(cache.materialize(digests[1], os.path.join(tmpdir, 'grunz')), 'hardlink')
+      self.assertTrue(os.path.samefile(os.path.join(tmpdir, 'grunz'), cache.blob_path(digests[1])))
+      self.assertEqual(os.stat(cache.blob_path(digests[1])).st_mode & 0o777, 0o444)
+      cache.link = 'copy'
+      self.assertEqual(cache.materialize(digests[1], os.path.join(tmpdir, 'grunz')), 'copy')
+      self.assertFalse(os.path.samefile(os.path.join(tmpdir, 'grunz'), cache.blob_path(digests[1])))
+
+      # a blob being fetched stays
+      with cache.lock(digests[2]):
+        self.assertListEqual([ b.digest for b in cache.evict(max_size=0) ], [ digests[1] ])
+      self.assertListEqual([ b.digest for b in cache.evict(older_than=time.time()-60) ], [ digests[2] ])
+      with self.assertRaisesRegex(Exception, r'invalid digest'):
+        cache.lookup('sha256:../../etc/passwd')
+
+      # lock files go with their blobs, or when nothing was ever stored
+      with cache.lock(digests[0]):
+        pass
+      self.assertEqual(cache.prune_locks(), 1)
+      self.assertListEqual(os.listdir(os.path.join(tmpdir, 'cache', 'locks')), [])
+
+  def test_parse_digest(self):
+    hex = hashlib.sha256(b"oink").hexdigest()
+    self.assertEqual(parse_digest(f"sha256:{hex}"), f"sha256:{hex}")
+    self.assertEqual(parse_digest(f"sha256.{hex}"), f"sha256:{hex}")
+    for invalid in [ None, '', hex, 'sha256:oink', f"md5:{hex}" ]:
+      self.assertIsNone(parse_digest(invalid))
+
+  def test_fetch_blob_cache(self):
+    data = os.urandom(10000)
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      reg.add_download(data, 'test.bin', ['v1'])
+      api = HinkApi(base=reg.base, key='secret', use_cache=False)
+      api.blob_cache = BlobCache(os.path.join(tmpdir, 'cache'))
+      outs = [ os.path.join(tmpdir, f'out{i}') for i in range(8) ]
+      for out in outs:
+        os.mkdir(out)
+      # all at once: one downloads, the others wait for it
+      with ThreadPoolExecutor(max_workers=8) as executor:
+        fns = list(executor.map(lambda out: api.fetch_blob(container='test', tag='v1', out=out), outs))
+      self.assertEqual(len([ r for r in reg.requests if r[1].endswith('/download') ]), 1)
+      for fn in fns:
+        with open(fn, 'rb') as fh:
+          self.assertEqual(fh.read(), data)
+      self.assertTrue(os.path.samefile(fns[0], fns[-1]))
+
+  def test_fetch_blob_cache_digests(self):
+    data = os.urandom(1000)
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      # hinkskalle image hashes use a dot
+      dotted = reg.add_download(data, 'test.bin', ['v1'])
+      dotted['images'] = [ dotted['images'][0].replace('sha256:', 'sha256.') ]
+      # nothing to key the cache on
+      invalid = reg.add_download(data, 'test.bin', ['v2'])
+      invalid['images'] = [ 'oink' ]
+      api = HinkApi(base=reg.base, key='secret', use_cache=False)
+      api.blob_cache = BlobCache(os.path.join(tmpdir, 'cache'))
+
+      fn = api.fetch_blob(container='test', tag='v1', out=os.path.join(tmpdir, 'dotted'))
+      self.assertTrue(os.path.samefile(fn, api.blob_cache.blob_path(f"sha256:{dotted['hash']}")))
+
+      fn = api.fetch_blob(container='test', tag='v2', out=os.path.join(tmpdir, 'invalid'))
+      with open(fn, 'rb') as fh:
+        self.assertEqual(fh.read(), data)
+      self.assertFalse(os.path.samefile(fn, api.blob_cache.blob_path(f"sha256:{dotted['hash']}")))
+      self.assertEqual(len([ r for r in reg.requests if r[1].endswith('/download') ]), 2)
+
+  def test_stage_file(self):
+    data = os.urandom(10000)
+    with tempfile.TemporaryDirectory() as tmpdir:
+      src = os.path.join(tmpdir, 'src')
+      with open(src, 'wb') as fh:
+        fh.write(data)
+      dest = os.path.join(tmpdir, 'staged')
+      with open(src, 'rb') as fh:
+        self.assertEqual(stage_file(fh, dest, len(data)), ('hardlink', None))
+      self.assertTrue(os.path.samefile(src, dest))
+      # again over the same link
+      with open(src, 'rb') as fh:
+        self.assertEqual(stage_file(fh, dest, len(data)), ('hardlink', None))
+      self.assertListEqual(sorted(os.listdir(tmpdir)), [ 'src', 'staged' ])
+
+      with open(src, 'rb') as fh:
+        mode, digest = stage_file(fh, dest, len(data), link='reflink')
+      self.assertIn(mode, ('reflink', 'copy_file_range', 'copy'))
+      self.assertFalse(os.path.samefile(src, dest))
+      with open(dest, 'rb') as fh:
+        self.assertEqual(fh.read(), data)
+
+      # nothing to link from: copied and hashed on the way
+      mode, digest = stage_file(io.BytesIO(data), dest, len(data))
+      self.assertEqual(mode, 'copy')
+      self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+      with self.assertRaisesRegex(Exception, r'expected 10001 bytes'):
+        stage_file(io.BytesIO(data), dest, len(data)+1)
+      with self.assertRaisesRegex(Exception, r'unknown staging mode'):
+        stage_file(io.BytesIO(data), dest, len(data), link='teleport')
+
+  def test_push_staged(self):
+    data = os.urandom(10000)
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      reg.staging_path = os.path.join(tmpdir, 'staging')
+      src = os.path.join(tmpdir, 'src')
+      with open(src, 'wb') as fh:
+        fh.write(data)
+      api = HinkApi(base=reg.base, key='secret', use_cache=False)
+      api.digest_cache = None
+      api.staging_path = reg.staging_path
+      api.staging_threshold = 1000
+      with open(src, 'rb') as fh, mock.patch('hinkskalle_api.util.fastcopy.copy_hashing') as mock_copy:
+        digest, size = api.push_blob(entity='test.hase', container='test', data=typing.cast(typing.BinaryIO, fh))
+      mock_copy.assert_not_called()
+      self.assertEqual(reg.blobs[f"sha256:{digest}"], data)
+      self.assertEqual(reg.upload_params, [])
+      self.assertListEqual(os.listdir(reg.staging_path), [])
+
+      # below the threshold: regular upload
+      api.staging_threshold = 10000
+      small = os.urandom(10000)
+      digest, _ = api.push_blob(entity='test.hase', container='test', data=io.BytesIO(small))
+      self.assertEqual(reg.blobs[f"sha256:{digest}"], small)
+
+      # buffered copies are checked against the digest we were given
+      api.staging_threshold = 1000
+      with self.assertRaisesRegex(Exception, r'Checksum mismatch while staging'):
+        api.upload_blob(io.BytesIO(data), 'f'*64, len(data), entity='test.hase', container='test')
+      self.assertListEqual(os.listdir(reg.staging_path), [])
+
+  def test_http_cache_max_age(self):
+    with FakeRegistry() as reg:
+      reg.cache_control = 'max-age=60'
+      reg.add_download(b"oink\n", 'testfile', ['v1'])
+      api = HinkApi(base=reg.base, key='secret')
+      api.list_manifests('test', entity='test.hase')
+      before = len(reg.requests)
+      api.list_manifests('test', entity='test.hase')
+      self.assertEqual(len(reg.requests), before)
+
+      # pushing a manifest makes us ask again
+      api.push_manifest({}, tag='v2', container='test', entity='test.hase')
+      before = len(reg.requests)
+      api.list_manifests('test', entity='test.hase')
+      self.assertEqual(len(reg.requests), before+1)
+
+  def test_http_cache_eviction(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = HttpCache(tmpdir, max_size=1000)
+      for i in range(10):
+        key = HttpCache.key_for(f'http://localhost/{i}', 'secret')
+        cache.store(key, f'http://localhost/{i}', 'x'*200, { 'ETag': f'"{i}"' })
+        os.utime(cache._fn(key), (i, i))
+      self.assertLessEqual(sum(e.stat().st_size for e in os.scandir(tmpdir)), 1000)
+      self.assertIsNotNone(cache.lookup(HttpCache.key_for('http://localhost/9', 'secret')))
+      self.assertIsNone(cache.lookup(HttpCache.key_for('http://localhost/0', 'secret')))
+
+      key = HttpCache.key_for('http://localhost/nostore', 'secret')
+      self.assertIsNone(cache.store(key, 'http://localhost/nostore', '{}', { 'ETag': '"1"', 'Cache-Control': 'no-store' }))
+      self.assertIsNone(cache.store(key, 'http://localhost/nostore', '{}', {}))
+      self.assertIsNone(cache.lookup(key))
+
+  def test_manifest_index(self):
+    with FakeRegistry() as reg:
+      for i in range(50):
+        reg.add_download(f"oink {i}\n".encode('utf8'), f'testfile{i}', [f'v{i}'])
+      api = HinkApi(base=reg.base, key='secret')
+      self.assertEqual(api.get_manifest('test', tag='v3').filename, 'testfile3')
+      self.assertEqual(api.get_manifest('test', tag='v42').filename, 'testfile42')
+      hash = reg.listing['test.hase/default/test'][7]['hash']
+      self.assertEqual(api.get_manifest('test', hash=f"sha256:{hash}").filename, 'testfile7')
+      with self.assertRaisesRegex(Exception, r'not found'):
+        api.get_manifest('test', tag='oink')
+      # one probe for the direct route, then the listing, and again when a tag is missing
+      listings = [ r for r in reg.requests if r[1].endswith('/manifests') ]
+      probes = [ r for r in reg.requests if ':' in r[1] ]
+      self.assertEqual((len(listings), len(probes)), (2, 1))
+      self.assertFalse(api.direct_tag_lookup)
+
+      # the next client knows that already
+      before = len(reg.requests)
+      api2 = HinkApi(base=reg.base, key='secret')
+      self.assertEqual(api2.get_manifest('test', tag='v3').filename, 'testfile3')
+      self.assertListEqual([ r for r in reg.requests[before:] if ':' in r[1] ], [])
+
+      # new manifests from our own pushes are seen
+      reg.add_download(b"grunz\n", 'newfile', ['new'])
+      api.push_manifest({}, tag='new', container='test', entity='test.hase')
+      self.assertEqual(api.get_manifest('test', tag='new').filename, 'newfile')
+
+  def test_manifest_direct_tag(self):
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      reg.direct_tags = True
+      for i in range(50):
+        reg.add_download(f"oink {i}\n".encode('utf8'), f'testfile{i}', [f'v{i}'])
+      api = HinkApi(base=reg.base, key='secret')
+      out = api.fetch_blob('test', tag='v23', out=tmpdir)
+      with open(out, 'rb') as fh:
+        self.assertEqual(fh.read(), b"oink 23\n")
+      self.assertTrue(api.direct_tag_lookup)
+      self.assertListEqual([ r for r in reg.requests if r[1].endswith('/manifests') ], [])
+      self.assertTrue(HinkApi(base=reg.base, key='secret').server_info.lookup(reg.base, 'direct_tag_lookup'))
+
+  def test_manifest_direct_tag_error(self):
+    with FakeRegistry() as reg:
+      reg.direct_tags = True
+      reg.direct_tags_status = 503
+      reg.add_download(b"oink\n", 'testfile', ['v1'])
+      api = HinkApi(base=reg.base, key='secret')
+      self.assertEqual(api.get_manifest('test', tag='v1').filename, 'testfile')
+      # a failed probe says nothing about the route
+      self.assertIsNone(api.direct_tag_lookup)
+      self.assertIsNone(api.server_info.lookup(reg.base, 'direct_tag_lookup'))
+
+      reg.direct_tags_status = None
+      api = HinkApi(base=reg.base, key='secret')
+      api.get_manifest('test', tag='v1')
+      self.assertTrue(api.direct_tag_lookup)
+
+  def test_user_cache(self):
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      status = lambda: len([ r for r in reg.requests if r[1] == '/v1/token-status' ])
+      HinkApi(base=reg.base, key='secret').list_manifests('test')
+      self.assertEqual(status(), 1)
+      api = HinkApi(base=reg.base, key='secret')
+      api.list_manifests('test')
+      self.assertEqual(status(), 1)
+      self.assertEqual(api.user.username, 'test.hase') # type: ignore
+      with open(os.path.join(api.cache_dir, 'users.json')) as fh:
+        self.assertNotIn('secret', fh.read())
+
+      HinkApi(base=reg.base, key='other').list_manifests('test')
+      self.assertEqual(status(), 2)
+      HinkApi(base=reg.base, key='secret', use_cache=False).list_manifests('test')
+      self.assertEqual(status(), 3)
+
+      with mock.patch('hinkskalle_api.util.user_cache.time.time', return_value=time.time()+3601):
+        HinkApi(base=reg.base, key='secret').list_manifests('test')
+      self.assertEqual(status(), 4)
+
+      # a new token forgets the old identity
+      with mock.patch.dict(os.environ, { 'HINK_API_CFG': os.path.join(tmpdir, 'hink.yml') }):
+        api = HinkApi(base=reg.base, key='secret')
+        api.get_token(username='test.hase', password='oink')
+      HinkApi(base=reg.base, key='secret').list_manifests('test')
+      self.assertEqual(status(), 5)
+
+  def test_load_config(self):
+    import yaml
+    flat = "hink_api_base: https://testha.se/\nhink_api_key: secret.token-123_x\n# comment\n\nhink_api_pool_maxsize: 16\nhink_api_keep_alive: false\nhink_api_cache_dir: /scratch/me/.hinkli\n"
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, 'hink.yml')
+      for text in (flat, "hink_api_base: 'https://testha.se'\nhink_api_keep_alive: yes\nhink_api_http_cache_ttl: 1.5\n", "a: b # comment\na2: 0x10\na3: 1:20\n", ""):
+        with open(fn, 'w') as fh:
+          fh.write(text)
+        self.assertDictEqual(load_config(fn), yaml.safe_load(text) or {})
@@ -0,0 +1,165 @@
+import asyncio
+import io
+import os
+import os.path
+import tempfile
+import threading
+import typing
+import unittest
+from unittest import mock
+
+from .registry import FakeRegistry
+
+try:
+  import httpx
+  from hinkskalle_api.async_api import AsyncHinkApi
+except ImportError:
+  httpx = None
+
+
+@unittest.skipIf(httpx is None, "httpx not installed")
+class TestAsyncApi(unittest.TestCase):
+  def test_listings(self):
+    async def run(api: AsyncHinkApi):
+      return await asyncio.gather(*[ api.list_manifests('test') for _ in range(10) ])
+
+    with FakeRegistry() as reg:
+      reg.add_download(b"oink\n", 'test.bin', ['v1'])
+      api = AsyncHinkApi(base=reg.base, key='secret', use_cache=False, concurrency=2)
+      results = asyncio.run(self._with(api, run))
+    self.assertEqual(len(results), 10)
+    self.assertListEqual([ m.tags for m in results[0] ], [['v1']])
+    self.assertEqual(results[0][0].filename, 'test.bin')
+
+  def test_semaphore_lazy(self):
+    async def run(api: AsyncHinkApi):
+      return await api.list_manifests('test')
+
+    with FakeRegistry() as reg:
+      reg.add_download(b"oink\n", 'test.bin', ['v1'])
+      api = AsyncHinkApi(base=reg.base, key='secret', use_cache=False)
+      # created in the loop that runs the requests, not at construction
+      self.assertIsNone(api._slots)
+      asyncio.run(self._with(api, run))
+    self.assertIsNotNone(api._slots)
+
+  def test_download_token(self):
+    with FakeRegistry() as reg:
+      manifest = reg.add_download(b"oink\n", 'test.bin', ['v1'])
+      api = AsyncHinkApi(base=reg.base, key='secret', use_cache=False)
+      location = asyncio.run(self._with(api, lambda api: api.get_download_token(container='test', tag='v1')))
+    self.assertEqual(location, f"{reg.base}/v1/manifests/{manifest['id']}/download?temp_token=dl-1")
+
+  def test_fetch_blob(self):
+    data = os.urandom(1000)
+    for connections in (1, 4):
+      with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+        reg.add_download(data, 'test.bin', ['v1'])
+        api = AsyncHinkApi(base=reg.base, key='secret', use_cache=False)
+        seen: typing.List[int] = []
+        outfn = asyncio.run(self._with(api, lambda api: api.fetch_blob(container='test', tag='v1', out=tmpdir, connections=connections, segment_size=128, progress=seen.append)))
+        with open(outfn, 'rb') as fh:
+          self.assertEqual(fh.read(), data)
+        self.assertEqual(sum(seen), 1000)
+        downloads = [ r for r in reg.requests if r[1].endswith('/download') ]
+        self.assertEqual(len(downloads), 1 if connections == 1 else 9)
+
+  def test_fetch_checksum_mismatch(self):
+    with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+      manifest = reg.add_download(os.urandom(1000), 'test.bin', ['v1'])
+      reg.blobs[manifest['images'][0]] = os.urandom(1000)
+      api = AsyncHinkApi(base=reg.base, key='secret', use_cache=False)
+      with self.assertRaisesRegex(Exception, r'Checksum mismatch'):
+        asyncio.run(self._with(api, lambda api: api.fetch_blob(container='test', tag='v1', out=tmpdir)))
+
+  def test_push(self):
+    data = os.urandom(1000)
+    for chunk_size in (None, 100):
+      with FakeRegistry() as reg, tempfile.TemporaryFile('wb+') as testdata:
+        testdata.write(data)
+        testdata.seek(0)
+        api = AsyncHinkApi(base=reg.base, key='secret', use_cache=False)
+        api.digest_cache = None
+        async def run(api: AsyncHinkApi):
+          digest, size = await api.push_blob(container='test', data=typing.cast(typing.BinaryIO, testdata), chunk_size=chunk_size)
+          await api.push_manifest({ 'layers': [{ 'digest': f'sha256:{digest}', 'size': size }]}, tag='v1', container='test')
+          # second push finds the blob on the server
+          await api.push_blob(container='test', data=typing.cast(typing.BinaryIO, testdata))
+          return digest
+        digest = asyncio.run(self._with(api, run))
+      self.assertEqual(reg.blobs[f"sha256:{digest}"], data)
+      self.assertIn('test.hase/default/test:v1', reg.manifests)
+      self.assertEqual(len([ r for r in reg.requests if r[0] == 'PATCH' ]), 10 if chunk_size else 0)
+      self.assertEqual(len([ r for r in reg.requests if r[0] == 'HEAD' ]), 2)
+
+  def test_push_chunked_first_fails(self):
+    data = os.urandom(1000)
+    with FakeRegistry() as reg:
+      # the session is still empty when asked, Range: 0-0
+      reg.fail_patch_at = 0
+      api = AsyncHinkApi(base=reg.base, key='secret', use_cache=False)
+      api.digest_cache = None
+      digest, _ = asyncio.run(self._with(api, lambda api: api.push_blob(container='test', data=io.BytesIO(data), chunk_size=100)))
+    self.assertEqual(reg.blobs[f"sha256:{digest}"], data)
+    self.assertEqual(len([ r for r in reg.requests if r[0] == 'PATCH' ]), 11)
+
+  def test_push_without_digest(self):
+    data = os.urandom(1000)
+    with FakeRegistry() as reg:
+      reg.upload_digest = False
+      api = AsyncHinkApi(base=reg.base, key='secret', use_cache=False)
+      api.digest_cache = None
+      digest, size = asyncio.run(self._with(api, lambda api: api.push_blob(container='test', data=io.BytesIO(data))))
+    self.assertEqual(size, 1000)
+    self.assertEqual(reg.blobs[f"sha256:{digest}"], data)
+
+  def test_fetch_writes_off_loop(self):
+    from hinkskalle_api import async_api
+    from hinkskalle_api.util.http_cache import HttpCache
+    main = threading.get_ident()
+    writers: typing.Set[int] = set()
+
+    def recorded(fn):
+      def wrapper(*args):
+        writers.add(threading.get_ident())
+        return fn(*args)
+      return wrapper
+
+    data = os.urandom(1000)
+    for connections in (1, 4):
+      writers.clear()
+      with FakeRegistry() as reg, tempfile.TemporaryDirectory() as tmpdir:
+        reg.add_download(data, 'test.bin', ['v1'])
+        api = AsyncHinkApi(base=reg.base, key='secret')
+        with mock.patch.object(async_api, '_write_hashed', recorded(async_api._write_hashed)), \
+            mock.patch.object(async_api.os, 'pwrite', recorded(os.pwrite)), \
+            mock.patch.object(HttpCache, 'store', recorded(HttpCache.store)):
+          outfn = asyncio.run(self._with(api, lambda api: api.fetch_blob(container='test', tag='v1', out=tmpdir, connections=connections, segment_size=128)))
+        with open(outfn, 'rb') as fh:
+          self.assertEqual(fh.read(), data)
+      self.assertTrue(writers)
+      self.assertNotIn(main, writers)
+
+  def test_push_reads_off_loop(self):
+    main = threading.get_ident()
+    readers: typing.Set[int] = set()
+
+    class Data(io.BytesIO):
+      def read(self, *args):
+        readers.add(threading.get_ident())
+        return super().read(*args)
+
+    for chunk_size in (None, 100):
+      readers.clear()
+      with FakeRegistry() as reg:
+        api = AsyncHinkApi(base=reg.base, key='secret', use_cache=False)
+        api.digest_cache = None
+        api.hash_mmap = False
+        asyncio.run(self._with(api, lambda api: api.push_blob(container='test', data=typing.cast(typing.BinaryIO, Data(os.urandom(1000))), chunk_size=chunk_size)))
+      self.assertTrue(readers)
+      self.assertNotIn(main, readers)
+
+  @staticmethod
+  async def _with(api: 'AsyncHinkApi', fn):
+    async with api:
+      return await fn(api)
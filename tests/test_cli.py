@@ -8,8 +8,11 @@ from click.testing import CliRunner
 from unittest import mock
 
 from hinkskalle_api import cli
+from hinkskalle_api.api import HinkApi
 import re
 import os
+import subprocess
+import sys
 
 
 class TestCli(unittest.TestCase):
@@ -35,7 +38,7 @@ class TestCli(unittest.TestCase):
     with mock.patch('hinkskalle_api.api.HinkApi.push_file') as mock_push:
       result = runner.invoke(cli.cli, ['push', 'testhase', 'testhase:v1', '--exclude', 'oink'], catch_exceptions=False)
     self.assertEqual(result.exit_code, 0)
-    mock_push.assert_called_with(entity=None, collection='default', container='testhase', tag='v1', progress=True, filename='testhase', excludes=[re.compile('oink')], private=False, valid_for=None)
+    mock_push.assert_called_with(entity=None, collection='default', container='testhase', tag='v1', progress=True, filename='testhase', excludes=[re.compile('oink')], private=False, valid_for=None, chunk_size=None, connections=1, stream=False, codec='gzip', compress_level=None, threads=None, reproducible=True, gitignore=False, layers=None, layer_size=1024*1024*1024)
 
   @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
   def test_push_valid_for(self):
@@ -43,7 +46,7 @@ class TestCli(unittest.TestCase):
     with mock.patch('hinkskalle_api.api.HinkApi.push_file') as mock_push:
       result = runner.invoke(cli.cli, ['push', 'testhase', 'testhase:v1', '--valid-for', '2w'], catch_exceptions=False)
     self.assertEqual(result.exit_code, 0)
-    mock_push.assert_called_with(entity=None, collection='default', container='testhase', tag='v1', progress=True, filename='testhase', excludes=[], private=False, valid_for='2w')
+    mock_push.assert_called_with(entity=None, collection='default', container='testhase', tag='v1', progress=True, filename='testhase', excludes=[], private=False, valid_for='2w', chunk_size=None, connections=1, stream=False, codec='gzip', compress_level=None, threads=None, reproducible=True, gitignore=False, layers=None, layer_size=1024*1024*1024)
   
   @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
   def test_push_exclude_file(self):
@@ -55,4 +58,156 @@ class TestCli(unittest.TestCase):
         ofh.write(".*\n")
       result = runner.invoke(cli.cli, ['push', 'testhase', 'testhase:v1', '--exclude-file', 'excludes'], catch_exceptions=False)
     self.assertEqual(result.exit_code, 0)
-    mock_push.assert_called_with(entity=None, collection='default', container='testhase', tag='v1', progress=True, filename='testhase', excludes=[re.compile('oink'), re.compile('.*')], private=False, valid_for=None)
+    mock_push.assert_called_with(entity=None, collection='default', container='testhase', tag='v1', progress=True, filename='testhase', excludes=[re.compile('oink'), re.compile('.*')], private=False, valid_for=None, chunk_size=None, connections=1, stream=False, codec='gzip', compress_level=None, threads=None, reproducible=True, gitignore=False, layers=None, layer_size=1024*1024*1024)
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_pull_parallel(self):
+    runner = CliRunner()
+    with mock.patch('hinkskalle_api.api.HinkApi.fetch_blob') as mock_fetch:
+      result = runner.invoke(cli.cli, ['pull', 'testhase:v1', '--connections', '8', '--segment-size', '16'], catch_exceptions=False)
+    self.assertEqual(result.exit_code, 0)
+    mock_fetch.assert_called_with(entity=None, collection='default', container='testhase', tag='v1', out=None, progress=True, connections=8, segment_size=16*1024*1024, resume=False, unpack=False)
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_pull_from_file(self):
+    runner = CliRunner()
+    with mock.patch('hinkskalle_api.api.HinkApi.pull_many') as mock_pull, runner.isolated_filesystem():
+      with open('spec.txt', 'w') as fh:
+        fh.write("testhase:v1\nother/testhase:v2 out.bin\n")
+      mock_pull.return_value.failed = []
+      result = runner.invoke(cli.cli, ['pull', '--from-file', 'spec.txt', '--workers', '8', '--out', 'data'], catch_exceptions=False)
+      self.assertEqual(result.exit_code, 0)
+      items = mock_pull.call_args.args[0]
+      self.assertListEqual([ i.path for i in items ], ['default/testhase:v1', 'other/testhase:v2'])
+      self.assertEqual(items[1].out, 'out.bin')
+      self.assertEqual(mock_pull.call_args.kwargs['workers'], 8)
+      self.assertEqual(mock_pull.call_args.kwargs['out'], 'data')
+
+      mock_pull.return_value.failed = [ mock.Mock() ]
+      result = runner.invoke(cli.cli, ['pull', '--from-file', 'spec.txt'])
+      self.assertEqual(result.exit_code, 1)
+      result = runner.invoke(cli.cli, ['pull', 'testhase:v1', '--from-file', 'spec.txt'])
+      self.assertEqual(result.exit_code, 1)
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_push_from_file(self):
+    runner = CliRunner()
+    with mock.patch('hinkskalle_api.api.HinkApi.push_many') as mock_push, runner.isolated_filesystem():
+      with open('spec.txt', 'w') as fh:
+        fh.write("run1/reads.fq.gz testhase:run1\nrun2/ other/testhase:run2\n")
+      mock_push.return_value.failed = []
+      result = runner.invoke(cli.cli, ['push', '--from-file', 'spec.txt', '--workers', '8', '--hash-workers', '2', '--private'], catch_exceptions=False)
+      self.assertEqual(result.exit_code, 0)
+      items = mock_push.call_args.args[0]
+      self.assertListEqual([ str(i) for i in items ], ['run1/reads.fq.gz -> default/testhase:run1', 'run2/ -> other/testhase:run2'])
+      self.assertEqual(mock_push.call_args.kwargs['workers'], 8)
+      self.assertEqual(mock_push.call_args.kwargs['hash_workers'], 2)
+      self.assertTrue(mock_push.call_args.kwargs['private'])
+
+      with open('spec.txt', 'w') as fh:
+        fh.write("run1/reads.fq.gz testhase\n")
+      result = runner.invoke(cli.cli, ['push', '--from-file', 'spec.txt'])
+      self.assertEqual(result.exit_code, 1)
+      self.assertIn('container:tag', result.output)
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_push_compression(self):
+    runner = CliRunner()
+    with mock.patch('hinkskalle_api.api.HinkApi.push_file') as mock_push:
+      result = runner.invoke(cli.cli, ['push', 'testhase', 'testhase:v1', '--compression', 'zstd', '--level', '9', '--threads', '4'], catch_exceptions=False)
+    self.assertEqual(result.exit_code, 0)
+    mock_push.assert_called_with(entity=None, collection='default', container='testhase', tag='v1', progress=True, filename='testhase', excludes=[], private=False, valid_for=None, chunk_size=None, connections=1, stream=False, codec='zstd', compress_level=9, threads=4, reproducible=True, gitignore=False, layers=None, layer_size=1024*1024*1024)
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_push_level(self):
+    runner = CliRunner()
+    with mock.patch('hinkskalle_api.api.HinkApi.push_file') as mock_push:
+      result = runner.invoke(cli.cli, ['push', 'testhase', 'testhase:v1', '--level', '0'], catch_exceptions=False)
+      self.assertEqual(result.exit_code, 0)
+      self.assertEqual(mock_push.call_args[1]['compress_level'], 0)
+      for args in (['--level', '10'], ['--compression', 'zstd', '--level', '0'], ['--level', '23']):
+        result = runner.invoke(cli.cli, ['push', 'testhase', 'testhase:v1', *args])
+        self.assertEqual(result.exit_code, 2, args)
+        self.assertIn('--level', result.output)
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_list_downloads(self):
+    from hinkskalle_api.auto.models import Manifest
+    runner = CliRunner()
+    manifests = [ Manifest(filename='test.bin', type='oras', tags=['v1'], total_size=3), Manifest(filename='(none)', type='oras', tags=['v2'], total_size=0), Manifest(filename='image', type='singularity', tags=['v3'], total_size=0) ]
+    with mock.patch('hinkskalle_api.api.HinkApi.iter_manifests', return_value=iter(manifests)) as mock_iter:
+      result = runner.invoke(cli.cli, ['list-downloads', 'test.hase/default/test'], catch_exceptions=False)
+    self.assertEqual(result.exit_code, 0)
+    mock_iter.assert_called_with(entity='test.hase', collection='default', container='test')
+    self.assertIn('- filename: test.bin', result.output)
+    self.assertNotIn('(none)', result.output)
+    self.assertNotIn('image', result.output)
+
+    with mock.patch('hinkskalle_api.api.HinkApi.iter_collections', return_value=iter([])):
+      result = runner.invoke(cli.cli, ['list-collections'], catch_exceptions=False)
+    self.assertIn('No collections', result.output)
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_du(self):
+    from hinkskalle_api.util.inventory import Usage
+    runner = CliRunner()
+    usage = [ Usage('container', 'test.hase/default/test', used_quota=2048), Usage('entity', 'test.hase', used_quota=2048) ]
+    usage[0].manifests = 2
+    with mock.patch('hinkskalle_api.api.HinkApi.disk_usage', return_value=iter(usage)) as mock_du:
+      result = runner.invoke(cli.cli, ['du', 'test.hase', '--workers', '4'], catch_exceptions=False)
+    self.assertEqual(result.exit_code, 0)
+    mock_du.assert_called_with('test.hase', workers=4, manifests=False)
+    self.assertRegex(result.output.splitlines()[1], r'2.0 kB .* 2 .* test.hase/default/test$')
+
+    with mock.patch('hinkskalle_api.api.HinkApi.disk_usage', return_value=iter(usage)) as mock_du:
+      result = runner.invoke(cli.cli, ['du', '--json', '-a'], catch_exceptions=False)
+    mock_du.assert_called_with(None, workers=16, manifests=True)
+    import json
+    self.assertEqual([ json.loads(l)['path'] for l in result.output.splitlines() ], [ 'test.hase/default/test', 'test.hase' ])
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_sync(self):
+    runner = CliRunner()
+    with mock.patch('hinkskalle_api.api.HinkApi.sync') as mock_sync:
+      result = runner.invoke(cli.cli, ['sync', 'test.hase/raw/test', 'mirror', '--prune'], catch_exceptions=False)
+    self.assertEqual(result.exit_code, 0)
+    self.assertEqual(mock_sync.call_args[0], ('test', 'mirror'))
+    self.assertEqual({ k: v for k, v in mock_sync.call_args[1].items() if k != 'on_file' }, { 'collection': 'raw', 'entity': 'test.hase', 'workers': 4, 'prune': True })
+
+  def test_cache(self):
+    runner = CliRunner()
+    with runner.isolated_filesystem() as tmpdir:
+      with open('hink.yml', 'w') as fh:
+        fh.write(f"hink_api_base: http://testha.se\nhink_api_key: secret\n")
+      with mock.patch.dict(os.environ, { 'HINK_API_CFG': os.path.join(tmpdir, 'hink.yml') }):
+        result = runner.invoke(cli.cli, ['cache', 'ls'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('No blob cache configured', result.output)
+
+        with open('hink.yml', 'a') as fh:
+          fh.write(f"hink_api_blob_cache: {os.path.join(tmpdir, 'blobs')}\n")
+        os.makedirs(os.path.join('blobs', 'sha256'))
+        with open(os.path.join('blobs', 'sha256', '0'*64), 'wb') as fh:
+          fh.write(b'oink')
+        result = runner.invoke(cli.cli, ['cache', 'ls'], catch_exceptions=False)
+        self.assertIn(f"sha256:{'0'*64} 4 ", result.output)
+        result = runner.invoke(cli.cli, ['cache', 'prune', '--older-than', '1d'], catch_exceptions=False)
+        self.assertIn('Removed 0 blob(s)', result.output)
+        result = runner.invoke(cli.cli, ['cache', 'prune', '--all'], catch_exceptions=False)
+        self.assertIn('Removed 1 blob(s), 4 Bytes', result.output)
+
+  @mock.patch.dict(os.environ, { 'HINK_API_BASE': 'http://testha.se', 'HINK_API_KEY': 'secret'})
+  def test_no_cache(self):
+    runner = CliRunner()
+    with mock.patch('hinkskalle_api.api.HinkApi.fetch_blob'), mock.patch('hinkskalle_api.api.HinkApi', wraps=HinkApi) as mock_api:
+      result = runner.invoke(cli.cli, ['--no-cache', 'pull', 'testhase:v1'], catch_exceptions=False)
+    self.assertEqual(result.exit_code, 0)
+    mock_api.assert_called_with(None, None, use_cache=False)
+
+  def test_help_imports(self):
+    # hinkli --help and shell completion must not load the api
+    code = "import sys; from hinkskalle_api.cli import cli\ntry:\n  cli(['--help'])\nexcept SystemExit:\n  pass\nprint(' '.join(sys.modules))"
+    ret = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    loaded = ret.stdout.decode('utf8').split()
+    for heavy in ('requests', 'yaml', 'hinkskalle_api.api', 'hinkskalle_api.auto.models'):
+      self.assertNotIn(heavy, loaded)